@@ -1,33 +1,41 @@
-import json
-import pandas as pd
+import os
 import plotly.express as px
 import pymongo
 import streamlit as st
+from marcellus.dashboard import DashboardData, SnapshotDashboardData
 
+# Read a Parquet export (python -m marcellus.export) instead of MongoDB
+EXPORT_PATH = os.environ.get("MARCELLUS_EXPORT")
 
-# Connect to database
-connection = pymongo.MongoClient(host="localhost", port=27017)
-collection = connection["marcellus"]["report.production"]
+# The county boundaries are simplified into a small artifact on first use and whenever the source changes, see
+# marcellus/geometry.py (python -m marcellus.geometry builds it ahead of time)
+GEOJSON_PATH = "Pennsylvania County Boundaries.geojson"
+GEOMETRY_PATH = "counties.geojson"
 
-# Load the county boundaries
-with open("Pennsylvania County Boundaries.geojson") as fin:
-    counties = json.load(fin)
+
+# Connect to database once per server. Query results are memoized by DashboardData until the crawl reports new data,
+# see marcellus/dashboard.py
+@st.cache(allow_output_mutation=True)
+def get_dashboard_data():
+    if EXPORT_PATH:
+        return SnapshotDashboardData(EXPORT_PATH, GEOJSON_PATH, geometry_path=GEOMETRY_PATH)
+    connection = pymongo.MongoClient(host="localhost", port=27017)
+    data = DashboardData(connection["marcellus"], GEOJSON_PATH, geometry_path=GEOMETRY_PATH)
+    data.ensure_indexes()
+    return data
+
+
+data = get_dashboard_data()
 
 # Load all unique periods
-periods = sorted(collection.distinct("production_report.period"))
+periods = data.periods()
 
 
 st.title("Marcellus Gas Well by County")
 
 # Get a dataframe with elements from the first periods
 def get_data_by_period(period):
-    cursor = collection.aggregate(
-        [{"$match": {"production_report.period": period}}, {"$group": {"_id": "$county", "sum": {"$sum": 1}}}]
-    )
-    records = ({"county": r.get("_id"), "sum": r.get("sum")} for r in cursor)
-    df = pd.DataFrame.from_dict(records)
-    df["county"] = df["county"].str.upper()
-    return df
+    return data.county_counts(period)
 
 
 # Create a sidebar
@@ -41,7 +49,8 @@ def create_map_from_period(option_period):
         df = df.groupby("county")["sum"].sum().reset_index()
         fig = px.choropleth(
             df,
-            geojson=counties,
+            # Loaded with the first map
+            geojson=data.geometry(),
             locations="county",
             featureidkey="properties.county_nam",
             color="sum",
@@ -66,3 +75,81 @@ st.plotly_chart(fig_map)
 
 fig_bar = create_barchart_from_period(option_period)
 st.plotly_chart(fig_bar)
+
+
+# Production analytics over every stored period, see marcellus/analytics.py
+PRODUCTION_VALUES = {
+    "Gas (mcf)": "quanitity_of_gas",
+    "Value of gas ($)": "value_of_gas",
+    "Royalties ($)": "est_royalites",
+}
+option_value = st.sidebar.selectbox("Production", list(PRODUCTION_VALUES))
+
+
+def create_trend_chart(option_value):
+    with st.spinner("Getting data..."):
+        df = data.production_trend(PRODUCTION_VALUES[option_value], "county")
+        df["county"] = df["county"].astype(str).str.upper()
+    return px.line(df, x="period", y="rolling", color="county")
+
+
+def create_decline_chart(well, permit_number):
+    with st.spinner("Getting data..."):
+        df = data.decline_curve(well, permit_number)
+        df["period"] = df["period"].astype(str)
+        df = df.melt(id_vars="period", value_vars=["rate", "smoothed"], var_name="series", value_name="mcf per day")
+    return px.line(df, x="period", y="mcf per day", color="series")
+
+
+st.header(f"{option_value} by county, 12 month mean")
+st.plotly_chart(create_trend_chart(option_value))
+
+st.header(f"Top wells in {option_period}")
+st.dataframe(data.top_producers(option_period, 10, PRODUCTION_VALUES[option_value]))
+
+st.header("Steepest declines since peak")
+declines = data.decline_rates()
+st.dataframe(declines.head(20))
+# Wells sharing a name are told apart by their permit number
+decline_wells = declines[["well", "permit_number"]].astype(str).head(100)
+option_well = st.selectbox(
+    "Well",
+    list(range(len(decline_wells))),
+    format_func=lambda position: "{0} ({1})".format(*decline_wells.iloc[position]),
+)
+if option_well is not None:
+    st.plotly_chart(create_decline_chart(*decline_wells.iloc[option_well]))
+
+
+# Well drilldown: indexed prefix search, one page of wells at a time, the production report loaded when a well is
+# picked, see marcellus/wells.py
+WELL_SEARCH_FIELDS = {"Well name": "well_name", "Permit number": "permit_number"}
+WELL_PAGE_SIZE = 25
+
+st.header("Well drilldown")
+search_labels = [label for label, field in WELL_SEARCH_FIELDS.items() if field in data.search_fields]
+search_field = WELL_SEARCH_FIELDS[st.radio("Search by", search_labels)]
+search_text = st.text_input("Starts with")
+found = data.count_wells(search_text, search_field)
+pages = max(1, -(-found // WELL_PAGE_SIZE))
+page = st.number_input(f"Page (of {pages}, {found} wells)", min_value=1, max_value=pages, value=1, step=1)
+page_wells = data.search_wells(search_text, search_field, int(page) - 1, WELL_PAGE_SIZE)
+st.dataframe(page_wells.drop(columns="id"))
+
+
+def well_label(position):
+    well = page_wells.iloc[position]
+    return f"{well['well_name']} ({well['permit_number'] or 'no permit'}, {well['county']})"
+
+
+def create_well_chart(well, option_value):
+    with st.spinner("Getting data..."):
+        df = data.well_series(well["id"], well["county"])
+    return px.line(df, x="period", y=PRODUCTION_VALUES[option_value]), df
+
+
+if len(page_wells):
+    position = st.selectbox("Well on this page", list(range(len(page_wells))), format_func=well_label)
+    fig_well, well_report = create_well_chart(page_wells.iloc[position], option_value)
+    st.plotly_chart(fig_well)
+    st.dataframe(well_report)
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+
+# Columnar production analytics.
+#
+# `load_frame` reads every stored period into one pandas frame, one row per well and period, in cursor batches: from
+# the well x period collection when it is filled (see `marcellus.timeseries`), otherwise from the wells, decoding
+# compact reports straight into NumPy arrays. The queries below are groupby, pivot and rolling operations on that
+# frame. `FrameCache` keeps the frame on disk keyed by the crawl generation, so repeated runs only read MongoDB again
+# after a crawl wrote new data. The dashboard memoizes the same queries, see `marcellus.dashboard`.
+#
+#     python -m marcellus.analytics trend --value quanitity_of_gas --by county
+#     python -m marcellus.analytics top --period 2019-06 -n 10
+#     python -m marcellus.analytics declines --county bradford
+import argparse
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pymongo
+from scrapy.utils.project import get_project_settings
+from marcellus import compact, export, generation
+
+WELL_COLUMNS = ("well", "permit_number", "county", "township")
+
+# A well is identified by its name and permit number, as in `marcellus.upserts`; a missing permit number is ""
+WELL_KEY = ["well", "permit_number"]
+
+VALUE_COLUMNS = compact.FLOAT_FIELDS + ("operating_days",)
+
+PERIOD_PROJECTION = dict.fromkeys(
+    ("well_name", "permit_number", "county", "township", "period", "production_company") + VALUE_COLUMNS, 1
+)
+
+WELL_PROJECTION = {
+    "well_name": 1,
+    "permit_number": 1,
+    "county": 1,
+    "township": 1,
+    "production_report": 1,
+    "compact_report": 1,
+}
+
+# Little-endian dtypes of the compact report columns
+DTYPES = {"d": "<f8", "H": "<u2", "h": "<i2"}
+
+
+class FrameBuilder:
+    """
+    Collects the periods of a batch of wells column-wise and turns them into a frame. Records are converted once per
+    batch; compact reports are already arrays.
+    """
+
+    def __init__(self):
+        self.wells = list()
+        self.counts = list()
+        self.arrays = {column: list() for column in ("month", "production_company") + VALUE_COLUMNS}
+        self.records = list()
+
+    def add_records(self, well, records):
+        if not records:
+            return
+        self.wells.append(well)
+        self.counts.append(len(records))
+        self.records.extend(records)
+
+    def flush_records(self):
+        if not self.records:
+            return
+        frame = pd.DataFrame.from_records(self.records, columns=("period", "production_company") + VALUE_COLUMNS)
+        self.records = list()
+        self.arrays["month"].append(period_months(frame["period"]))
+        self.arrays["production_company"].append(frame["production_company"].to_numpy(object))
+        for column in VALUE_COLUMNS:
+            # None becomes NaN
+            self.arrays[column].append(frame[column].to_numpy("f8", na_value=np.nan))
+
+    def add_compact(self, well, encoded):
+        length = encoded.get("length", 0)
+        if encoded.get("version") != compact.VERSION:
+            raise ValueError(f"Unknown compact report version {encoded.get('version')!r}")
+        if not length:
+            return
+        # Keep the rows in the order of the wells
+        self.flush_records()
+        self.wells.append(well)
+        self.counts.append(length)
+        columns = {
+            field: np.frombuffer(encoded[field], DTYPES[typecode]) for field, typecode in compact.TYPECODES.items()
+        }
+        self.arrays["month"].append(columns["period"].astype("i4"))
+        companies = np.array(list(encoded.get("companies", ())), object)
+        self.arrays["production_company"].append(companies[columns["production_company"]])
+        for field in compact.FLOAT_FIELDS:
+            self.arrays[field].append(columns[field])
+        days = columns["operating_days"].astype("f8")
+        days[days < 0] = np.nan
+        self.arrays["operating_days"].append(days)
+
+    def frame(self):
+        self.flush_records()
+        if not self.counts:
+            return empty_frame()
+        counts = np.array(self.counts)
+        data = {
+            column: np.repeat(np.array([well[i] for well in self.wells], object), counts)
+            for i, column in enumerate(WELL_COLUMNS)
+        }
+        for column, arrays in self.arrays.items():
+            data[column] = np.concatenate(arrays)
+        return pd.DataFrame(data)
+
+
+def empty_frame():
+    frame = pd.DataFrame({column: pd.Series([], dtype=object) for column in WELL_COLUMNS + ("production_company",)})
+    frame["month"] = pd.Series([], dtype="i4")
+    for column in VALUE_COLUMNS:
+        frame[column] = pd.Series([], dtype="f8")
+    return frame
+
+
+def well_values(document):
+    return document.get("well_name"), document.get("permit_number"), document.get("county"), document.get("township")
+
+
+def iter_well_batches(collection, batch_size=1000):
+    """
+    :param collection: Well collection
+    :param batch_size: Wells per frame
+    :return: Generator of frames
+    """
+    builder = FrameBuilder()
+    wells = 0
+    for document in collection.find({}, WELL_PROJECTION, batch_size=batch_size):
+        if "compact_report" in document:
+            builder.add_compact(well_values(document), document["compact_report"])
+        else:
+            builder.add_records(well_values(document), document.get("production_report") or [])
+        wells += 1
+        if wells % batch_size == 0:
+            yield builder.frame()
+            builder = FrameBuilder()
+    yield builder.frame()
+
+
+def iter_period_batches(periods, batch_size=50000):
+    """
+    :param periods: Well x period collection
+    :param batch_size: Periods per frame
+    :return: Generator of frames
+    """
+    cursor = periods.find({}, PERIOD_PROJECTION, batch_size=min(batch_size, 10000))
+    while True:
+        documents = [document for _, document in zip(range(batch_size), cursor)]
+        if not documents:
+            return
+        frame = pd.DataFrame.from_records(documents, columns=list(PERIOD_PROJECTION))
+        frame = frame.rename(columns={"well_name": "well"})
+        frame["month"] = period_months(frame.pop("period"))
+        yield frame
+
+
+def load_frame(collection, periods=None, batch_size=1000):
+    """
+    Every stored period as one row
+    :param collection: Well collection
+    :param periods: Well x period collection, read instead of the wells when it is filled
+    :param batch_size: Wells per cursor batch
+    :return: DataFrame with WELL_COLUMNS, `period`, `month` (months since year 0), `production_company` and the
+        VALUE_COLUMNS
+    """
+    if periods is not None and periods.estimated_document_count() > 0:
+        batches = iter_period_batches(periods, batch_size * 50)
+    else:
+        batches = iter_well_batches(collection, batch_size)
+    return finish_frame(pd.concat(list(batches), ignore_index=True))
+
+
+def finish_frame(frame):
+    """
+    Compact dtypes, the `period` column, and rows sorted by well and month
+    :param frame: Raw frame with WELL_COLUMNS, `month`, `production_company` and VALUE_COLUMNS
+    :return:
+    """
+    # Grouping drops missing keys
+    frame["permit_number"] = frame["permit_number"].fillna("")
+    for column in WELL_COLUMNS + ("production_company",):
+        frame[column] = frame[column].astype("category")
+    for column in VALUE_COLUMNS:
+        frame[column] = frame[column].astype("f8")
+    frame["month"] = frame["month"].astype("i4")
+    # Periods that could not be read are left out
+    frame = frame[frame["month"] > 0]
+    frame = frame.assign(period=month_periods(frame["month"]))
+    return frame.sort_values(WELL_KEY + ["month"], kind="mergesort").reset_index(drop=True)
+
+
+def load_export_frame(path):
+    """
+    `load_frame` from a Parquet export, see `marcellus.export`. Wells exported again after an update keep the rows of
+    their latest export only, see `marcellus.export.latest_rows`.
+    :param path: Export directory
+    :return: DataFrame as returned by `load_frame`
+    """
+    columns = ["well_name", "permit_number", "county", "township", "period", "production_company"]
+    exported = export.read_export(path, columns + list(VALUE_COLUMNS))
+    frame = pd.DataFrame(
+        {
+            "well": exported["well_name"].to_numpy(object),
+            "permit_number": exported["permit_number"].to_numpy(object),
+            "county": exported["county"].astype(str).to_numpy(object),
+            "township": exported["township"].to_numpy(object),
+            "production_company": exported["production_company"].to_numpy(object),
+        }
+    )
+    frame["month"] = period_months(exported["period"])
+    for column in VALUE_COLUMNS:
+        frame[column] = exported[column].to_numpy("f8", na_value=np.nan)
+    return finish_frame(frame)
+
+
+def period_months(periods):
+    """
+    :param periods: Series of `YYYY-MM` periods
+    :return: Array of months since year 0; 0 where the period is missing
+    """
+    # A few hundred distinct periods; convert each once. Missing periods have code -1 and pick the trailing 0.
+    codes, uniques = pd.factorize(periods)
+    return np.array([compact.period_ordinal(period) for period in uniques] + [0], "i4")[codes]
+
+
+def month_periods(months):
+    """
+    :param months: Series of months since year 0
+    :return: Categorical series of `YYYY-MM` periods
+    """
+    codes, uniques = pd.factorize(months, sort=True)
+    return pd.Categorical.from_codes(codes, [compact.ordinal_period(month) for month in uniques], ordered=True)
+
+
+def month_range(start, stop):
+    return pd.Index(range(start, stop + 1), name="month")
+
+
+def county_rollup(frame, value="quanitity_of_gas"):
+    """
+    :param frame: See `load_frame`
+    :param value: Column to total
+    :return: DataFrame of `period`, `county`, `total` and `wells`, one row per county and period
+    """
+    rollup = frame.groupby(["month", "county"], observed=True, sort=True).agg(
+        total=(value, "sum"), wells=("well", "count")
+    )
+    rollup = rollup.reset_index()
+    rollup.insert(0, "period", rollup.pop("month").map(compact.ordinal_period))
+    return rollup
+
+
+def trend(frame, value="quanitity_of_gas", by=None, window=12):
+    """
+    Monthly totals and their trailing mean over `window` months. Months without reports count as zero.
+    :param frame: See `load_frame`
+    :param value: Column to total
+    :param by: None for the whole corpus, or a column such as "county"
+    :param window: Months of the rolling mean
+    :return: Long DataFrame of `period`, the `by` column, `total` and `rolling`
+    """
+    if frame.empty:
+        return pd.DataFrame(columns=["period"] + ([by] if by else []) + ["total", "rolling"])
+    if by is None:
+        wide = frame.groupby("month")[value].sum().to_frame("all")
+    else:
+        wide = frame.pivot_table(index="month", columns=by, values=value, aggfunc="sum", observed=True)
+    wide = wide.reindex(month_range(wide.index.min(), wide.index.max())).fillna(0.0)
+    rolling = wide.rolling(window, min_periods=1).mean()
+    name = by or "series"
+    result = pd.DataFrame({"total": wide.stack(), "rolling": rolling.stack()}).reset_index()
+    result.columns = ["month", name, "total", "rolling"]
+    result.insert(0, "period", result.pop("month").map(compact.ordinal_period))
+    return result if by is not None else result.drop(columns=name)
+
+
+def decline_curves(frame, window=3, wells=None, permit_number=None):
+    """
+    Daily gas rate of every well and period, smoothed over `window` reported months
+    :param frame: See `load_frame`
+    :param window: Reported months of the rolling mean
+    :param wells: Only wells with these names
+    :param permit_number: Only the well with this permit number, "" for wells without one
+    :return: DataFrame of `well`, `permit_number`, `county`, `period`, `month`, `rate` (mcf/day), `smoothed`, `change`
+        (month over month of the smoothed rate) and `from_peak` (share of the smoothed peak lost)
+    """
+    if wells is not None:
+        frame = frame[frame["well"].isin(wells)]
+    if permit_number is not None:
+        frame = frame[frame["permit_number"] == permit_number]
+    days = frame["operating_days"].where(frame["operating_days"] > 0)
+    curves = pd.DataFrame(
+        {
+            "well": frame["well"],
+            "permit_number": frame["permit_number"],
+            "county": frame["county"],
+            "period": frame["period"],
+            "month": frame["month"],
+            "rate": frame["quanitity_of_gas"] / days,
+        }
+    )
+    by_well = curves.groupby(WELL_KEY, observed=True, sort=False)
+    # The frame is sorted by well and month, so the rolling windows line up with the rows
+    smoothed = by_well["rate"].rolling(window, min_periods=1).mean()
+    curves["smoothed"] = smoothed.reset_index(level=list(range(len(WELL_KEY))), drop=True)
+    by_well = curves.groupby(WELL_KEY, observed=True, sort=False)
+    curves["change"] = curves["smoothed"] / by_well["smoothed"].shift(1) - 1.0
+    curves["from_peak"] = 1.0 - curves["smoothed"] / by_well["smoothed"].cummax()
+    return curves
+
+
+def decline_rates(curves, min_months=6):
+    """
+    Exponential decline of every well fitted after its peak, ln q(t) = ln q_peak - D t, by least squares computed with
+    grouped sums
+    :param curves: See `decline_curves`
+    :param min_months: Wells with fewer reported months after the peak are left out
+    :return: DataFrame of `well`, `permit_number`, `county`, `peak_period`, `peak_rate`, `months`, `monthly_decline`
+        (D) and `annual_decline` (share of the rate lost per year), steepest first
+    """
+    rated = curves[curves["smoothed"] > 0]
+    peak = rated.loc[rated.groupby(WELL_KEY, observed=True, sort=False)["smoothed"].idxmax()]
+    peak = peak.set_index(WELL_KEY)[["county", "period", "month", "smoothed"]]
+    after = rated.join(peak["month"].rename("peak_month"), on=WELL_KEY)
+    after = after[after["month"] >= after["peak_month"]]
+    t = (after["month"] - after["peak_month"]).astype("f8")
+    y = np.log(after["smoothed"])
+    sums = after[WELL_KEY].assign(n=1.0, t=t, y=y, tt=t * t, ty=t * y)
+    sums = sums.groupby(WELL_KEY, observed=True).sum()
+    sums = sums[sums["n"] >= min_months]
+    slope = (sums["n"] * sums["ty"] - sums["t"] * sums["y"]) / (sums["n"] * sums["tt"] - sums["t"] ** 2)
+    peak = peak.loc[sums.index]
+    rates = pd.DataFrame(
+        {
+            "county": peak["county"],
+            "peak_period": peak["period"],
+            "peak_rate": peak["smoothed"],
+            "months": sums["n"].astype("i4"),
+            "monthly_decline": -slope,
+        }
+    )
+    rates["annual_decline"] = 1.0 - np.exp(12.0 * -rates["monthly_decline"])
+    rates.index.names = WELL_KEY
+    return rates.sort_values("monthly_decline", ascending=False).reset_index()
+
+
+def top_producers(frame, n=10, value="quanitity_of_gas", period=None):
+    """
+    :param frame: See `load_frame`
+    :param n: Wells per period
+    :param value: Column to rank by
+    :param period: Only this period
+    :return: DataFrame of the `n` largest wells of every period with their rank
+    """
+    if period is not None:
+        frame = frame[frame["period"] == period]
+    ranked = frame.sort_values(["month", value], ascending=[True, False], kind="mergesort")
+    top = ranked.groupby("month", sort=False).head(n)
+    top = top[["period", "well", "permit_number", "county", "township", "production_company", value]]
+    top = top.reset_index(drop=True)
+    top.insert(1, "rank", top.groupby("period", observed=True).cumcount() + 1)
+    return top
+
+
+class FrameCache:
+    """
+    `load_frame` results pickled on disk, keyed by the crawl generation and the number of stored wells
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name, key):
+        return os.path.join(self.directory, "frame-{0}-{1}.pkl".format(name, "-".join(str(part) for part in key)))
+
+    def load(self, name, key, compute):
+        path = self.path(name, key)
+        if os.path.exists(path):
+            return pd.read_pickle(path)
+        frame = compute()
+        os.makedirs(self.directory, exist_ok=True)
+        for stale in glob.glob(os.path.join(self.directory, f"frame-{name}-*.pkl")):
+            os.remove(stale)
+        frame.to_pickle(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        return frame
+
+
+def generation_key(collection, meta):
+    """
+    :return: Cache key of the stored data; the count catches writers that do not bump the generation
+    """
+    current = generation.current(meta, collection.name) if meta is not None else 0
+    return current, collection.estimated_document_count()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Production analytics over the stored wells")
+    parser.add_argument("query", choices=("rollup", "trend", "declines", "curves", "top"))
+    parser.add_argument("--value", default="quanitity_of_gas", choices=VALUE_COLUMNS, help="Column to total or rank")
+    parser.add_argument("--by", help="Trend per county, township or production_company")
+    parser.add_argument("--window", type=int, help="Months of the rolling mean (trend: 12, curves: 3)")
+    parser.add_argument("--period", help="Only this period, e.g. 2019-06")
+    parser.add_argument("--county", help="Only wells in this county")
+    parser.add_argument("--well", action="append", help="Only this well, repeatable")
+    parser.add_argument("-n", type=int, default=10, help="Rows per period (top) or in total (declines)")
+    parser.add_argument("--cache-dir", default=".analytics", help="Frame cache; empty to always read MongoDB")
+    parser.add_argument("--csv", help="Write the result to this file instead of printing it")
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    db = client[settings.get("MONGO_DATABASE", "marcellus")]
+    collection = db[settings.get("MONGO_COLLECTION", "report.production")]
+    periods = db[settings.get("MONGO_PERIOD_COLLECTION")] if settings.get("MONGO_PERIOD_COLLECTION") else None
+    meta = db[settings.get("MONGO_META_COLLECTION")] if settings.get("MONGO_META_COLLECTION") else None
+
+    def compute():
+        return load_frame(collection, periods)
+
+    if args.cache_dir:
+        frame = FrameCache(args.cache_dir).load(collection.name, generation_key(collection, meta), compute)
+    else:
+        frame = compute()
+    client.close()
+
+    if args.county:
+        frame = frame[frame["county"].astype(str).str.lower() == args.county.lower()]
+    if args.query == "rollup":
+        result = county_rollup(frame, args.value)
+        if args.period:
+            result = result[result["period"] == args.period]
+    elif args.query == "trend":
+        result = trend(frame, args.value, args.by, args.window or 12)
+    elif args.query == "curves":
+        result = decline_curves(frame, args.window or 3, args.well)
+    elif args.query == "declines":
+        result = decline_rates(decline_curves(frame, args.window or 3, args.well)).head(args.n)
+    else:
+        result = top_producers(frame, args.n, args.value, args.period)
+
+    if args.csv:
+        result.to_csv(args.csv, index=False)
+        print(f"{len(result)} rows written to {args.csv}")
+    else:
+        with pd.option_context("display.width", 160, "display.max_columns", 20):
+            result.to_string(sys.stdout, index=False)
+            print()
+
+
+if __name__ == "__main__":
+    main()
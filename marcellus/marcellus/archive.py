@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Append-only archive of crawled responses.
+#
+# Every response is stored as its own gzip member in `responses.gz`, and a line in `responses.idx` records its
+# offset and length together with the URL and well_id. Appending never rewrites earlier data, and single responses can
+# be read back without decompressing the whole archive.
+import gzip
+import json
+import os
+
+DATA_FILE = "responses.gz"
+INDEX_FILE = "responses.idx"
+
+
+class ResponseArchive:
+    """
+    Compressed response archive keyed by URL and well_id
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_path = os.path.join(path, DATA_FILE)
+        self.index_path = os.path.join(path, INDEX_FILE)
+        self.data = None
+        self.index = None
+        self.entries = None
+        self.well_ids = None
+
+    def open_writer(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.data = open(self.data_path, "ab")
+        self.index = open(self.index_path, "a", encoding="utf-8")
+
+    def open_reader(self):
+        self.data = open(self.data_path, "rb")
+        self.load_index()
+
+    def close(self):
+        for handle in (self.data, self.index):
+            if handle is not None:
+                handle.close()
+        self.data = self.index = None
+
+    def append(self, kind, url, body, well_id=None, status=200):
+        """
+        Add a response to the archive
+        :param kind: "index" for the rendered production report, "page" for the production report as served, "fragment"
+            for a township permit table, "well" for a well report
+        :param url:
+        :param body: Decoded response body
+        :param well_id:
+        :param status:
+        :return:
+        """
+        record = {"kind": kind, "url": url, "well_id": well_id, "status": status, "body": body}
+        payload = gzip.compress(json.dumps(record).encode("utf-8"))
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(payload)
+        self.data.flush()
+        entry = {"kind": kind, "url": url, "well_id": well_id, "offset": offset, "length": len(payload)}
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+    def load_index(self):
+        """
+        Read the index. Later entries for the same URL replace earlier ones.
+        :return:
+        """
+        self.entries = dict()
+        self.well_ids = dict()
+        with open(self.index_path, encoding="utf-8") as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash during capture can leave a partial last line
+                    continue
+                self.entries[entry["url"]] = entry
+                if entry.get("well_id") is not None:
+                    self.well_ids[entry["well_id"]] = entry
+        return self.entries
+
+    def urls(self, kind=None):
+        return [url for url, entry in self.entries.items() if kind is None or entry["kind"] == kind]
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        return None if entry is None else self.read(entry)
+
+    def get_by_well_id(self, well_id):
+        entry = self.well_ids.get(well_id)
+        return None if entry is None else self.read(entry)
+
+    def read(self, entry):
+        self.data.seek(entry["offset"])
+        return json.loads(gzip.decompress(self.data.read(entry["length"])).decode("utf-8"))
+
+    def __len__(self):
+        return len(self.entries or ())
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# Throughput benchmark for the crawl stages, run against synthetic pages.
+#
+#     python -m marcellus.benchmark --counties 60 --wells 20000 --periods 120 --reports 2000
+#     python -m marcellus.benchmark --mongomock
+#     python -m marcellus.benchmark --compact
+#     python -m marcellus.benchmark --processes 4
+#     python -m marcellus.benchmark --mongo-uri mongodb://localhost:27017
+#
+# Each stage reports items/sec and the peak resident memory of the process once the stage has finished.
+import argparse
+import collections
+import json
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import bson
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+from marcellus import compact, offload, synthetic
+from marcellus.pipelines import MarcellusPipeline, MongoDBPipeline
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+BASE_URL = "http://www.marcellusgas.org"
+
+StageResult = collections.namedtuple("StageResult", ("stage", "items", "seconds", "peak_rss_mb"))
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def result(stage, items, seconds):
+    return StageResult(stage, items, seconds, peak_rss_mb())
+
+
+def bench_index(spider, args):
+    page = synthetic.index_page(args.counties, args.wells, args.townships, args.seed)
+    response = HtmlResponse(url=f"{BASE_URL}/pro_update.php", body=page.encode("utf-8"), encoding="utf-8")
+    del page
+    started = time.perf_counter()
+    requests = list(spider.parse_production_report(response))
+    return result("parse_production_report", len(requests), time.perf_counter() - started), requests
+
+
+def bench_well_reports(spider, requests, args):
+    items = list()
+    elapsed = 0.0
+    for request in requests[: args.reports]:
+        row = request.meta["row"]
+        well_id = request.url.split("well_id=")[-1]
+        page = synthetic.well_report_page(int(well_id), args.periods, args.seed)
+        response = HtmlResponse(url=request.url, body=page.encode("utf-8"), encoding="utf-8", request=request)
+        started = time.perf_counter()
+        item = spider.parse_by_well_id(response, well_id, row)
+        elapsed += time.perf_counter() - started
+        if item is not None:
+            items.append(item)
+    return result("parse_by_well_id", len(items), elapsed), items
+
+
+def bench_offload(spider, requests, args):
+    """
+    Parse and clean the same well reports in a pool of --processes workers; compare with parse_by_well_id and
+    MarcellusPipeline together
+    """
+    well_ids = [request.url.split("well_id=")[-1] for request in requests[: args.reports]]
+    pages = [synthetic.well_report_page(int(well_id), args.periods, args.seed) for well_id in well_ids]
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=offload.mp_context()) as executor:
+        # Start the workers before the clock does
+        list(
+            executor.map(
+                offload.parse_well_report, pages[: args.processes], well_ids, repeat(spider.well_report_parser)
+            )
+        )
+        started = time.perf_counter()
+        reports = executor.map(
+            offload.parse_well_report, pages, well_ids, repeat(spider.well_report_parser), chunksize=8
+        )
+        cleaned = sum(1 for records in reports if records is not None)
+        elapsed = time.perf_counter() - started
+    return result(f"process pool ({args.processes})", cleaned, elapsed)
+
+
+def bench_pipeline(spider, items, args):
+    pipeline = MarcellusPipeline()
+    pipeline.compact = args.compact
+    started = time.perf_counter()
+    cleaned = [pipeline.process_item(item, spider) for item in items]
+    return result("MarcellusPipeline", len(cleaned), time.perf_counter() - started), cleaned
+
+
+def bench_encode(items):
+    started = time.perf_counter()
+    sizes = [len(bson.encode(compact.to_document(item))) for item in items]
+    return result("BSON encode", len(sizes), time.perf_counter() - started), sum(sizes) / len(sizes) if sizes else 0
+
+
+def bench_mongo(items, settings, args):
+    if args.mongomock:
+        import mongomock
+
+        client = mongomock.MongoClient()
+    else:
+        import pymongo
+
+        client = pymongo.MongoClient(args.mongo_uri)
+    batch_size = settings.getint("MONGO_BATCH_SIZE", 500)
+    writer = MongoDBPipeline(args.mongo_uri, settings.get("MONGO_DATABASE", "marcellus"), args.collection, batch_size)
+    writer.collection = client[writer.mongo_db][writer.mongo_collection]
+    writer.collection.drop()
+    started = time.perf_counter()
+    for start in range(0, len(items), batch_size):
+        writer.write_batch([writer.to_document(item) for item in items[start : start + batch_size]])
+    elapsed = time.perf_counter() - started
+    writer.collection.drop()
+    client.close()
+    return result("MongoDB bulk write", len(items), elapsed)
+
+
+def run(args):
+    settings = get_project_settings()
+    spider = MarcellusSpider()
+    spider.index_page_parser = args.index_page_parser or settings.get("INDEX_PAGE_PARSER", "lxml")
+    spider.well_report_parser = args.well_report_parser or settings.get("WELL_REPORT_PARSER", "regex")
+
+    results = list()
+    stage, requests = bench_index(spider, args)
+    results.append(stage)
+    stage, items = bench_well_reports(spider, requests, args)
+    results.append(stage)
+    stage, items = bench_pipeline(spider, items, args)
+    results.append(stage)
+    if args.processes:
+        results.append(bench_offload(spider, requests, args))
+    stage, document_bytes = bench_encode(items)
+    results.append(stage)
+    if args.mongomock or args.mongo_uri:
+        results.append(bench_mongo(items, settings, args))
+    return results, document_bytes
+
+
+def report(results):
+    print(f"{'stage':<26}{'items':>10}{'seconds':>10}{'items/sec':>12}{'peak MB':>10}")
+    for stage in results:
+        rate = stage.items / stage.seconds if stage.seconds else float("inf")
+        print(f"{stage.stage:<26}{stage.items:>10}{stage.seconds:>10.2f}{rate:>12.0f}{stage.peak_rss_mb:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the crawl stages on synthetic pages")
+    parser.add_argument("--counties", type=int, default=60)
+    parser.add_argument("--townships", type=int, default=20, help="Townships per county")
+    parser.add_argument("--wells", type=int, default=20000, help="Wells on the production report index")
+    parser.add_argument("--periods", type=int, default=120, help="Operating periods per well report")
+    parser.add_argument("--reports", type=int, default=2000, help="Well reports to parse and clean")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--index-page-parser", choices=("lxml", "xpath"))
+    parser.add_argument("--well-report-parser", choices=("regex", "lxml"))
+    parser.add_argument("--compact", action="store_true", help="Hold cleaned reports as typed arrays")
+    parser.add_argument(
+        "--processes", type=int, default=0, help="Also parse and clean in a pool of this many processes"
+    )
+    parser.add_argument("--mongo-uri", help="Time bulk writes against this MongoDB")
+    parser.add_argument("--mongomock", action="store_true", help="Time bulk writes against mongomock")
+    parser.add_argument("--collection", default="benchmark.production", help="Scratch collection, dropped after")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results, document_bytes = run(args)
+    report(results)
+    print(f"mean document size: {document_bytes:.0f} bytes")
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump([stage._asdict() for stage in results], fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
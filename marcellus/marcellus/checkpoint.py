@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# Crash-safe checkpoint of the well report frontier.
+#
+# The spider stores every well row it is about to request, and MongoDBPipeline marks a well done once its item is
+# written. Wells whose download fails, whose page has no report or whose item is dropped are marked failed; they are
+# not retried. After a crash the next run requests only the wells still pending, reusing the saved session cookies
+# while they are fresh enough. A crawl that finishes clears the frontier, so the next one starts from the index again.
+#
+# In fragments mode the frontier grows one township permit table at a time, so the townships are stored as well and
+# marked done once the rows of their table are in the frontier. A crash before every table was read leaves townships
+# pending; the resumed crawl requests their tables again, and the frontier is only cleared when none is left.
+import json
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frontier (
+    link TEXT PRIMARY KEY,
+    row TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS townships (
+    permit_link TEXT PRIMARY KEY,
+    meta TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS session (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    cookies TEXT NOT NULL,
+    saved REAL NOT NULL
+);
+"""
+
+
+class Checkpoint:
+    """
+    SQLite checkpoint of the well rows requested and the wells written
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        columns = [column for _, column, *_ in self.db.execute("PRAGMA table_info(frontier)")]
+        if "failed" not in columns:
+            # Checkpoints written before failures were recorded
+            with self.db:
+                self.db.execute("ALTER TABLE frontier ADD COLUMN failed INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.db.close()
+
+    def add_rows(self, rows):
+        """
+        :param rows: Well rows about to be requested
+        :return: The rows not in the frontier yet
+        """
+        added = list()
+        with self.db:
+            for row in rows:
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO frontier (link, row) VALUES (?, ?)", (row["link"], json.dumps(row))
+                )
+                if cursor.rowcount:
+                    added.append(row)
+        return added
+
+    def complete(self, links):
+        with self.db:
+            self.db.executemany("UPDATE frontier SET done = 1 WHERE link = ?", [(link,) for link in links])
+
+    def fail(self, links):
+        """
+        Give up on wells; a resumed crawl does not request them again
+        :param links: Well report links
+        :return:
+        """
+        with self.db:
+            self.db.executemany(
+                "UPDATE frontier SET failed = 1 WHERE link = ? AND done = 0", [(link,) for link in links]
+            )
+
+    def pending_rows(self):
+        return [json.loads(row) for row, in self.db.execute("SELECT row FROM frontier WHERE done = 0 AND failed = 0")]
+
+    def progress(self):
+        """
+        :return: (wells done, wells failed, wells in the frontier)
+        """
+        return self.db.execute(
+            "SELECT COALESCE(SUM(done), 0), COALESCE(SUM(failed), 0), COUNT(*) FROM frontier"
+        ).fetchone()
+
+    def add_townships(self, townships):
+        """
+        :param townships: Request meta of every township permit table, see `MarcellusSpider.request_permit_tables`
+        :return:
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO townships (permit_link, meta) VALUES (?, ?)",
+                [(township["permit_link"], json.dumps(township)) for township in townships],
+            )
+
+    def complete_townships(self, permit_links=None):
+        """
+        The well rows of these townships are in the frontier
+        :param permit_links: Township link ids, all townships when None
+        :return:
+        """
+        with self.db:
+            if permit_links is None:
+                self.db.execute("UPDATE townships SET done = 1")
+            else:
+                self.db.executemany(
+                    "UPDATE townships SET done = 1 WHERE permit_link = ?", [(link,) for link in permit_links]
+                )
+
+    def pending_townships(self):
+        return [json.loads(meta) for meta, in self.db.execute("SELECT meta FROM townships WHERE done = 0")]
+
+    def reset(self):
+        """
+        Start a new frontier for a new crawl
+        :return:
+        """
+        with self.db:
+            self.db.execute("DELETE FROM frontier")
+            self.db.execute("DELETE FROM townships")
+
+    def save_session(self, cookies):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO session (id, cookies, saved) VALUES (0, ?, ?)",
+                (json.dumps(cookies), time.time()),
+            )
+
+    def session(self, max_age):
+        """
+        :param max_age: Seconds a saved session is trusted
+        :return: Cookie dict, or None when there is no fresh session
+        """
+        row = self.db.execute("SELECT cookies, saved FROM session WHERE id = 0").fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        return json.loads(row[0])
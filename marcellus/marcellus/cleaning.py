@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Cleaning engine for the production report of a well.
+#
+# The field spec maps every cleaned field to the label it is read from and the function that parses it. Patterns are
+# compiled once at import and the period parser is cached, so cleaning a well is a single pass over its report.
+#
+# Only the regex parser needs cleaning: it strips all whitespace and markup from the report and leaves labels such as
+# `QuantityofGas` with values such as `1,234Mcf`. The lxml parser emits cleaned records itself, see
+# `marcellus.extractors.extract_well_report`.
+import datetime
+import functools
+import re
+import time
+
+AVERAGE_PRODUCTION = re.compile(r":\$([0-9.,]+)\(")
+ROYALTIES = re.compile(r"([0-9][0-9,.]*)\(")
+OPERATING_DAYS = re.compile(r"([0-9]+)")
+QUANTITY_OF_GAS = re.compile(r"([0-9,.]+)")
+CROWD_SOURCE_ATW = re.compile(r"([0-9.,]+)\/")
+VALUE_OF_GAS = re.compile(r"\$([0-9,.]+)\(")
+
+# Report labels become record keys, e.g. `Est.Royalties:` -> `Est_Royalties`
+LABEL_TABLE = str.maketrans({":": None, ".": "_"})
+
+MONTHS = {
+    month: "{0:02d}".format(number)
+    for number, month in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), start=1
+    )
+}
+
+
+def _float(pattern, original):
+    match = pattern.search(original)
+    if match is None:
+        return None
+    return float(match.group(1).replace(",", ""))
+
+
+def clean_average_production(original):
+    return _float(AVERAGE_PRODUCTION, original)
+
+
+def clean_royalties(original):
+    return _float(ROYALTIES, original)
+
+
+def clean_operating_days(original):
+    match = OPERATING_DAYS.search(original)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def clean_company(original):
+    return original.replace(":", "").replace("&amp", "_")
+
+
+def clean_quantity_of_gas(original):
+    return _float(QUANTITY_OF_GAS, original)
+
+
+def clean_crowd_source_atw(original):
+    return _float(CROWD_SOURCE_ATW, original)
+
+
+def clean_value_of_gas(original):
+    return _float(VALUE_OF_GAS, original)
+
+
+@functools.lru_cache(maxsize=4096)
+def clean_period(original):
+    """
+    `OperatingPeriod:Jul2019-Dec2019` -> `2019-12`
+    Periods repeat across every well so results are cached. Month tokens are looked up directly; anything unusual
+    falls back to strptime so the result (or error) is the same as before.
+    :param original:
+    :return:
+    """
+    parsed = original.split(":")[-1].split("-")[-1][:7]
+    month = MONTHS.get(parsed[:3].lower())
+    year = parsed[3:]
+    if month is None or len(year) != 4 or not (year.isascii() and year.isdigit()) or year[0] == "0":
+        return datetime.datetime.strptime(parsed, "%b%Y").strftime("%Y-%m")
+    return "{0}-{1}".format(year, month)
+
+
+@functools.lru_cache(maxsize=256)
+def record_key(label):
+    return label.translate(LABEL_TABLE)
+
+
+# (cleaned field, record key, cleaner)
+FIELD_SPEC = (
+    ("avg_production", "AvgProductionPerDay", clean_average_production),
+    ("est_royalites", "Est_Royalties", clean_royalties),
+    ("operating_days", "OperatingDays", clean_operating_days),
+    ("production_company", "ProductionCompany", clean_company),
+    ("quanitity_of_gas", "QuantityofGas", clean_quantity_of_gas),
+    ("value_of_gas", "ValueofGas", clean_value_of_gas),
+    ("crowd_source_atw", "crowdsourcedATW", clean_crowd_source_atw),
+    ("period", "period", clean_period),
+)
+
+
+class ReportCleaner:
+    """
+    Compiles a field spec and cleans every operating period of a well in one pass. This is the adapter from the
+    regex parser's format to cleaned records.
+    """
+
+    def __init__(self, spec=FIELD_SPEC):
+        self.spec = tuple(spec)
+        self.keys = frozenset(key for _, key, _ in self.spec)
+
+    def clean(self, production_report):
+        """
+        :param production_report: {operating period: [label, value, label, value, ...]} from the regex parser
+        :return: List of cleaned records, one per operating period
+        """
+        return [self.clean_values(op_period, values) for op_period, values in production_report.items()]
+
+    def clean_values(self, op_period, values):
+        record = dict()
+        pairs = iter(values)
+        for label, value in zip(pairs, pairs):
+            key = record_key(label)
+            if key in self.keys:
+                record[key] = value
+        record["period"] = op_period
+        return self.clean_record(record)
+
+    def clean_record(self, record):
+        return {field: cleaner(record.get(key, "")) for field, key, cleaner in self.spec}
+
+
+class TimedReportCleaner(ReportCleaner):
+    """
+    ReportCleaner that records the time of every field cleaner as a `clean_<field>` stage
+    """
+
+    def __init__(self, metrics, spec=FIELD_SPEC):
+        super().__init__(spec)
+        self.metrics = metrics
+        self.stages = tuple((field, key, cleaner, f"clean_{field}") for field, key, cleaner in self.spec)
+
+    def clean_record(self, record):
+        cleaned = dict()
+        for field, key, cleaner, stage in self.stages:
+            started = time.perf_counter()
+            cleaned[field] = cleaner(record.get(key, ""))
+            self.metrics.observe(stage, time.perf_counter() - started)
+        return cleaned
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Compact production reports.
+#
+# With COMPACT_REPORTS, MarcellusPipeline holds the cleaned report of a well as typed arrays, one per field, instead of
+# a list of per-period dicts: periods as month ordinals, operating days as integers, the money and gas figures as
+# doubles and the production companies as codes into a short list of interned names. MongoDBPipeline stores the arrays
+# as little-endian binary columns under `compact_report`; `report_records` and `expand` turn a stored well back into
+# the usual `production_report` records for the readers.
+import sys
+from array import array
+import bson
+
+VERSION = 1
+
+FLOAT_FIELDS = ("avg_production", "est_royalites", "quanitity_of_gas", "value_of_gas", "crowd_source_atw")
+
+# Typecode of every binary column; missing values are NaN for doubles and -1 (0 for periods) for integers
+TYPECODES = dict({field: "d" for field in FLOAT_FIELDS}, period="H", operating_days="h", production_company="H")
+
+NAN = float("nan")
+
+# Enough of a well document, in either layout, for `report_periods`
+PERIOD_PROJECTION = {
+    "county": 1,
+    "production_report.period": 1,
+    "compact_report.version": 1,
+    "compact_report.period": 1,
+}
+
+
+def period_ordinal(period):
+    """
+    `2019-12` -> 2019 * 12 + 11
+    :param period:
+    :return:
+    """
+    if period is None:
+        return 0
+    year, month = period.split("-")
+    return int(year) * 12 + int(month) - 1
+
+
+def ordinal_period(ordinal):
+    if ordinal == 0:
+        return None
+    year, month = divmod(ordinal, 12)
+    return "{0}-{1:02d}".format(year, month + 1)
+
+
+class CompactReport:
+    """
+    Cleaned production report of one well held column-wise in typed arrays
+    """
+
+    __slots__ = ("columns", "companies")
+
+    def __init__(self, columns, companies):
+        self.columns = columns
+        self.companies = companies
+
+    def __len__(self):
+        return len(self.columns["period"])
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: Cleaned records, see `marcellus.cleaning.ReportCleaner.clean`
+        :return: CompactReport
+        """
+        columns = {field: array(typecode) for field, typecode in TYPECODES.items()}
+        companies = dict()
+        for record in records:
+            for field in FLOAT_FIELDS:
+                value = record.get(field)
+                columns[field].append(NAN if value is None else value)
+            days = record.get("operating_days")
+            columns["operating_days"].append(-1 if days is None else days)
+            company = record.get("production_company")
+            code = companies.get(company)
+            if code is None:
+                code = companies[company] = len(companies)
+            columns["production_company"].append(code)
+            columns["period"].append(period_ordinal(record.get("period")))
+        # The same few operators run thousands of wells; share one string per name
+        return cls(columns, tuple(name if name is None else sys.intern(name) for name in companies))
+
+    def to_records(self):
+        """
+        :return: The cleaned records the report was built from
+        """
+        columns = self.columns
+        floats = [columns[field] for field in FLOAT_FIELDS]
+        records = list()
+        for i in range(len(self)):
+            avg_production, est_royalites, quanitity_of_gas, value_of_gas, crowd_source_atw = (
+                None if column[i] != column[i] else column[i] for column in floats
+            )
+            days = columns["operating_days"][i]
+            records.append(
+                {
+                    "avg_production": avg_production,
+                    "est_royalites": est_royalites,
+                    "operating_days": None if days < 0 else days,
+                    "production_company": self.companies[columns["production_company"][i]],
+                    "quanitity_of_gas": quanitity_of_gas,
+                    "value_of_gas": value_of_gas,
+                    "crowd_source_atw": crowd_source_atw,
+                    "period": ordinal_period(columns["period"][i]),
+                }
+            )
+        return records
+
+    def periods(self):
+        return [ordinal_period(ordinal) for ordinal in self.columns["period"]]
+
+    def encode(self):
+        """
+        :return: BSON-ready subdocument with one little-endian binary column per field
+        """
+        encoded = {"version": VERSION, "length": len(self), "companies": list(self.companies)}
+        for field, column in self.columns.items():
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            encoded[field] = bson.Binary(column.tobytes())
+        return encoded
+
+    @classmethod
+    def decode(cls, encoded, fields=None):
+        """
+        :param encoded: Subdocument written by `encode`
+        :param fields: Only decode these columns
+        :return: CompactReport
+        """
+        if encoded.get("version") != VERSION:
+            raise ValueError(f"Unknown compact report version {encoded.get('version')!r}")
+        columns = dict()
+        for field in fields or TYPECODES:
+            column = array(TYPECODES[field])
+            column.frombytes(encoded[field])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns[field] = column
+        return cls(columns, tuple(encoded.get("companies", ())))
+
+
+def report_records(document):
+    """
+    Production report records of a stored well in either layout
+    :param document: Well document
+    :return: List of cleaned records
+    """
+    if "compact_report" in document:
+        return CompactReport.decode(document["compact_report"]).to_records()
+    return document.get("production_report") or []
+
+
+def report_periods(document):
+    """
+    Periods of a stored well in either layout; only the period column of a compact report is decoded
+    :param document: Well document, at least PERIOD_PROJECTION
+    :return: List of periods
+    """
+    if "compact_report" in document:
+        encoded = document["compact_report"]
+        return CompactReport.decode(encoded, fields=("period",)).periods()
+    return [record.get("period") for record in document.get("production_report") or ()]
+
+
+def expand(document):
+    """
+    :param document: Well document
+    :return: The document with a compact report expanded into `production_report`
+    """
+    if "compact_report" not in document:
+        return document
+    document = dict(document)
+    document["production_report"] = CompactReport.decode(document.pop("compact_report")).to_records()
+    return document
+
+
+def to_document(item):
+    """
+    Mongo document of an item, with a compact report encoded
+    :param item:
+    :return:
+    """
+    document = dict(item)
+    report = document.get("production_report")
+    if isinstance(report, CompactReport):
+        del document["production_report"]
+        document["compact_report"] = report.encode()
+    return document
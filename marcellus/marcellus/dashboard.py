@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+# Data access for the Streamlit dashboard.
+#
+# Streamlit reruns app.py on every interaction. Results are memoized here and keyed by the crawl generation marker
+# (see `marcellus.generation`), so they are reused until the crawl pipeline reports new data. The cache is bounded in
+# size and entries expire after a TTL as a safety net. The production series of the wells viewed last are kept in an
+# LRU cache of their own, so browsing wells does not push the county and analytics results out.
+import collections
+import json
+import os
+import threading
+import time
+import cachetools
+import pandas as pd
+from marcellus import analytics, compact, export, generation, geometry, timeseries, wells
+
+
+class DashboardData:
+    """
+    Memoized periods, per-period frames, production analytics, well search and county geometry for app.py
+    """
+
+    # Fields the well search can run on, see `marcellus.wells`
+    search_fields = wells.SEARCH_FIELDS
+
+    def __init__(
+        self,
+        db,
+        geojson_path,
+        collection="report.production",
+        rollups="report.rollups",
+        periods="report.periods",
+        meta="report.meta",
+        maxsize=128,
+        ttl=3600,
+        poll=10,
+        geometry_path=None,
+        well_cache=64,
+    ):
+        if db is not None:
+            self.collection = db[collection]
+            self.rollups = db[rollups]
+            self.period_collection = db[periods]
+            self.meta = db[meta]
+        else:
+            # No database behind a snapshot, see SnapshotDashboardData
+            self.collection = self.rollups = self.period_collection = self.meta = None
+        self.geojson_path = geojson_path
+        self.geometry_path = geometry_path
+        self.poll = poll
+        self.cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.recent_wells = cachetools.LRUCache(maxsize=well_cache)
+        self.lock = threading.Lock()
+        self.generation = None
+        self.checked = 0.0
+        self.frame = (None, None)
+
+    def current_generation(self):
+        """
+        The marker is read at most once every `poll` seconds
+        :return:
+        """
+        now = time.monotonic()
+        if self.generation is None or now - self.checked >= self.poll:
+            self.generation = generation.current(self.meta, self.collection.name)
+            self.checked = now
+        return self.generation
+
+    def cached(self, key, compute):
+        with self.lock:
+            try:
+                return self.cache[key]
+            except KeyError:
+                pass
+        value = compute()
+        with self.lock:
+            self.cache[key] = value
+        return value
+
+    def use_rollups(self):
+        return self.cached(
+            ("use_rollups", self.current_generation()), lambda: self.rollups.estimated_document_count() > 0
+        )
+
+    def use_periods(self):
+        return self.cached(
+            ("use_periods", self.current_generation()),
+            lambda: self.period_collection.estimated_document_count() > 0,
+        )
+
+    def use_compact(self):
+        # Compact reports can't be unwound on the server, see `marcellus.compact`
+        return self.cached(
+            ("use_compact", self.current_generation()),
+            lambda: self.collection.find_one({"compact_report": {"$exists": True}}, {"_id": 1}) is not None,
+        )
+
+    def ensure_indexes(self):
+        """
+        Make sure the well search and the well x period layout are indexed before querying them
+        :return:
+        """
+        wells.ensure_indexes(self.collection)
+        if self.use_periods():
+            timeseries.ensure_indexes(self.period_collection)
+
+    def periods(self):
+        """
+        :return: Sorted list of every period in the reports
+        """
+        return self.cached(("periods", self.current_generation()), self.load_periods)
+
+    def load_periods(self):
+        if self.use_rollups():
+            return sorted(self.rollups.distinct("period"))
+        if self.use_periods():
+            return sorted(self.period_collection.distinct("period"))
+        if self.use_compact():
+            periods = set()
+            for document in self.collection.find({}, compact.PERIOD_PROJECTION):
+                periods.update(compact.report_periods(document))
+            return sorted(periods)
+        return sorted(self.collection.distinct("production_report.period"))
+
+    def county_counts(self, period):
+        """
+        :param period:
+        :return: DataFrame with the number of wells (`sum`) per `county` for the period
+        """
+        return self.cached(
+            ("county_counts", self.current_generation(), period), lambda: self.load_county_counts(period)
+        ).copy()
+
+    def load_county_counts(self, period):
+        if self.use_rollups():
+            cursor = self.rollups.find({"period": period}, {"_id": 0, "county": 1, "well_count": 1})
+            records = ({"county": r.get("county"), "sum": r.get("well_count")} for r in cursor)
+        elif self.use_periods():
+            cursor = self.period_collection.aggregate(
+                # One document per operating period; a well counts once
+                [{"$match": {"period": period, "sequence": 0}}, {"$group": {"_id": "$county", "sum": {"$sum": 1}}}]
+            )
+            records = ({"county": r.get("_id"), "sum": r.get("sum")} for r in cursor)
+        elif self.use_compact():
+            counts = collections.Counter(
+                document.get("county")
+                for document in self.collection.find({}, compact.PERIOD_PROJECTION)
+                if period in compact.report_periods(document)
+            )
+            records = ({"county": county, "sum": count} for county, count in counts.items())
+        else:
+            cursor = self.collection.aggregate(
+                [{"$match": {"production_report.period": period}}, {"$group": {"_id": "$county", "sum": {"$sum": 1}}}]
+            )
+            records = ({"county": r.get("_id"), "sum": r.get("sum")} for r in cursor)
+        df = pd.DataFrame.from_dict(records)
+        df["county"] = df["county"].str.upper()
+        return df
+
+    def production_frame(self):
+        """
+        Every stored period as one row, see `marcellus.analytics.load_frame`. Only the frame of the current generation
+        is kept; it is far larger than anything else in the cache.
+        :return: DataFrame, shared by every caller and not to be modified
+        """
+        current = self.current_generation()
+        with self.lock:
+            frame_generation, frame = self.frame
+        if frame_generation != current:
+            frame = self.load_production_frame()
+            with self.lock:
+                self.frame = (current, frame)
+        return frame
+
+    def load_production_frame(self):
+        return analytics.load_frame(self.collection, self.period_collection if self.use_periods() else None)
+
+    def production_trend(self, value="quanitity_of_gas", by="county", window=12):
+        """
+        :return: Monthly totals of `value` per `by` with their rolling mean, see `marcellus.analytics.trend`
+        """
+        return self.cached(
+            ("production_trend", self.current_generation(), value, by, window),
+            lambda: analytics.trend(self.production_frame(), value, by, window),
+        ).copy()
+
+    def top_producers(self, period, n=10, value="quanitity_of_gas"):
+        return self.cached(
+            ("top_producers", self.current_generation(), period, n, value),
+            lambda: analytics.top_producers(self.production_frame(), n, value, period),
+        ).copy()
+
+    def decline_rates(self, window=3):
+        """
+        :return: Fitted decline of every well, steepest first, see `marcellus.analytics.decline_rates`
+        """
+        return self.cached(
+            ("decline_rates", self.current_generation(), window),
+            lambda: analytics.decline_rates(analytics.decline_curves(self.production_frame(), window)),
+        ).copy()
+
+    def decline_curve(self, well, permit_number, window=3):
+        """
+        :param permit_number: "" for a well without one, see `marcellus.analytics.WELL_KEY`
+        """
+        return self.cached(
+            ("decline_curve", self.current_generation(), well, permit_number, window),
+            lambda: analytics.decline_curves(self.production_frame(), window, [well], permit_number),
+        ).copy()
+
+    def count_wells(self, text, field="well_name"):
+        """
+        :param text: Beginning of a well name or permit number, see `marcellus.wells.search_filter`
+        :param field: One of `search_fields`
+        :return: Number of wells found
+        """
+        return self.cached(
+            ("count_wells", self.current_generation(), text, field), lambda: self.load_well_count(text, field)
+        )
+
+    def load_well_count(self, text, field):
+        return wells.count(self.collection, text, field)
+
+    def search_wells(self, text, field="well_name", page=0, page_size=25):
+        """
+        :param page: Page number, from 0
+        :return: DataFrame of the wells of the page with `id` and `marcellus.wells.SUMMARY_FIELDS`
+        """
+        return self.cached(
+            ("search_wells", self.current_generation(), text, field, page, page_size),
+            lambda: self.load_well_page(text, field, page, page_size),
+        ).copy()
+
+    def load_well_page(self, text, field, page, page_size):
+        return wells.search(self.collection, text, field, page, page_size)
+
+    def well_series(self, well_id, county=None):
+        """
+        Production report of one well, loaded when the well is picked
+        :param well_id: `id` of a search result
+        :param county: County of the well; narrows the read of an export
+        :return: DataFrame, see `marcellus.wells.report_frame`
+        """
+        key = (self.current_generation(), well_id)
+        with self.lock:
+            series = self.recent_wells.get(key)
+        if series is None:
+            series = self.load_well_series(well_id, county)
+            with self.lock:
+                self.recent_wells[key] = series
+        return series.copy()
+
+    def load_well_series(self, well_id, county):
+        return wells.series(self.collection, well_id)
+
+    def geometry(self):
+        """
+        County boundaries, read again only when the file changes. With `geometry_path` set, the simplified artifact
+        is read instead and built first if needed, see `marcellus.geometry`.
+        :return: GeoJSON dict
+        """
+        stamps = tuple(
+            os.path.getmtime(path) for path in (self.geojson_path, self.geometry_path) if path and os.path.exists(path)
+        )
+        return self.cached(("geometry",) + stamps, self.load_geometry)
+
+    def load_geometry(self):
+        if self.geometry_path:
+            return geometry.load(self.geojson_path, self.geometry_path)
+        with open(self.geojson_path) as fin:
+            return json.load(fin)
+
+
+class SnapshotDashboardData(DashboardData):
+    """
+    DashboardData read from a Parquet export (see `marcellus.export`) instead of MongoDB.
+    Results are keyed by the export run, so they are reused until the next export lands.
+    """
+
+    # The export carries no permit numbers
+    search_fields = ("well_name",)
+
+    def __init__(self, export_path, geojson_path, maxsize=128, ttl=3600, poll=10, geometry_path=None, well_cache=64):
+        super().__init__(
+            None,
+            geojson_path,
+            maxsize=maxsize,
+            ttl=ttl,
+            poll=poll,
+            geometry_path=geometry_path,
+            well_cache=well_cache,
+        )
+        self.export_path = export_path
+        self.state = None
+
+    def current_generation(self):
+        now = time.monotonic()
+        if self.generation is None or now - self.checked >= self.poll:
+            self.state = export.load_state(self.export_path)
+            self.generation = (self.state.get("runs"), self.state.get("exported"))
+            self.checked = now
+        return self.generation
+
+    def ensure_indexes(self):
+        pass
+
+    def load_periods(self):
+        # Every export run records the periods it has seen
+        return list(self.state["periods"])
+
+    def load_county_counts(self, period):
+        # Only the year partition of the period is read
+        df = export.read_export(self.export_path, ["county", "period"], filters=[("year", "=", int(period[:4]))])
+        df = df[df["period"] == period]
+        df = df.groupby(df["county"].astype(str))["document_id"].nunique().reset_index(name="sum")
+        df["county"] = df["county"].str.upper()
+        return df
+
+    def load_production_frame(self):
+        return analytics.load_export_frame(self.export_path)
+
+    def well_table(self):
+        """
+        :return: DataFrame with `id` and `marcellus.wells.SUMMARY_FIELDS` of every exported well, sorted like the
+            search results
+        """
+        return self.cached(("well_table", self.current_generation()), self.load_well_table)
+
+    def load_well_table(self):
+        exported = export.read_export(self.export_path, ["well_name", "county", "township"])
+        exported = exported.drop_duplicates("document_id", keep="last")
+        table = pd.DataFrame(
+            {
+                "id": exported["document_id"].to_numpy(object),
+                "well_name": exported["well_name"].to_numpy(object),
+                "permit_number": None,
+                "county": exported["county"].astype(str).to_numpy(object),
+                "township": exported["township"].to_numpy(object),
+            }
+        )
+        return table.sort_values(["well_name", "id"]).reset_index(drop=True)
+
+    def well_matches(self, text, field):
+        table = self.well_table()
+        prefix = wells.normalize(text, field)
+        if not prefix:
+            return table
+        return table[table[field].str.startswith(prefix, na=False)]
+
+    def load_well_count(self, text, field):
+        return len(self.well_matches(text, field))
+
+    def load_well_page(self, text, field, page, page_size):
+        return self.well_matches(text, field).iloc[page * page_size : (page + 1) * page_size].reset_index(drop=True)
+
+    def load_well_series(self, well_id, county):
+        # Only the county partition is read; a well exported again keeps the rows of its latest export
+        filters = [("county", "=", county)] if county else None
+        exported = export.read_export(self.export_path, list(wells.REPORT_COLUMNS), filters)
+        exported = exported[exported["document_id"] == well_id]
+        return wells.report_frame(exported[list(wells.REPORT_COLUMNS)].to_dict("records"))
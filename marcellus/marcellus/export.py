@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+# Columnar export of the production reports.
+#
+# `python -m marcellus.export --out export` streams the well collection with a projection, flattens every report into
+# well x period rows and writes Parquet files partitioned by county and year (`county=bradford/year=2019/...`), which
+# pandas and pyarrow read as one dataset. Memory stays bounded: rows are buffered up to --flush-rows and at most
+# --max-open files are open at a time. The last exported well and write time are kept in `_export.json`; the next run
+# only exports wells inserted or updated since, unless --full. An updated well is exported whole again, so a reader
+# keeps, per `document_id`, all the rows of its latest `written` time and none of the older ones: `read_export` does
+# that, `latest_rows` applies it to rows read some other way.
+import argparse
+import collections
+import datetime
+import json
+import os
+import shutil
+import bson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pymongo
+from scrapy.utils.project import get_project_settings
+from marcellus import compact
+
+STATE_FILE = "_export.json"
+
+SCHEMA = pa.schema(
+    [
+        ("document_id", pa.string()),
+        ("written", pa.timestamp("ms", tz="UTC")),
+        ("well_name", pa.string()),
+        ("permit_number", pa.string()),
+        ("township", pa.string()),
+        ("period", pa.string()),
+        ("month", pa.int8()),
+        ("avg_production", pa.float64()),
+        ("est_royalites", pa.float64()),
+        ("operating_days", pa.int32()),
+        ("production_company", pa.string()),
+        ("quanitity_of_gas", pa.float64()),
+        ("value_of_gas", pa.float64()),
+        ("crowd_source_atw", pa.float64()),
+    ]
+)
+
+WELL_COLUMNS = ("document_id", "written", "well_name", "permit_number", "township")
+
+RECORD_COLUMNS = tuple(name for name in SCHEMA.names if name not in WELL_COLUMNS)
+
+PROJECTION = {
+    "county": 1,
+    "township": 1,
+    "well_name": 1,
+    "permit_number": 1,
+    "production_report": 1,
+    "compact_report": 1,
+    "updated": 1,
+}
+
+
+def latest_written(path):
+    """
+    :param path: Export directory
+    :return: Series of the latest `written` time per `document_id`
+    """
+    rows = pd.read_parquet(path, columns=["document_id", "written"])
+    return rows.groupby("document_id", sort=False)["written"].max()
+
+
+def latest_rows(rows, latest=None):
+    """
+    Drop the rows of wells exported again since: keep every row of the latest run of each document, including
+    several operating periods in one month, and drop older runs, including periods the latest run no longer has
+    :param rows: DataFrame read from an export, with `document_id` and `written`
+    :param latest: `latest_written` of the whole export when `rows` are only part of it, e.g. filtered by partition
+    :return: DataFrame
+    """
+    if latest is None:
+        latest = rows.groupby("document_id", sort=False)["written"].max()
+    current = rows["document_id"].map(latest)
+    return rows[(rows["written"] == current) | current.isna()]
+
+
+def read_export(path, columns=None, filters=None):
+    """
+    `pd.read_parquet` of an export with only the current rows, see `latest_rows`
+    :param path: Export directory
+    :param columns: Columns to read; `document_id` and `written` are always read
+    :param filters: Partition filters, e.g. `[("county", "=", "bradford")]`
+    :return: DataFrame
+    """
+    if columns is not None:
+        columns = ["document_id", "written"] + [
+            column for column in columns if column not in ("document_id", "written")
+        ]
+    rows = pd.read_parquet(path, columns=columns, filters=filters)
+    # A filtered read may miss the latest run of a well, e.g. when it moved to another partition
+    return latest_rows(rows, latest_written(path) if filters else None)
+
+
+def load_state(out):
+    path = os.path.join(out, STATE_FILE)
+    if not os.path.exists(path):
+        return {"last_id": None, "last_updated": None, "runs": 0, "wells": 0, "rows": 0, "periods": []}
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def save_state(out, state):
+    # Write then rename; the state only moves once every file of the run is in place
+    path = os.path.join(out, STATE_FILE)
+    with open(f"{path}.tmp", "w") as fout:
+        json.dump(state, fout, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def drop_export(out):
+    """
+    Remove a previous export: the `county=*` partitions and the state. Anything else in `out` is left alone, and then
+    nothing is removed at all.
+    :param out: Export directory
+    :return:
+    """
+    if not os.path.isdir(out):
+        return
+    names = os.listdir(out)
+    own = [name for name in names if name.startswith("county=") or name in (STATE_FILE, f"{STATE_FILE}.tmp")]
+    others = sorted(set(names) - set(own))
+    if others:
+        raise ValueError(f"{out} is not an export directory, it holds {', '.join(others)}")
+    for name in own:
+        path = os.path.join(out, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def partition_key(county, period):
+    """
+    :return: (county, year) partition of a row; unknown values go to `unknown` and year 0
+    """
+    county = (county or "unknown").replace("/", "_")
+    year = int(period[:4]) if period else 0
+    return county, year
+
+
+def written(document):
+    """
+    :return: Last write of a well; wells inserted before delta writes only have their ObjectId time
+    """
+    if document.get("updated") is not None:
+        return document["updated"].replace(tzinfo=datetime.timezone.utc)
+    document_id = document["_id"]
+    return document_id.generation_time if isinstance(document_id, bson.ObjectId) else None
+
+
+def well_rows(document):
+    """
+    Flatten a well document into export rows
+    :param document: Well document in either report layout, see `marcellus.compact`
+    :return: Generator of (partition key, row dict)
+    """
+    well = {
+        "document_id": str(document["_id"]),
+        "written": written(document),
+        "well_name": document.get("well_name"),
+        "permit_number": document.get("permit_number"),
+        "township": document.get("township"),
+    }
+    for record in compact.report_records(document):
+        period = record.get("period")
+        row = dict(well)
+        row.update({column: record.get(column) for column in RECORD_COLUMNS})
+        row["month"] = int(period[5:7]) if period else None
+        yield partition_key(document.get("county"), period), row
+
+
+class PartitionedWriter:
+    """
+    Buffers rows per partition and appends them as row groups to one file per partition and run. Only the `max_open`
+    most recently used files are kept open; an evicted partition continues in a new part file.
+    """
+
+    def __init__(self, out, run, flush_rows=200000, max_open=32):
+        self.out = out
+        self.run = run
+        self.flush_rows = flush_rows
+        self.max_open = max_open
+        self.buffers = collections.defaultdict(lambda: {name: list() for name in SCHEMA.names})
+        self.buffered = 0
+        self.writers = collections.OrderedDict()
+        self.parts = collections.Counter()
+        self.finished = list()
+        self.rows = 0
+
+    def add(self, key, row):
+        columns = self.buffers[key]
+        for name, values in columns.items():
+            values.append(row.get(name))
+        self.buffered += 1
+        if self.buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        for key, columns in self.buffers.items():
+            self.writer(key).write_table(pa.Table.from_pydict(columns, schema=SCHEMA))
+        self.rows += self.buffered
+        self.buffers.clear()
+        self.buffered = 0
+
+    def writer(self, key):
+        open_writer = self.writers.get(key)
+        if open_writer is not None:
+            self.writers.move_to_end(key)
+            return open_writer[0]
+        if len(self.writers) >= self.max_open:
+            self.close_writer(*self.writers.popitem(last=False)[1])
+        county, year = key
+        directory = os.path.join(self.out, f"county={county}", f"year={year}")
+        os.makedirs(directory, exist_ok=True)
+        # Readers skip files starting with `_` until the part is complete
+        name = f"part-{self.run}-{self.parts[key]:04d}.parquet"
+        self.parts[key] += 1
+        while os.path.exists(os.path.join(directory, name)):
+            name = f"part-{self.run}-{self.parts[key]:04d}.parquet"
+            self.parts[key] += 1
+        writer = pq.ParquetWriter(os.path.join(directory, f"_{name}"), SCHEMA)
+        self.writers[key] = (writer, (directory, name))
+        return writer
+
+    def close_writer(self, writer, path):
+        writer.close()
+        self.finished.append(path)
+
+    def close(self):
+        self.flush()
+        while self.writers:
+            self.close_writer(*self.writers.popitem(last=False)[1])
+        for directory, name in self.finished:
+            os.replace(os.path.join(directory, f"_{name}"), os.path.join(directory, name))
+
+
+def export(collection, out, full=False, batch_size=1000, flush_rows=200000, max_open=32):
+    """
+    Export the wells written since the last export
+    :param collection: Well collection
+    :param out: Export directory
+    :param full: Drop the previous export and start over, see `drop_export`
+    :param batch_size: Wells per cursor batch
+    :param flush_rows: Rows buffered before they are written out
+    :param max_open: Files open at a time
+    :return: (export state, wells exported, rows exported)
+    """
+    if full:
+        drop_export(out)
+    os.makedirs(out, exist_ok=True)
+    state = load_state(out)
+    query = dict()
+    if state["last_id"] is not None:
+        query = {"_id": {"$gt": bson.ObjectId(state["last_id"])}}
+    if state.get("last_updated") is not None:
+        since = datetime.datetime.fromisoformat(state["last_updated"])
+        query = {"$or": [query, {"updated": {"$gt": since}}]}
+    cursor = collection.find(query, projection=PROJECTION, batch_size=batch_size).sort("_id", pymongo.ASCENDING)
+
+    run = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    writer = PartitionedWriter(out, run, flush_rows, max_open)
+    periods = set(state["periods"])
+    wells = 0
+    last_id = bson.ObjectId(state["last_id"]) if state["last_id"] is not None else None
+    last_updated = state.get("last_updated")
+    for document in cursor:
+        for key, row in well_rows(document):
+            periods.add(row["period"])
+            writer.add(key, row)
+        wells += 1
+        last_id = document["_id"] if last_id is None else max(last_id, document["_id"])
+        if document.get("updated") is not None:
+            last_updated = max(last_updated or "", document["updated"].isoformat())
+    writer.close()
+
+    if wells:
+        state.update(
+            last_id=str(last_id),
+            last_updated=last_updated,
+            runs=state["runs"] + 1,
+            wells=state["wells"] + wells,
+            rows=state["rows"] + writer.rows,
+            periods=sorted(period for period in periods if period is not None),
+            exported=run,
+        )
+        save_state(out, state)
+    return state, wells, writer.rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the production reports to partitioned Parquet files")
+    parser.add_argument("--out", default="export", help="Export directory")
+    parser.add_argument("--full", action="store_true", help="Drop the previous export and export every well")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Wells per cursor batch")
+    parser.add_argument("--flush-rows", type=int, default=200000, help="Rows buffered before writing")
+    parser.add_argument("--max-open", type=int, default=32, help="Parquet files open at a time")
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    collection = client[settings.get("MONGO_DATABASE", "marcellus")][
+        settings.get("MONGO_COLLECTION", "report.production")
+    ]
+    state, wells, rows = export(collection, args.out, args.full, args.batch_size, args.flush_rows, args.max_open)
+    print(f"{wells} wells, {rows} rows exported to {args.out} ({state['runs']} runs so far)")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+# Structured extraction straight from the lxml element tree.
+#
+# The selectors only locate the element of interest; everything below it is read by walking its text nodes, which
+# avoids serializing the DOM back to a string and parsing it again with regex.
+import logging
+import re
+from itertools import groupby
+from lxml import etree
+from marcellus import cleaning
+
+logger = logging.getLogger(__name__)
+
+TEXT_NODES = etree.XPath(".//text()", smart_strings=False)
+
+# Values of the well report as displayed, e.g. `$1,234.56 (wellhead)` or `87.5 / 100`
+AVERAGE_PRODUCTION = re.compile(r":\s*\$\s*([0-9][0-9,.]*)\s*\(")
+ROYALTIES = re.compile(r"([0-9][0-9,.]*)\s*\(")
+OPERATING_DAYS = re.compile(r"([0-9]+)")
+QUANTITY_OF_GAS = re.compile(r"([0-9][0-9,.]*)")
+VALUE_OF_GAS = re.compile(r"\$\s*([0-9][0-9,.]*)\s*\(")
+CROWD_SOURCE_ATW = re.compile(r"([0-9][0-9,.]*)\s*/")
+
+
+def squash(text):
+    """
+    Collapse runs of whitespace to single spaces and strip the ends
+    :param text:
+    :return:
+    """
+    return " ".join(text.split())
+
+
+def parse_float(pattern):
+    def parse(text):
+        match = pattern.search(text)
+        if match is None:
+            return None
+        return float(match.group(1).replace(",", ""))
+
+    return parse
+
+
+def parse_int(pattern):
+    def parse(text):
+        match = pattern.search(text)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    return parse
+
+
+def parse_period(text):
+    """
+    `Operating Period: Jul 2019 - Dec 2019` -> `2019-12`
+    :param text:
+    :return:
+    """
+    return cleaning.clean_period("".join(text.split(":")[-1].split("-")[-1].split()))
+
+
+def report_label(text):
+    """
+    `Est. Royalties:` -> `est royalties`
+    :param text:
+    :return:
+    """
+    return squash(text.replace(":", " ").replace(".", " ")).lower()
+
+
+# Displayed label -> (cleaned field, parser of the displayed value)
+REPORT_FIELDS = {
+    "avg production per day": ("avg_production", parse_float(AVERAGE_PRODUCTION)),
+    "est royalties": ("est_royalites", parse_float(ROYALTIES)),
+    "operating days": ("operating_days", parse_int(OPERATING_DAYS)),
+    "production company": ("production_company", str),
+    "quantity of gas": ("quanitity_of_gas", parse_float(QUANTITY_OF_GAS)),
+    "value of gas": ("value_of_gas", parse_float(VALUE_OF_GAS)),
+    "crowdsourced atw": ("crowd_source_atw", parse_float(CROWD_SOURCE_ATW)),
+}
+
+# Cleaned fields in the order `marcellus.cleaning.ReportCleaner` produces them
+REPORT_COLUMNS = tuple(field for field, _, _ in cleaning.FIELD_SPEC)
+
+
+def empty_record():
+    record = dict.fromkeys(REPORT_COLUMNS)
+    record["production_company"] = ""
+    return record
+
+
+def extract_well_report(element):
+    """
+    Read the operating periods of a `pro_{well_id}` element into cleaned records.
+    Text nodes are visited in document order. Every node mentioning the operating period opens a new record, the
+    nodes that follow are its alternating labels and values. Values are parsed as displayed, so company names keep
+    their spaces and every operating period of a month is kept.
+    :param element: lxml element of the `pro_{well_id}` div
+    :return: List of cleaned records, see `marcellus.cleaning.ReportCleaner.clean`
+    """
+    records = list()
+    record = None
+    label = None
+    in_period = False
+    for node in TEXT_NODES(element):
+        text = squash(node)
+        if not text:
+            continue
+        if "OperatingPeriod" in text.replace(" ", ""):
+            # Consecutive period nodes belong to the first one, as in the regex parser
+            if not in_period:
+                record = empty_record()
+                record["period"] = parse_period(text)
+                records.append(record)
+                label = None
+            in_period = True
+            continue
+        in_period = False
+        if record is None:
+            continue
+        if label is None:
+            label = text
+            continue
+        field = REPORT_FIELDS.get(report_label(label))
+        if field is not None:
+            record[field[0]] = field[1](text)
+        label = None
+    return records
+
+
+def report_from_tree(selector, well_id):
+    """
+    Walk the `pro_{well_id}` element and read label/value pairs per operating period
+    :param selector: Response or parsel Selector of the well report page
+    :param well_id:
+    :return: List of cleaned records or None when the report is missing
+    """
+    dom = selector.xpath(f"//div[@id='pro_{well_id}']")
+    if len(dom) == 0:
+        return None
+    return extract_well_report(dom[0].root)
+
+
+def report_from_markup(selector, well_id):
+    """
+    Serialize the `pro_{well_id}` element, strip the markup and split the text on the operating periods
+    :param selector: Response or parsel Selector of the well report page
+    :param well_id:
+    :return: {operating period: [label, value, label, value, ...]} or None when the report is missing, cleaned by
+        `marcellus.cleaning.ReportCleaner`
+    """
+    # Get the desired DOM element
+    dom = selector.xpath(f"//div[@id='pro_{well_id}']").extract()
+    if len(dom) == 0:
+        return None
+
+    # Sometimes errors occur
+    try:
+        # Extract the first (and only) element
+        dom = dom[0]
+
+        # Replace all the whitespace characters with null strings
+        no_ws = re.sub(r"\s", "", dom)
+
+        # Remove all the HTMl tags. Replace those tags with newline characters
+        no_tags = re.sub(r"<.*?>", "\n", no_ws)
+    except Exception as e:
+        logger.exception(e)
+        return None
+    # Split into a nice list
+    list_report = re.split(r"\n+", no_tags)
+
+    # This is the itertools.groupby method, not the pandas groupby. It works differently!
+    # The list is split each time the lambda function is True. This allows for unique keys to
+    # be creates where the `OperatingPeriod` is the key
+    unique_keys = list()
+    groups = list()
+    for k, g in groupby(list_report, lambda x: "OperatingPeriod" in x):
+        unique_keys.append(k)
+        groups.append(list(g))
+
+    # Create a dict object out of the iterrated report
+    report_dict = {}
+    for idx, (key, group) in enumerate(zip(unique_keys, groups)):
+        # if key is True means that the element of groups[idx][0] has 'OperatingPeriod' in the string.
+        # The 'OperatingPeriod' becomes the key for the remaining fields of the report
+        if key is True:
+            report_dict[groups[idx][0]] = groups[idx + 1]
+    return report_dict
+
+
+def first_text(element):
+    """
+    First text node directly below the element, like `xpath("text()")[0]`
+    :param element:
+    :return: str or None
+    """
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def child_elements(element, tag):
+    return [child for child in element if child.tag == tag]
+
+
+def parse_index_row(tr, permit_link):
+    """
+    Read one `record_book_row` of a township permit table
+    :param tr: lxml element of the table row
+    :param permit_link: Township link id the table belongs to
+    :return: Row dict as built by `MarcellusSpider.get_table_rows`, or None when cells are missing
+    """
+    cells = child_elements(tr, "td")
+    if len(cells) < 7:
+        return None
+    try:
+        well_name = first_text(child_elements(cells[0], "b")[0])
+        royalty = first_text(child_elements(cells[1], "nobr")[0])
+        market_value = first_text(child_elements(cells[2], "nobr")[0])
+        mcf = first_text(child_elements(cells[3], "nobr")[0])
+        link = child_elements(child_elements(cells[4], "span")[0], "a")[0].get("href")
+        date_start = first_text(child_elements(cells[5], "span")[0])
+        permit_number = first_text(child_elements(cells[6], "span")[0])
+    except IndexError:
+        return None
+    values = (well_name, royalty, market_value, mcf, link, date_start, permit_number)
+    if any(value is None for value in values):
+        return None
+    return {
+        "well_name": well_name.strip(),
+        "royalty": royalty.strip(),
+        "market_value": market_value.strip(),
+        "mcf": mcf.strip(),
+        "link": link.strip(),
+        "date_start": date_start.strip(),
+        "permit_number": permit_number.strip(),
+        "permit_link": permit_link,
+    }
+
+
+def iter_table_rows(table, permit_link):
+    for tr in table:
+        if tr.tag != "tr" or not tr.get("class", "").startswith("record_book_row"):
+            continue
+        row = parse_index_row(tr, permit_link)
+        if row is not None:
+            yield row
+
+
+def iter_permit_rows(permits, permit_link):
+    for table in child_elements(permits, "table"):
+        for tbody in child_elements(table, "tbody"):
+            yield from iter_table_rows(tbody, permit_link)
+
+
+def iter_townships(root):
+    """
+    Walk the production report once and yield every township listed under a county.
+    The document is traversed a single time to index the county anchors and the `munis_*`/`permits_*` divs by id.
+    :param root: lxml root of the production report page
+    :return: Generator of (county, township, permit_link, permits element or None)
+    """
+    county_links = list()
+    divs = dict()
+    for element in root.iter("a", "div"):
+        element_id = element.get("id")
+        if element_id is None:
+            continue
+        if element.tag == "a":
+            if element_id.startswith("munilink"):
+                county_links.append(element)
+        elif element_id.startswith("munis_") or element_id.startswith("permits_"):
+            divs.setdefault(element_id, element)
+
+    for county_link in county_links:
+        county = (county_link.text or "").replace("+", "").replace(" ", "")
+        county_div = divs.get("munis_{0}".format(county_link.get("id").split("_")[-1]))
+        if county_div is None:
+            continue
+        for township_link in child_elements(county_div, "a"):
+            township = (township_link.text or "").replace("+ ", "")
+            permit_link = township_link.get("id", "").split("_")[-1]
+            yield county, township, permit_link, divs.get("permits_{0}".format(permit_link))
+
+
+def iter_production_report(root):
+    """
+    Walk the rendered production report once and yield the well rows of every county and township.
+    Each township table is read directly from its element.
+    :param root: lxml root of the rendered production report page
+    :return: Generator of row dicts including `county` and `township`
+    """
+    for county, township, permit_link, permits in iter_townships(root):
+        if permits is None:
+            continue
+        for row in iter_permit_rows(permits, permit_link):
+            row["county"] = county
+            row["township"] = township
+            yield row
+
+
+def iter_fragment_rows(root, permit_link):
+    """
+    Rows of a permit table fetched on its own, the way the page's JavaScript loads it.
+    The fragment may or may not carry the `permits_{link}` div, and the parser may not have added a tbody.
+    :param root: lxml root of the fragment
+    :param permit_link: Township link id
+    :return: Generator of row dicts
+    """
+    permits = next((div for div in root.iter("div") if div.get("id") == f"permits_{permit_link}"), root)
+    for table in permits.iter("table"):
+        yield from iter_table_rows(table, permit_link)
+        for tbody in child_elements(table, "tbody"):
+            yield from iter_table_rows(tbody, permit_link)
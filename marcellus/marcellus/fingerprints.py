@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Summary fingerprints for incremental crawls.
+#
+# Every row of the production report index already carries the well's royalty, market value, mcf and permit
+# number. Hashing those values gives a cheap signature that changes whenever the well report has new data, so an
+# incremental crawl only needs to download the wells whose signature differs from the stored one.
+import hashlib
+
+FINGERPRINT_FIELDS = ("royalty", "market_value", "mcf", "permit_number")
+
+
+def normalize_well_name(well_name):
+    """
+    Well names are stored lower case with underscores, see MarcellusPipeline.process_production_report
+    :param well_name:
+    :return:
+    """
+    return well_name.lower().replace(" ", "_")
+
+
+def row_fingerprint(row):
+    """
+    Fingerprint of the summary values for a single row of the production report index
+    :param row: Row dict built by MarcellusSpider.get_table_rows
+    :return: Hex digest
+    """
+    summary = "\x1f".join(row.get(field, "") for field in FINGERPRINT_FIELDS)
+    return hashlib.sha1(summary.encode("utf-8")).hexdigest()
+
+
+def load_fingerprint_index(collection):
+    """
+    Load {(well_name, permit_number): fingerprint} for every stored well with a single query. Wells are stored by
+    name and permit number, see `marcellus.upserts`, as several wells can share a name.
+    :param collection: MongoDB collection holding the production reports
+    :return: dict
+    """
+    cursor = collection.find({}, projection={"_id": 0, "well_name": 1, "permit_number": 1, "fingerprint": 1})
+    return {
+        (doc["well_name"], doc.get("permit_number")): doc.get("fingerprint") for doc in cursor if "well_name" in doc
+    }
+
+
+def index_key(index, well_name, permit_number):
+    """
+    Key of a well in the fingerprint index. A well stored before permit numbers were kept is found under its name
+    alone, just as `marcellus.upserts.adopted_match` writes to it.
+    :param index: Fingerprint index, see `load_fingerprint_index`
+    :param well_name: Normalized well name
+    :param permit_number: Permit number of the index row, empty when not shown
+    :return: (well_name, permit_number)
+    """
+    key = (well_name, permit_number or None)
+    if key in index or key[1] is None:
+        return key
+    return well_name, None
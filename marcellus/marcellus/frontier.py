@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# The well report frontier: request priorities and a scheduler queue with bounded memory.
+#
+# WELL_PRIORITY_POLICY orders the well requests: "counties" crawls the counties of WELL_PRIORITY_COUNTIES first and in
+# that order, "newest_permits" the wells with the latest start date first. Priorities are coarse (one per county or
+# per month) because the scheduler keeps one queue per priority.
+#
+# `SpillingFifoQueue` is a scheduler memory queue (SCHEDULER_MEMORY_QUEUE) that holds up to FRONTIER_MEMORY_LIMIT
+# requests in memory across all priorities and spills the rest to disk queues under FRONTIER_SPILL_DIR. A queue that
+# has spilled keeps appending to disk until its disk part is drained, so every priority stays first in, first out.
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+from collections import deque
+from scrapy.squeues import PickleFifoDiskQueue
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y")
+
+
+def start_month(date_start):
+    """
+    :param date_start: Start date of a well as shown in the index
+    :return: Months since year 0, or 0 when the date is missing or unreadable
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime((date_start or "").strip(), date_format)
+        except ValueError:
+            continue
+        return date.year * 12 + date.month - 1
+    return 0
+
+
+def well_priority(policy, counties=()):
+    """
+    :param policy: None, "counties" or "newest_permits"
+    :param counties: County names for the "counties" policy, first crawled first
+    :return: Function of an index row returning its request priority; higher goes first
+    """
+    if not policy:
+        return lambda row: 0
+    if policy == "counties":
+        ranks = {county.lower(): len(counties) - rank for rank, county in enumerate(counties)}
+        return lambda row: ranks.get((row.get("county") or "").lower(), 0)
+    if policy == "newest_permits":
+        return lambda row: start_month(row.get("date_start"))
+    raise ValueError(f"Unknown well priority policy {policy!r}")
+
+
+class SpillBudget:
+    """
+    Requests held in memory by the spilling queues of one crawler, and the directory they spill to
+    """
+
+    def __init__(self, limit, directory=None):
+        self.limit = limit
+        self.in_memory = 0
+        self.spilled = 0
+        self.queues = 0
+        self.directory = directory
+        self.temporary = directory is None
+
+    def path(self, key):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="marcellus-frontier-")
+        return os.path.join(self.directory, key.strip("/").replace("/", "_") or "queue")
+
+    def release(self):
+        self.queues -= 1
+        if self.queues == 0 and self.temporary and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+_budgets = weakref.WeakKeyDictionary()
+
+
+class SpillingFifoQueue:
+    """
+    FIFO of requests in memory up to the crawler's FRONTIER_MEMORY_LIMIT, on disk past it
+    """
+
+    def __init__(self, crawler, key, budget):
+        self.crawler = crawler
+        self.key = key
+        self.budget = budget
+        self.memory = deque()
+        self.disk = None
+        budget.queues += 1
+
+    @classmethod
+    def from_crawler(cls, crawler, key, *args, **kwargs):
+        budget = _budgets.get(crawler)
+        if budget is None:
+            settings = crawler.settings
+            budget = _budgets[crawler] = SpillBudget(
+                settings.getint("FRONTIER_MEMORY_LIMIT", 20000), settings.get("FRONTIER_SPILL_DIR")
+            )
+        return cls(crawler, key, budget)
+
+    def push(self, request):
+        budget = self.budget
+        if self.disk is None and (not budget.limit or budget.in_memory < budget.limit):
+            self.memory.append(request)
+            budget.in_memory += 1
+            return
+        if self.disk is None:
+            self.disk = PickleFifoDiskQueue.from_crawler(self.crawler, budget.path(f"{self.key}-{id(self)}"))
+        try:
+            self.disk.push(request)
+        except ValueError as error:
+            # Requests that cannot be serialized stay in memory, like in Scrapy's scheduler
+            logger.debug("Request kept in memory: %s", error)
+            self.memory.append(request)
+            budget.in_memory += 1
+            return
+        budget.spilled += 1
+        self.crawler.stats.inc_value("frontier/spilled")
+
+    def pop(self):
+        if self.memory:
+            self.budget.in_memory -= 1
+            return self.memory.popleft()
+        if self.disk is None:
+            return None
+        request = self.disk.pop()
+        if request is not None:
+            self.budget.spilled -= 1
+        if not len(self.disk):
+            # Drained; new requests go to memory again
+            self.close_disk()
+        return request
+
+    def peek(self):
+        if self.memory:
+            return self.memory[0]
+        return self.disk.peek() if self.disk is not None else None
+
+    def close_disk(self):
+        path = self.disk.path
+        self.disk.close()
+        self.disk = None
+        shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        self.budget.in_memory -= len(self.memory)
+        self.memory.clear()
+        if self.disk is not None:
+            # The frontier does not outlive the crawl; checkpoints do that, see `marcellus.checkpoint`
+            self.budget.spilled -= len(self.disk)
+            self.close_disk()
+        self.budget.release()
+
+    def __len__(self):
+        return len(self.memory) + (len(self.disk) if self.disk is not None else 0)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Crawl generation marker.
+#
+# Writers bump a counter in the meta collection whenever they have changed a collection. Readers key their caches by
+# the counter, so cached results stay valid exactly until the data underneath changes.
+import datetime
+
+
+def bump(meta, name):
+    """
+    Record that `name` changed
+    :param meta: Meta collection
+    :param name: Name of the changed collection
+    :return:
+    """
+    meta.update_one(
+        {"_id": name}, {"$inc": {"generation": 1}, "$set": {"updated": datetime.datetime.utcnow()}}, upsert=True
+    )
+
+
+def current(meta, name):
+    """
+    :param meta: Meta collection
+    :param name: Collection name
+    :return: Current generation of `name`, 0 if it was never bumped
+    """
+    document = meta.find_one({"_id": name}, projection={"generation": 1})
+    return 0 if document is None else document.get("generation", 0)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Simplified county geometry for the dashboard.
+#
+# The county boundary file is far more detailed than a state-wide choropleth can show, and plotly ships all of it to
+# the browser on every rerun. `build` keeps only the `county_nam` key of every county, simplifies the boundaries with
+# Douglas-Peucker at `tolerance` degrees and rounds the coordinates to `precision` decimals. Borders two counties share
+# are simplified once, between the points where the neighbours change, so both counties keep exactly the same border
+# and no slivers open up between them. `load` returns the artifact and rebuilds it when the source changed:
+#
+#     python -m marcellus.geometry --source "Pennsylvania County Boundaries.geojson" --out counties.geojson
+import argparse
+import collections
+import json
+import os
+import numpy as np
+
+KEY = "county_nam"
+
+
+def douglas_peucker(points, tolerance):
+    """
+    :param points: (n, 2) array; the first and last point are kept
+    :param tolerance: Largest distance of a dropped point from the simplified line
+    :return: Boolean mask of the points kept
+    """
+    keep = np.zeros(len(points), bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1 : last]
+        chord = end - start
+        length = np.hypot(chord[0], chord[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            distances = np.abs(chord[0] * (inner[:, 1] - start[1]) - chord[1] * (inner[:, 0] - start[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def simplify_run(run, tolerance):
+    """
+    Simplify a run of points between two fixed points. The run is simplified in a canonical direction so the neighbour
+    walking the same border the other way keeps the same points.
+    :param run: List of (x, y)
+    :return: List of (x, y) kept
+    """
+    reverse = run[-1] < run[0]
+    if reverse:
+        run = run[::-1]
+    keep = douglas_peucker(np.array(run, float), tolerance)
+    kept = [point for point, kept in zip(run, keep) if kept]
+    return kept[::-1] if reverse else kept
+
+
+def iter_rings(geometry):
+    if geometry["type"] == "Polygon":
+        yield from geometry["coordinates"]
+    elif geometry["type"] == "MultiPolygon":
+        for polygon in geometry["coordinates"]:
+            yield from polygon
+
+
+def simplify_ring(ring, owners, tolerance):
+    """
+    :param ring: Closed ring of (x, y)
+    :param owners: {(x, y): frozenset of the features having the point}
+    :return: Closed ring of (x, y)
+    """
+    points = ring[:-1] if ring[0] == ring[-1] else ring
+    size = len(points)
+    if size < 4:
+        return ring
+    # Points where the set of neighbours changes, where shared borders begin and end
+    fixed = [
+        i
+        for i in range(size)
+        if owners[points[i]] != owners[points[i - 1]] or owners[points[i]] != owners[points[(i + 1) % size]]
+    ]
+    if len(fixed) < 2:
+        # A border nobody shares; anchor it at the start and the point farthest from it
+        start = np.array(points[0], float)
+        farthest = int(np.argmax(np.hypot(*(np.array(points, float) - start).T)))
+        fixed = sorted({0, farthest})
+    simplified = list()
+    for first, last in zip(fixed, fixed[1:] + [fixed[0] + size]):
+        run = [points[i % size] for i in range(first, last + 1)]
+        simplified.extend(simplify_run(run, tolerance)[:-1])
+    if len(simplified) < 3:
+        return ring
+    return simplified + [simplified[0]]
+
+
+def round_ring(ring, precision):
+    rounded = list()
+    for x, y in ring:
+        point = [round(x, precision), round(y, precision)]
+        if not rounded or rounded[-1] != point:
+            rounded.append(point)
+    return rounded
+
+
+def build(source, tolerance=0.002, precision=4):
+    """
+    :param source: County boundaries GeoJSON dict
+    :param tolerance: Simplification tolerance in degrees; 0.002 is about 200 m
+    :param precision: Decimals kept of every coordinate; 4 is about 10 m
+    :return: Simplified GeoJSON dict
+    """
+    features = [
+        feature
+        for feature in source.get("features", ())
+        if (feature.get("properties") or {}).get(KEY) and feature.get("geometry") is not None
+    ]
+    owners = collections.defaultdict(set)
+    for index, feature in enumerate(features):
+        for ring in iter_rings(feature["geometry"]):
+            for x, y, *_ in ring:
+                owners[(x, y)].add(index)
+    owners = {point: frozenset(indexes) for point, indexes in owners.items()}
+
+    simplified = list()
+    for feature in features:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        coordinates = list()
+        for polygon in polygons:
+            coordinates.append(
+                [
+                    round_ring(simplify_ring([(x, y) for x, y, *_ in ring], owners, tolerance), precision)
+                    for ring in polygon
+                ]
+            )
+        simplified.append(
+            {
+                "type": "Feature",
+                "properties": {KEY: feature["properties"][KEY]},
+                "geometry": (
+                    {"type": "MultiPolygon", "coordinates": coordinates}
+                    if len(coordinates) > 1
+                    else {"type": "Polygon", "coordinates": coordinates[0]}
+                ),
+            }
+        )
+    return {"type": "FeatureCollection", "features": simplified}
+
+
+def source_stamp(source_path):
+    stat = os.stat(source_path)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def write(source_path, artifact_path, tolerance=0.002, precision=4):
+    """
+    Build the artifact from the source file
+    :return: The simplified GeoJSON dict
+    """
+    with open(source_path) as fin:
+        source = json.load(fin)
+    artifact = build(source, tolerance, precision)
+    artifact["build"] = dict(source_stamp(source_path), tolerance=tolerance, precision=precision)
+    with open(f"{artifact_path}.tmp", "w") as fout:
+        json.dump(artifact, fout, separators=(",", ":"))
+    os.replace(f"{artifact_path}.tmp", artifact_path)
+    return artifact
+
+
+def load(source_path, artifact_path, tolerance=0.002, precision=4):
+    """
+    The artifact, rebuilt first if the source changed since it was written. An artifact built from the current source
+    is used whatever its tolerance and precision, so one built with `main` stays. Without the source the artifact is
+    used as it is.
+    :param tolerance: Used when the artifact is (re)built
+    :param precision: Used when the artifact is (re)built
+    :return: Simplified GeoJSON dict
+    """
+    if os.path.exists(artifact_path):
+        with open(artifact_path) as fin:
+            artifact = json.load(fin)
+        if not os.path.exists(source_path):
+            return artifact
+        stamp = artifact.get("build") or dict()
+        if all(stamp.get(key) == value for key, value in source_stamp(source_path).items()):
+            return artifact
+    return write(source_path, artifact_path, tolerance, precision)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simplify the county boundaries for the dashboard")
+    parser.add_argument("--source", default="Pennsylvania County Boundaries.geojson")
+    parser.add_argument("--out", default="counties.geojson")
+    parser.add_argument("--tolerance", type=float, default=0.002, help="Simplification tolerance in degrees")
+    parser.add_argument("--precision", type=int, default=4, help="Decimals kept of every coordinate")
+    args = parser.parse_args(argv)
+
+    artifact = write(args.source, args.out, args.tolerance, args.precision)
+    vertices = sum(len(ring) for feature in artifact["features"] for ring in iter_rings(feature["geometry"]))
+    print(
+        f"{len(artifact['features'])} counties, {vertices} vertices, "
+        f"{os.path.getsize(args.source) / 1024:.0f} KB -> {os.path.getsize(args.out) / 1024:.0f} KB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Per-stage crawl metrics.
+#
+# With INSTRUMENTATION_ENABLED the spider carries a `Metrics` registry. The Marcellus middlewares and pipelines record
+# stage latencies into it, `MarcellusSpiderMiddleware` samples queue depth, item rate and memory, writes the registry
+# as a Prometheus text file every INSTRUMENTATION_INTERVAL seconds and a JSON summary when the spider closes.
+import bisect
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from cleaning a field to rendering the production report in Splash
+BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """
+    Cumulative-bucket latency histogram in the Prometheus layout
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        :param q: Quantile between 0 and 1
+        :return: Upper bound of the bucket holding the quantile; the largest sample past the last bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 6),
+        }
+
+
+def rss_bytes():
+    """
+    :return: (current, peak) resident set size in bytes; current falls back to peak without /proc
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    peak = peak if sys.platform == "darwin" else peak * 1024
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        current = peak
+    return current, peak
+
+
+class Metrics:
+    """
+    Stage latency histograms and gauges for one crawl
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.gauges = dict()
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def prometheus(self):
+        """
+        :return: The registry in the Prometheus text exposition format
+        """
+        lines = [
+            "# HELP marcellus_stage_seconds Latency of each crawl stage",
+            "# TYPE marcellus_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'marcellus_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'marcellus_stage_seconds_sum{{stage="{stage}"}} {histogram.sum!r}')
+            lines.append(f'marcellus_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE marcellus_{name} gauge")
+            lines.append(f"marcellus_{name} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        return {
+            "started": self.started,
+            "elapsed": round(time.time() - self.started, 3),
+            "stages": {stage: histogram.summary() for stage, histogram in sorted(self.stages.items())},
+            "gauges": dict(sorted(self.gauges.items())),
+        }
+
+    def write_prometheus(self, path):
+        # Write then rename so the node exporter textfile collector never reads half a file
+        write_atomic(path, self.prometheus())
+
+    def write_summary(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2) + "\n")
+
+
+def write_atomic(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as out:
+        out.write(text)
+    os.replace(tmp, path)
@@ -5,99 +5,322 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import inspect
+import os
+import re
+import time
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse, TextResponse
+from twisted.internet import task
+from marcellus.archive import ResponseArchive
+from marcellus.instrumentation import rss_bytes
 
 
 class MarcellusSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+    """
+    Instrumentation surface of the crawl, enabled by INSTRUMENTATION_ENABLED.
+    Generator callbacks are timed as `parse_<callback>` stages, counting only the work between the items and requests
+    they yield; the well report callbacks time `parse_by_well_id` or the process pool round trip themselves. Every
+    INSTRUMENTATION_INTERVAL seconds the scheduler, downloader, scraper and process pool queue depths, the item rate and
+    memory are sampled and `spider.metrics` is written to INSTRUMENTATION_PROMETHEUS_PATH. A JSON summary goes to
+    INSTRUMENTATION_SUMMARY_PATH when the spider closes.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("INSTRUMENTATION_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.interval = settings.getfloat("INSTRUMENTATION_INTERVAL", 15)
+        self.prometheus_path = settings.get("INSTRUMENTATION_PROMETHEUS_PATH")
+        self.summary_path = settings.get("INSTRUMENTATION_SUMMARY_PATH")
+        self.loop = None
+        self.last_sample = (time.monotonic(), 0)
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    def process_spider_output(self, response, result, spider):
+        callback = (response.request.callback if response.request is not None else None) or spider.parse
+        if spider.metrics is None or not inspect.isgeneratorfunction(callback):
+            yield from result
+            return
+        elapsed = 0.0
+        results = iter(result)
+        while True:
+            started = time.perf_counter()
+            try:
+                i = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            yield i
+        spider.metrics.observe(f"parse_{callback.__name__}", elapsed)
 
-        # Should return None or raise an exception.
-        return None
+    def spider_opened(self, spider):
+        if spider.metrics is None:
+            return
+        self.loop = task.LoopingCall(self.export, spider)
+        self.loop.start(self.interval, now=False)
 
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+    def spider_closed(self, spider, reason):
+        if spider.metrics is None:
+            return
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.export(spider)
+        items = self.crawler.stats.get_value("item_scraped_count", 0)
+        elapsed = time.time() - spider.metrics.started
+        spider.metrics.set_gauge("crawl_items_per_second", items / elapsed if elapsed else 0.0)
+        if self.summary_path:
+            spider.metrics.write_summary(self.summary_path)
+            spider.logger.info("Wrote instrumentation summary to %s" % self.summary_path)
 
-        # Must return an iterable of Request, dict or Item objects.
-        for i in result:
-            yield i
+    def sample(self, spider):
+        metrics = spider.metrics
+        engine = self.crawler.engine
+        slot = getattr(engine, "slot", None)
+        if slot is not None:
+            metrics.set_gauge("queue_scheduler", len(slot.scheduler))
+            metrics.set_gauge("queue_in_progress", len(slot.inprogress))
+        metrics.set_gauge("queue_downloader", len(engine.downloader.active))
+        if engine.scraper.slot is not None:
+            metrics.set_gauge("queue_scraper", len(engine.scraper.slot.active))
+        pool = getattr(spider, "pool", None)
+        if pool is not None:
+            metrics.set_gauge("queue_pool_in_flight", pool.in_flight)
+            metrics.set_gauge("queue_pool_waiting", pool.waiting)
+        now, items = time.monotonic(), self.crawler.stats.get_value("item_scraped_count", 0)
+        last_time, last_items = self.last_sample
+        metrics.set_gauge("items_scraped", items)
+        metrics.set_gauge("items_per_second", (items - last_items) / (now - last_time) if now > last_time else 0.0)
+        self.last_sample = (now, items)
+        current, peak = rss_bytes()
+        metrics.set_gauge("rss_bytes", current)
+        metrics.set_gauge("peak_rss_bytes", peak)
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+    def export(self, spider):
+        self.sample(spider)
+        if self.prometheus_path:
+            spider.metrics.write_prometheus(self.prometheus_path)
 
-        # Should return either None or an iterable of Request, dict
-        # or Item objects.
-        pass
 
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
+class MarcellusDownloaderMiddleware:
+    """
+    Time every download, enabled by INSTRUMENTATION_ENABLED. The stages `splash_render`, `well_download`,
+    `permit_table_download` and `page_download` (everything else) take the download latency Scrapy measures, so
+    throttle delays are not counted; the time a request waited in its download slot is the `download_slot_wait` stage.
+    """
 
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
+    def __init__(self, crawler):
+        if not crawler.settings.getbool("INSTRUMENTATION_ENABLED"):
+            raise NotConfigured
 
-    def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(s.response_downloaded, signal=signals.response_downloaded)
+        return s
 
+    def request_reached_downloader(self, request, spider):
+        request.meta["download_started"] = time.perf_counter()
+
+    def response_downloaded(self, response, request, spider):
+        started = request.meta.pop("download_started", None)
+        latency = request.meta.get("download_latency")
+        if started is None or latency is None or spider.metrics is None:
+            return
+        spider.metrics.observe(self.stage(request), latency)
+        spider.metrics.observe("download_slot_wait", max(0.0, time.perf_counter() - started - latency))
+
+    def stage(self, request):
+        if "splash" in request.meta:
+            return "splash_render"
+        if "row" in request.meta:
+            return "well_download"
+        if "permit_link" in request.meta:
+            return "permit_table_download"
+        return "page_download"
 
-class MarcellusDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+
+class ResponseArchiveMiddleware:
+    """
+    Record the production report (rendered, or as served with its permit table fragments) and every well report to a
+    local archive, or replay them from it.
+    ARCHIVE_MODE = "record" keeps crawling as usual and appends the responses.
+    ARCHIVE_MODE = "replay" answers every request from the archive; nothing goes to the network or Splash.
+    """
+
+    def __init__(self, archive, mode, stats):
+        self.archive = archive
+        self.mode = mode
+        self.stats = stats
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        mode = crawler.settings.get("ARCHIVE_MODE")
+        if not mode:
+            raise NotConfigured
+        if mode not in ("record", "replay"):
+            raise NotConfigured("Unknown ARCHIVE_MODE: %s" % mode)
+        archive = ResponseArchive(crawler.settings.get("ARCHIVE_DIR", "archive"))
+        s = cls(archive, mode, crawler.stats)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
+    def spider_opened(self, spider):
+        if self.mode == "record":
+            self.archive.open_writer()
+        else:
+            self.archive.open_reader()
+        spider.logger.info("Response archive %s: %s" % (self.mode, os.path.abspath(self.archive.path)))
 
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
+    def spider_closed(self, spider):
+        self.archive.close()
+
+    def process_request(self, request, spider):
+        if self.mode != "replay":
+            return None
+        record = self.archive.get(request.url)
+        if record is None:
+            self.stats.inc_value("archive/replay_missing", spider=spider)
+            raise IgnoreRequest("Not in archive: %s" % request.url)
+        self.stats.inc_value("archive/replayed", spider=spider)
+        return HtmlResponse(
+            url=record["url"], status=record["status"], body=record["body"], encoding="utf-8", request=request
+        )
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        if self.mode != "record" or not isinstance(response, TextResponse):
+            return response
+        if "splash" in request.meta:
+            kind, well_id = "index", None
+        elif "row" in request.meta:
+            match = re.match(r".*well_id=([0-9]+)", response.url)
+            kind, well_id = "well", match.group(1) if match else None
+        elif "permit_link" in request.meta:
+            kind, well_id = "fragment", None
+        elif request.meta.get("production_report_page") and response.status == 200:
+            # The page after login; replayed in fragments mode to request the permit tables again
+            kind, well_id = "page", None
+        else:
+            return response
+        self.archive.append(kind, response.url, response.text, well_id=well_id, status=response.status)
+        self.stats.inc_value("archive/recorded/%s" % kind, spider=spider)
+        return response
+
+
+class AdaptiveThrottleMiddleware:
+    """
+    Pace well report and permit table requests by how the server responds instead of a fixed DOWNLOAD_DELAY.
+    Latency and errors are tracked per download slot as moving averages. While responses stay under
+    ADAPTIVE_THROTTLE_TARGET_LATENCY the slot concurrency grows additively and the delay shrinks; slow responses,
+    errors and login pages (the session was lost) halve the concurrency and double the delay. Concurrency never
+    exceeds ADAPTIVE_THROTTLE_MAX_CONCURRENCY and the delay never drops below ADAPTIVE_THROTTLE_MIN_DELAY.
+    """
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+    # Weight of the newest sample in the moving averages
+    smoothing = 0.2
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.target_latency = settings.getfloat("ADAPTIVE_THROTTLE_TARGET_LATENCY", 1.0)
+        self.max_concurrency = settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 2)
+        self.min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 1.0)
+        self.max_delay = settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 30.0)
+        self.max_error_rate = settings.getfloat("ADAPTIVE_THROTTLE_MAX_ERROR_RATE", 0.05)
+        self.states = dict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def tracked(self, request):
+        return "row" in request.meta or "permit_link" in request.meta
+
+    def process_response(self, request, response, spider):
+        if not self.tracked(request):
+            return response
+        if "login.php" in response.url or response.status in (401, 403):
+            self.back_off(request, spider, "session")
+        elif response.status == 429 or response.status >= 500:
+            self.record(request, spider, error=True)
+        else:
+            self.record(request, spider, latency=request.meta.get("download_latency"))
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        if self.tracked(request):
+            self.record(request, spider, error=True)
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def get_slot(self, request):
+        key = request.meta.get("download_slot")
+        return key, self.crawler.engine.downloader.slots.get(key)
 
-    def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+    def get_state(self, key, slot):
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = {
+                "latency": None,
+                "errors": 0.0,
+                "concurrency": float(min(slot.concurrency, self.max_concurrency)),
+                "delay": max(slot.delay, self.min_delay),
+                "backed_off": 0.0,
+            }
+        return state
+
+    def record(self, request, spider, latency=None, error=False):
+        key, slot = self.get_slot(request)
+        if slot is None:
+            return
+        state = self.get_state(key, slot)
+        state["errors"] += self.smoothing * (float(error) - state["errors"])
+        if latency is not None:
+            if state["latency"] is None:
+                state["latency"] = latency
+            state["latency"] += self.smoothing * (latency - state["latency"])
+
+        if error or state["errors"] > self.max_error_rate:
+            self.back_off(request, spider, "error")
+        elif state["latency"] is not None and state["latency"] > self.target_latency:
+            self.back_off(request, spider, "latency")
+        elif state["latency"] is not None:
+            # Additive increase: roughly one more request in flight per round of responses
+            state["concurrency"] = min(self.max_concurrency, state["concurrency"] + 1.0 / state["concurrency"])
+            state["delay"] = max(self.min_delay, state["delay"] * 0.9)
+            self.apply(slot, state)
+
+    def back_off(self, request, spider, reason):
+        key, slot = self.get_slot(request)
+        if slot is None:
+            return
+        state = self.get_state(key, slot)
+        # Responses to requests sent before the last back off carry no news; wait one latency period
+        now = time.monotonic()
+        if now - state["backed_off"] < (state["latency"] or self.target_latency):
+            return
+        state["backed_off"] = now
+        state["concurrency"] = max(1.0, state["concurrency"] / 2)
+        state["delay"] = min(self.max_delay, max(self.min_delay, state["delay"]) * 2)
+        self.apply(slot, state)
+        self.crawler.stats.inc_value("adaptive_throttle/backoff/%s" % reason, spider=spider)
+        spider.logger.debug(
+            "Adaptive throttle backed off (%s): slot=%s concurrency=%d delay=%.2f"
+            % (reason, key, slot.concurrency, slot.delay)
+        )
+
+    def apply(self, slot, state):
+        slot.concurrency = int(state["concurrency"])
+        slot.delay = state["delay"]
+        self.crawler.stats.max_value("adaptive_throttle/max_concurrency", slot.concurrency)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Well report parsing in a process pool.
+#
+# Extracting and cleaning a well report is pure CPU work and holds the reactor thread for milliseconds per well. With
+# WELL_REPORT_PROCESSES set, the spider ships the page of every well to a pool of worker processes instead; the worker
+# locates `pro_{well_id}`, extracts the report with the configured parser and cleans it, and the cleaned records come
+# back through a Deferred. MarcellusPipeline leaves an already cleaned report alone. At most WELL_REPORT_MAX_IN_FLIGHT
+# pages are queued for the pool; callbacks past that wait for a slot, which holds their responses in the scraper and
+# in turn throttles the downloader.
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from parsel import Selector
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from marcellus import cleaning, extractors
+
+# One cleaner per worker process
+CLEANER = cleaning.ReportCleaner()
+
+
+def parse_well_report(text, well_id, parser="regex"):
+    """
+    Runs in a worker process
+    :param text: Decoded body of the well report page
+    :param well_id:
+    :param parser: "regex" or "lxml", see WELL_REPORT_PARSER
+    :return: Cleaned records, see `marcellus.cleaning.ReportCleaner.clean`, or None when the report is missing
+    """
+    selector = Selector(text=text)
+    if parser == "lxml":
+        return extractors.report_from_tree(selector, well_id)
+    report = extractors.report_from_markup(selector, well_id)
+    if report is None:
+        return None
+    return CLEANER.clean(report)
+
+
+def mp_context():
+    # Forking the crawler process would copy the reactor and the locks of its threads into every worker; a fork
+    # server starts workers from a clean process instead
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class WellReportPool:
+    """
+    Process pool returning Deferreds, with a bound on the work submitted and not finished yet
+    """
+
+    def __init__(self, processes, max_in_flight=None):
+        self.processes = processes
+        self.max_in_flight = max_in_flight or 2 * processes
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=mp_context())
+        self.semaphore = defer.DeferredSemaphore(self.max_in_flight)
+
+    @property
+    def in_flight(self):
+        return self.max_in_flight - self.semaphore.tokens
+
+    @property
+    def waiting(self):
+        return len(self.semaphore.waiting)
+
+    def submit(self, fn, *args):
+        """
+        :param fn: Module level function, it is pickled by name
+        :param args: Picklable arguments
+        :return: Deferred firing with the result of `fn(*args)` in the reactor thread
+        """
+        return self.semaphore.run(self._submit, fn, *args)
+
+    def _submit(self, fn, *args):
+        deferred = defer.Deferred()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda done: reactor.callFromThread(self._resolve, deferred, done))
+        return deferred
+
+    @staticmethod
+    def _resolve(deferred, future):
+        error = future.exception()
+        if error is not None:
+            deferred.errback(Failure(error))
+        else:
+            deferred.callback(future.result())
+
+    def parse_well_report(self, text, well_id, parser="regex"):
+        return self.submit(parse_well_report, text, well_id, parser)
+
+    def close(self):
+        # Callbacks still waiting have been cancelled with the crawl
+        self.executor.shutdown(wait=False)
@@ -4,10 +4,27 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-import datetime
-import re
+import logging
+import os
+import time
 import pymongo
 from scrapy.exceptions import DropItem
+from scrapy.utils.log import failure_to_exc_info
+from twisted.internet import defer, task, threads
+from marcellus import cleaning, compact, generation, rollups, sink, timeseries, upserts
+
+logger = logging.getLogger(__name__)
+
+
+def validate_item(item):
+    """
+    Every populated field must carry a value
+    :param item:
+    :return:
+    """
+    for field, value in item.items():
+        if not value:
+            raise DropItem("missing {0}".format(field))
 
 
 class MarcellusPipeline:
@@ -17,6 +34,18 @@ class MarcellusPipeline:
     a clean structure ready for MongoDB insert in a later pipeline
     """
 
+    cleaner = cleaning.ReportCleaner()
+    metrics = None
+    compact = False
+
+    def open_spider(self, spider):
+        # Hold cleaned reports as typed arrays, see `marcellus.compact`
+        self.compact = spider.settings.getbool("COMPACT_REPORTS")
+        # With instrumentation on, every field cleaner is timed as well
+        self.metrics = getattr(spider, "metrics", None)
+        if self.metrics is not None:
+            self.cleaner = cleaning.TimedReportCleaner(self.metrics)
+
     def process_item(self, item, spider):
         """
         Default method to be called for each item
@@ -24,130 +53,329 @@ class MarcellusPipeline:
         :param spider:
         :return:
         """
-        item = self.process_production_report(item)
-        return item
+        if self.metrics is None:
+            return self.process_production_report(item)
+        with self.metrics.timer("clean_report"):
+            return self.process_production_report(item)
 
     def process_production_report(self, item):
         """
         Structure the report!
         :return:
         """
-
-        # Create a new record set
-        records = list()
-        for op_period, values in item["production_report"].items():
-            labels = values[0::2]
-            targets = values[1::2][: len(labels)]
-            new_record = {k.replace(":", "").replace(".", "_"): v for k, v in zip(labels, targets)}
-            new_record["period"] = op_period
-            records.append(new_record)
-
-        cleaned_records = self.clean_production_report(records)
+        cleaned_records = item["production_report"]
+        if isinstance(cleaned_records, dict):
+            cleaned_records = self.cleaner.clean(cleaned_records)
+        # Otherwise the report was read by the lxml parser or cleaned in the process pool, see `marcellus.offload`
         item["county"] = item["county"].lower()
         item["township"] = item["township"].lower()
         item["well_name"] = item["well_name"].lower().replace(" ", "_")
-        item["production_report"] = cleaned_records
+        item["production_report"] = (
+            compact.CompactReport.from_records(cleaned_records) if self.compact else cleaned_records
+        )
         return item
 
     def clean_production_report(self, records):
         """
         For every field in the report, some clean is required. Most is done with Regex extraction of the desired
-        data group.
+        data group. See `marcellus.cleaning.FIELD_SPEC`.
         :param records:
         :return:
         """
-        parsed = list()
-        for record in records:
-            avg_production = self.clean_average_production(record)
-            est_royalites = self.clean_royalities(record)
-            operating_days = self.clean_operating_days(record)
-            production_company = self.clean_company(record)
-            quantity_of_gas = self.clean_quantity_of_gas(record)
-            value_of_gas = self.clean_value_of_gas(record)
-            crowd_source_atw = self.clean_crowd_source_atw(record)
-            period = self.clean_period(record)
-            parsed.append(
-                dict(
-                    avg_production=avg_production,
-                    est_royalites=est_royalites,
-                    operating_days=operating_days,
-                    production_company=production_company,
-                    quanitity_of_gas=quantity_of_gas,
-                    value_of_gas=value_of_gas,
-                    crowd_source_atw=crowd_source_atw,
-                    period=period,
-                )
-            )
-        return parsed
+        return [self.cleaner.clean_record(record) for record in records]
 
     def clean_average_production(self, records):
-        original = records.get("AvgProductionPerDay", "")
-        match = re.search(r":\$([0-9.,]+)\(", original)
-        if match is None:
-            return None
-        return float(match.group(1).replace(",", ""))
+        return cleaning.clean_average_production(records.get("AvgProductionPerDay", ""))
 
     def clean_royalities(self, records):
-        original = records.get("Est_Royalties", "")
-        match = re.search(r".*([0-9,.]+)\(", original)
-        if match is None:
-            return None
-        return float(match.group(1).replace(",", ""))
+        return cleaning.clean_royalties(records.get("Est_Royalties", ""))
 
     def clean_operating_days(self, records):
-        original = records.get("OperatingDays", "")
-        match = re.search(r"([0-9]+)", original)
-        if match is None:
-            return None
-        return int(match.group(1))
+        return cleaning.clean_operating_days(records.get("OperatingDays", ""))
 
     def clean_company(self, records):
-        original = records.get("ProductionCompany", "")
-        return original.replace(":", "").replace("&amp", "_")
+        return cleaning.clean_company(records.get("ProductionCompany", ""))
 
     def clean_quantity_of_gas(self, records):
-        original = records.get("QuantityofGas", "")
-        match = re.search(r"([0-9,.]+)", original)
-        if match is None:
-            return None
-        return float(match.group(1).replace(",", ""))
+        return cleaning.clean_quantity_of_gas(records.get("QuantityofGas", ""))
 
     def clean_crowd_source_atw(self, records):
-        original = records.get("crowdsourcedATW", "")
-        match = re.search(r"([0-9.,]+)\/", original)
-        if match is None:
-            return None
-        return float(match.group(1).replace(",", ""))
+        return cleaning.clean_crowd_source_atw(records.get("crowdsourcedATW", ""))
 
     def clean_period(self, records):
-        original = records.get("period", "")
-        parsed = original.split(":")[-1].split("-")[-1][:7]
-        return datetime.datetime.strptime(parsed, "%b%Y").strftime("%Y-%m")
+        return cleaning.clean_period(records.get("period", ""))
 
     def clean_value_of_gas(self, records):
-        original = records.get("ValueofGas", "")
-        match = re.search(r"\$([0-9,.]+)\(", original)
-        if match is None:
-            return None
-        return float(match.group(1).replace(",", ""))
+        return cleaning.clean_value_of_gas(records.get("ValueofGas", ""))
 
 
 class MongoDBPipeline:
     """
-    Dump the data into MongoDB
+    Dump the data into MongoDB.
+    Wells are upserted by well name and permit number and only their new or changed periods are written, see
+    `marcellus.upserts`; re-crawls never duplicate a well.
+    Items are buffered and written with bulk writes once MONGO_BATCH_SIZE items are waiting or MONGO_FLUSH_INTERVAL
+    seconds have passed. Writes run in the reactor thread pool so a slow round trip never stalls downloads or parsing.
+    At most MONGO_MAX_PENDING_FLUSHES batches are in flight; past that, items are held back until a batch completes.
+    A batch holding a well that is still being written by another batch waits for it, so the well is planned against
+    what that batch stored.
+    Each batch also increments the county x period rollups in MONGO_ROLLUP_COLLECTION, see `marcellus.rollups`.
+    With MONGO_PERIOD_COLLECTION set, every period is also upserted as its own document, see `marcellus.timeseries`.
+    With CHECKPOINT_PATH set, the wells of every written batch are marked done in the spider's checkpoint.
+    Readers are told about new data by bumping the generation marker in MONGO_META_COLLECTION, at most every
+    MONGO_GENERATION_INTERVAL seconds and once more when the spider closes.
     """
 
-    def __init__(self):
-        connection = pymongo.MongoClient("localhost", 27017)
-        db = connection["marcellus"]
-        self.collection = db["report.production"]
+    def __init__(
+        self,
+        mongo_uri,
+        mongo_db,
+        mongo_collection,
+        batch_size=500,
+        flush_interval=5.0,
+        max_pending=2,
+        stats=None,
+        rollup_collection=None,
+        meta_collection=None,
+        generation_interval=300.0,
+        period_collection=None,
+    ):
+        self.mongo_uri = mongo_uri
+        self.mongo_db = mongo_db
+        self.mongo_collection = mongo_collection
+        self.rollup_collection = rollup_collection
+        self.meta_collection = meta_collection
+        self.generation_interval = generation_interval
+        self.period_collection = period_collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = stats
+        self.client = None
+        self.collection = None
+        self.rollups = None
+        self.meta = None
+        self.periods = None
+        self.checkpoint = None
+        self.metrics = None
+        self.last_bump = time.monotonic()
+        self.unannounced = False
+        self.buffer = list()
+        self.pending = list()
+        self.in_flight = dict()
+        self.flush_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            mongo_uri=settings.get("MONGO_URI", "mongodb://localhost:27017"),
+            mongo_db=settings.get("MONGO_DATABASE", "marcellus"),
+            mongo_collection=settings.get("MONGO_COLLECTION", "report.production"),
+            batch_size=settings.getint("MONGO_BATCH_SIZE", 500),
+            flush_interval=settings.getfloat("MONGO_FLUSH_INTERVAL", 5.0),
+            max_pending=settings.getint("MONGO_MAX_PENDING_FLUSHES", 2),
+            stats=crawler.stats,
+            rollup_collection=settings.get("MONGO_ROLLUP_COLLECTION"),
+            meta_collection=settings.get("MONGO_META_COLLECTION"),
+            generation_interval=settings.getfloat("MONGO_GENERATION_INTERVAL", 300.0),
+            period_collection=settings.get("MONGO_PERIOD_COLLECTION"),
+        )
+
+    def open_spider(self, spider):
+        self.checkpoint = getattr(spider, "checkpoint", None)
+        self.metrics = getattr(spider, "metrics", None)
+        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.collection = self.client[self.mongo_db][self.mongo_collection]
+        upserts.ensure_indexes(self.collection)
+        if self.rollup_collection:
+            self.rollups = self.client[self.mongo_db][self.rollup_collection]
+            rollups.ensure_indexes(self.rollups)
+        if self.meta_collection:
+            self.meta = self.client[self.mongo_db][self.meta_collection]
+        if self.period_collection:
+            self.periods = self.client[self.mongo_db][self.period_collection]
+            timeseries.ensure_indexes(self.periods)
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        d = defer.DeferredList(list(self.pending))
+        d.addBoth(lambda _: self.announce() if self.unannounced else None)
+        d.addBoth(lambda _: self.client.close())
+        return d
 
     def process_item(self, item, spider):
-        valid = True
-        for data in item:
-            if not data:
-                valid = False
-                raise DropItem("missing {0}".format(data))
-            if valid:
-                self.collection.insert(dict(item))
+        self.validate_item(item)
+        self.buffer.append(self.to_document(item))
+        self.inc_stat("mongodb/items_buffered")
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        if len(self.pending) < self.max_pending:
             return item
+
+        # Backpressure: hold this item until the oldest batch in flight has been written
+        d = defer.Deferred()
+        self.pending[0].addBoth(lambda _: d.callback(item))
+        self.inc_stat("mongodb/backpressure_waits")
+        return d
+
+    def validate_item(self, item):
+        validate_item(item)
+
+    def to_document(self, item):
+        return compact.to_document(item)
+
+    def flush(self):
+        """
+        Hand the buffered documents to a worker thread as a single bulk write
+        :return: Deferred firing once the batch is written
+        """
+        if not self.buffer:
+            return defer.succeed(None)
+        batch, self.buffer = self.buffer, list()
+        started = time.monotonic()
+        names = {document.get("well_name") for document in batch}
+        overlapping = [other for other, other_names in self.in_flight.items() if names & other_names]
+        if overlapping:
+            self.inc_stat("mongodb/overlapping_flushes")
+            d = defer.DeferredList(overlapping)
+            d.addCallback(lambda _: threads.deferToThread(self.write_batch, batch))
+        else:
+            d = threads.deferToThread(self.write_batch, batch)
+        d.addCallback(self.on_flush, batch, started)
+        d.addErrback(self.on_flush_error, len(batch))
+        self.pending.append(d)
+        self.in_flight[d] = names
+        d.addBoth(self.on_flush_done, d)
+        return d
+
+    def write_batch(self, batch):
+        return upserts.write(self.collection, batch, self.periods, self.rollups)
+
+    def on_flush(self, result, batch, started):
+        size = len(batch)
+        if self.metrics is not None:
+            self.metrics.observe("mongo_write", time.monotonic() - started)
+        if self.checkpoint is not None:
+            self.checkpoint.complete(
+                document["well_report_link"] for document in batch if "well_report_link" in document
+            )
+        self.inc_stat("mongodb/flushes")
+        self.inc_stat("mongodb/items_written", size)
+        for key, count in result.items():
+            self.inc_stat(f"mongodb/{key}", count)
+        self.inc_stat("mongodb/flush_time", time.monotonic() - started)
+        if self.stats is not None:
+            self.stats.max_value("mongodb/max_batch_size", size)
+        self.unannounced = True
+        if time.monotonic() - self.last_bump >= self.generation_interval:
+            self.announce()
+        return result
+
+    def announce(self):
+        """
+        Bump the generation marker so readers drop their cached results
+        :return: Deferred
+        """
+        if self.meta is None:
+            return defer.succeed(None)
+        self.unannounced = False
+        self.last_bump = time.monotonic()
+        self.inc_stat("mongodb/generation_bumps")
+        d = threads.deferToThread(generation.bump, self.meta, self.mongo_collection)
+        d.addErrback(lambda failure: logger.error("Generation bump failed", exc_info=failure_to_exc_info(failure)))
+        return d
+
+    def on_flush_error(self, failure, size):
+        self.inc_stat("mongodb/flush_errors")
+        self.inc_stat("mongodb/items_failed", size)
+        logger.error("MongoDB bulk write of %d items failed", size, exc_info=failure_to_exc_info(failure))
+
+    def on_flush_done(self, result, d):
+        self.pending.remove(d)
+        self.in_flight.pop(d, None)
+        return result
+
+    def inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
+
+
+class FileSinkPipeline:
+    """
+    Append the cleaned items to rotating compressed files instead of MongoDB, see `marcellus.sink`. Takes the place of
+    MongoDBPipeline in ITEM_PIPELINES; the crawl then needs no database. Load a finished run with
+    `python -m marcellus.sink load`.
+    With CHECKPOINT_PATH set, the wells of a file are marked done in the spider's checkpoint once the file is finished.
+    """
+
+    def __init__(
+        self, directory, file_format="jsonl", compression="gzip", buffer_items=500, file_items=50000, stats=None
+    ):
+        self.directory = directory
+        self.file_format = file_format
+        self.compression = compression
+        self.buffer_items = buffer_items
+        self.file_items = file_items
+        self.stats = stats
+        self.sink = None
+        self.checkpoint = None
+        self.metrics = None
+        # Well report links of the items in the unfinished file
+        self.links = list()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            directory=settings.get("SINK_DIR", "sink"),
+            file_format=settings.get("SINK_FORMAT", "jsonl"),
+            compression=settings.get("SINK_COMPRESSION", "gzip"),
+            buffer_items=settings.getint("SINK_BUFFER_ITEMS", 500),
+            file_items=settings.getint("SINK_FILE_ITEMS", 50000),
+            stats=crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        self.checkpoint = getattr(spider, "checkpoint", None)
+        self.metrics = getattr(spider, "metrics", None)
+        self.sink = sink.RotatingSink(
+            self.directory, self.file_format, self.compression, self.buffer_items, self.file_items
+        )
+
+    def close_spider(self, spider):
+        self.on_write(self.sink.close)
+
+    def process_item(self, item, spider):
+        validate_item(item)
+        self.links.append(item.get("well_report_link"))
+        self.on_write(self.sink.add, item)
+        return item
+
+    def on_write(self, write, *args):
+        started = time.monotonic()
+        finished = write(*args)
+        if self.metrics is not None and not self.sink.buffer:
+            # The buffer was written out
+            self.metrics.observe("sink_write", time.monotonic() - started)
+        if not finished:
+            return
+        for path in finished:
+            self.inc_stat("sink/files")
+            self.inc_stat("sink/bytes", os.path.getsize(path))
+            logger.info("Sink file finished: %s", path)
+        # The items not in a finished file are in the one still open
+        done = len(self.links) - (self.sink.items if self.sink.writer is not None else 0)
+        if self.checkpoint is not None:
+            self.checkpoint.complete(link for link in self.links[:done] if link)
+        self.inc_stat("sink/items_written", done)
+        self.links = self.links[done:]
+
+    def inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Splash render of the production report as a Lua script.
+#
+# With SPLASH_RENDER_MODE "lua" the spider renders pro_update.php through Splash's `execute` endpoint instead of
+# `render.html` with a fixed wait. The script loads no images, style sheets or resources from other hosts, polls the
+# page until the county links and the permit tables are in `#proData`, and returns only that element. The login cookies
+# go in and come back through SplashCookiesMiddleware. When the tables are not in after SPLASH_WAIT_TIMEOUT seconds,
+# whatever loaded is returned with `timed_out` set.
+LUA_SOURCE = """
+function main(splash, args)
+  splash.images_enabled = false
+  splash.plugins_enabled = false
+  splash.resource_timeout = args.resource_timeout
+
+  local host = args.url:match("^%a+://([^/?#]+)")
+  splash:on_request(function(request)
+    local path = request.url:match("^[^?#]*")
+    if request.url:match("^%a+://([^/?#]+)") ~= host or path:find("%.css$") then
+      request:abort()
+    end
+  end)
+
+  splash:init_cookies(args.cookies)
+  assert(splash:go{args.url, headers=args.headers})
+
+  local count = "document.querySelectorAll('" .. args.wait_for .. "').length"
+  local tables = "document.querySelectorAll('" .. args.tables .. "').length"
+  local waited = 0
+  local loaded = -1
+  local timed_out = true
+  while waited < args.wait_timeout do
+    if splash:evaljs(count) > 0 then
+      -- The tables come in with XHRs; done once their number holds for a poll
+      local now = splash:evaljs(tables)
+      if now > 0 and now == loaded then
+        timed_out = false
+        break
+      end
+      loaded = now
+    end
+    splash:wait(args.poll)
+    waited = waited + args.poll
+  end
+
+  local report = splash:select(args.fragment)
+  return {
+    html = report and report.node.outerHTML or "",
+    url = splash:url(),
+    cookies = splash:get_cookies(),
+    timed_out = timed_out,
+  }
+end
+"""
+
+# The production report, the county links it must show, and the permit tables loaded into it
+FRAGMENT = "#proData"
+WAIT_FOR = "#proData a[id^=munilink]"
+TABLES = "#proData div[id^=permits_] table"
+
+
+def production_report_args(wait_timeout=30.0, poll=0.25, resource_timeout=10.0):
+    """
+    Arguments of the `execute` endpoint for the production report
+    :param wait_timeout: Seconds to wait for the permit tables
+    :param poll: Seconds between two looks at the page
+    :param resource_timeout: Seconds before a single resource is given up
+    :return: dict
+    """
+    return {
+        "lua_source": LUA_SOURCE,
+        "fragment": FRAGMENT,
+        "wait_for": WAIT_FOR,
+        "tables": TABLES,
+        "wait_timeout": wait_timeout,
+        "poll": poll,
+        "resource_timeout": resource_timeout,
+    }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# County x period rollups of the production reports.
+#
+# MongoDBPipeline keeps the rollup collection up to date as wells are written, so the dashboard reads a handful of
+# small documents instead of aggregating every well. `python -m marcellus.rollups` recomputes the rollups from scratch.
+import argparse
+import pymongo
+from scrapy.utils.project import get_project_settings
+from marcellus import compact, generation
+
+SUM_FIELDS = ("quanitity_of_gas", "value_of_gas", "est_royalites")
+
+
+def rollup_deltas(documents):
+    """
+    Per (county, period) increments for a batch of cleaned well documents. A well counts once per period.
+    :param documents: Cleaned well documents
+    :return: {(county, period): {"well_count": int, field: float, ...}}
+    """
+    deltas = dict()
+    for document in documents:
+        accumulate_well(deltas, document.get("county"), compact.report_records(document))
+    return deltas
+
+
+def accumulate_well(deltas, county, records):
+    """
+    Add the records of one well to the rollup increments; the well counts once per period, however many operating
+    periods it reports in it
+    :param deltas: {(county, period): increments}, updated in place
+    :param county:
+    :param records: Cleaned records of the well
+    :return:
+    """
+    seen = set()
+    for record in records:
+        period = record.get("period")
+        accumulate(deltas, county, record, wells=0 if period in seen else 1)
+        seen.add(period)
+
+
+def accumulate(deltas, county, record, wells=1, sign=1):
+    """
+    Add one well period to the rollup increments
+    :param deltas: {(county, period): increments}, updated in place
+    :param county:
+    :param record: Cleaned record
+    :param wells: Change of the well count, 0 when the well period was counted before
+    :param sign: -1 takes the record back out, e.g. the stored values of a period that changed
+    :return:
+    """
+    key = (county, record.get("period"))
+    delta = deltas.get(key)
+    if delta is None:
+        delta = deltas[key] = dict.fromkeys(("well_count",) + SUM_FIELDS, 0)
+    delta["well_count"] += wells
+    for field in SUM_FIELDS:
+        value = record.get(field)
+        if value is not None:
+            delta[field] += sign * value
+
+
+def rollup_updates(deltas):
+    return [
+        pymongo.UpdateOne({"county": county, "period": period}, {"$inc": delta}, upsert=True)
+        for (county, period), delta in deltas.items()
+    ]
+
+
+def ensure_indexes(rollups):
+    rollups.create_index([("period", pymongo.ASCENDING), ("county", pymongo.ASCENDING)], unique=True)
+
+
+def rebuild(collection, rollups, batch_size=500):
+    """
+    Recompute every rollup from the stored wells and replace the rollup collection. Wells with an embedded report are
+    aggregated on the server; compact reports (see `marcellus.compact`) are added afterwards in batches.
+    :param collection: Collection with the well documents
+    :param rollups: Rollup collection
+    :param batch_size: Compact wells per bulk write
+    :return:
+    """
+    sums = {field: {"$sum": f"$production_report.{field}"} for field in SUM_FIELDS}
+    pipeline = [
+        {"$unwind": "$production_report"},
+        # One entry per well and period first, so a well counts once per period
+        {"$group": dict(_id={"well": "$_id", "county": "$county", "period": "$production_report.period"}, **sums)},
+        {
+            "$group": dict(
+                _id={"county": "$_id.county", "period": "$_id.period"},
+                well_count={"$sum": 1},
+                **{field: {"$sum": f"${field}"} for field in SUM_FIELDS},
+            )
+        },
+        {
+            "$project": dict(
+                _id=0, county="$_id.county", period="$_id.period", well_count=1, **{f: 1 for f in SUM_FIELDS}
+            )
+        },
+        {"$out": rollups.name},
+    ]
+    collection.aggregate(pipeline, allowDiskUse=True)
+    ensure_indexes(rollups)
+    batch = list()
+    for document in collection.find({"compact_report": {"$exists": True}}, {"county": 1, "compact_report": 1}):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            rollups.bulk_write(rollup_updates(rollup_deltas(batch)), ordered=False)
+            batch = list()
+    if batch:
+        rollups.bulk_write(rollup_updates(rollup_deltas(batch)), ordered=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the county x period rollups from the stored wells")
+    parser.parse_args(argv)
+    settings = get_project_settings()
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    db = client[settings.get("MONGO_DATABASE", "marcellus")]
+    rollups = db[settings.get("MONGO_ROLLUP_COLLECTION", "report.rollups")]
+    collection = db[settings.get("MONGO_COLLECTION", "report.production")]
+    rebuild(collection, rollups)
+    if settings.get("MONGO_META_COLLECTION"):
+        generation.bump(db[settings.get("MONGO_META_COLLECTION")], collection.name)
+    print(f"{rollups.count_documents({})} rollups written to {rollups.full_name}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
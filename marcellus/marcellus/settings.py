@@ -14,6 +14,8 @@ BOT_NAME = "marcellus"
 SPIDER_MODULES = ["marcellus.spiders"]
 NEWSPIDER_MODULE = "marcellus.spiders"
 SPLASH_URL = "http://0.0.0.0:8050"
+# Site to crawl; point both at a local stand-in (python -m marcellus.standin) for throughput tests
+MARCELLUS_BASE_URL = "http://www.marcellusgas.org"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -47,11 +49,17 @@ CONCURRENT_REQUESTS_PER_IP = 2
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-SPIDER_MIDDLEWARES = {"scrapy_splash.SplashDeduplicateArgsMiddleware": 100}
+SPIDER_MIDDLEWARES = {
+    "scrapy_splash.SplashDeduplicateArgsMiddleware": 100,
+    "marcellus.middlewares.MarcellusSpiderMiddleware": 543,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+    "marcellus.middlewares.MarcellusDownloaderMiddleware": 543,
+    "marcellus.middlewares.AdaptiveThrottleMiddleware": 590,
+    "marcellus.middlewares.ResponseArchiveMiddleware": 700,
     "scrapy_splash.SplashCookiesMiddleware": 723,
     "scrapy_splash.SplashMiddleware": 725,
     "scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware": 810,
@@ -67,9 +75,122 @@ DOWNLOADER_MIDDLEWARES = {
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {"marcellus.pipelines.MarcellusPipeline": 300, "marcellus.pipelines.MongoDBPipeline": 301}
 
+# MongoDB writer. Items are buffered and flushed with bulk writes off the reactor thread once MONGO_BATCH_SIZE
+# items are waiting or every MONGO_FLUSH_INTERVAL seconds. MONGO_MAX_PENDING_FLUSHES bounds the batches in flight.
+MONGO_URI = "mongodb://localhost:27017"
+MONGO_DATABASE = "marcellus"
+MONGO_COLLECTION = "report.production"
+MONGO_BATCH_SIZE = 500
+MONGO_FLUSH_INTERVAL = 5.0
+MONGO_MAX_PENDING_FLUSHES = 2
+# County x period rollups maintained with every flush; rebuild with `python -m marcellus.rollups`. None disables.
+MONGO_ROLLUP_COLLECTION = "report.rollups"
+# Optional well x period layout: one document per (well, period) with compound indexes on (period, county) and
+# (well_name, period). Fill it from existing data with `python -m marcellus.timeseries migrate`. None disables.
+MONGO_PERIOD_COLLECTION = None
+# Generation marker telling readers (app.py) the data changed, bumped at most every MONGO_GENERATION_INTERVAL seconds
+# during a crawl and once at the end. None disables.
+MONGO_META_COLLECTION = "report.meta"
+MONGO_GENERATION_INTERVAL = 300.0
+
+# Local file sink, see marcellus/sink.py. Put "marcellus.pipelines.FileSinkPipeline": 301 in ITEM_PIPELINES instead of
+# MongoDBPipeline to crawl without a database; items go to SINK_DIR as SINK_FORMAT "jsonl" (one well per line) or
+# "parquet" (one row per well and period) files, compressed with SINK_COMPRESSION ("gzip", "bz2", "xz" or None for
+# JSON lines; any Parquet codec). SINK_BUFFER_ITEMS items are written at once and SINK_FILE_ITEMS go into a file before
+# it rotates. Load a finished run with `python -m marcellus.sink load`.
+SINK_DIR = "sink"
+SINK_FORMAT = "jsonl"
+SINK_COMPRESSION = "gzip"
+SINK_BUFFER_ITEMS = 500
+SINK_FILE_ITEMS = 50000
+
+# Index fetch mode. "splash" renders the whole production report in Splash before any well is requested. "fragments"
+# reads the county/township structure from the page as served and requests every township permit table directly, in
+# parallel; Splash is only used when the structure is missing or a table cannot be fetched. PERMIT_TABLE_URL is the
+# path the page's JavaScript loads a permit table from, `{link}` being the township link id.
+INDEX_FETCH_MODE = "splash"
+PERMIT_TABLE_URL = "/pro_permits.php?muni={link}"
+
+# Splash render of the production report. "html" renders the whole page with render.html and a fixed wait; "lua" runs
+# a script (marcellus/render.py) that blocks images, CSS and other hosts, waits up to SPLASH_WAIT_TIMEOUT seconds for
+# the permit tables in #proData and returns only that element.
+SPLASH_RENDER_MODE = "html"
+SPLASH_WAIT_TIMEOUT = 30.0
+
+# Sharded crawl, see marcellus/shards.py. SHARD_ROLE "plan" queues the well rows per county in the SQLite
+# SHARD_QUEUE; "worker" logs in and crawls counties claimed from it. Normally set by `python -m marcellus.shards`.
+SHARD_ROLE = None
+SHARD_QUEUE = "shards.sqlite"
+
+# Instrumentation. Latency histograms for the Splash render, page downloads, spider callbacks, every cleaning step and
+# the Mongo writes, plus queue depth, item rate and memory. Written as a Prometheus text file every
+# INSTRUMENTATION_INTERVAL seconds (point the node exporter textfile collector at it) and as a JSON summary at close.
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_INTERVAL = 15
+INSTRUMENTATION_PROMETHEUS_PATH = "marcellus.prom"
+INSTRUMENTATION_SUMMARY_PATH = "marcellus-metrics.json"
+
+# Hold cleaned production reports as typed arrays and store them as binary columns under `compact_report` instead of
+# a list of per-period documents, see marcellus/compact.py. Cuts pipeline memory and document size.
+COMPACT_REPORTS = False
+
+# Checkpoint of the well report frontier. Rows are stored before their requests go out and marked done once written
+# to MongoDB; a restarted crawl only requests the wells still pending, reusing the saved session cookies for up to
+# CHECKPOINT_SESSION_TTL seconds. None disables.
+CHECKPOINT_PATH = None
+CHECKPOINT_SESSION_TTL = 3600
+
+# Incremental crawl. At spider open the stored wells are loaded with their index fingerprints; only well reports that
+# are new or whose royalty, market value, mcf or permit number changed are downloaded.
+INCREMENTAL_CRAWL = False
+
+# Well report parser. "regex" serializes the report element and strips the markup, "lxml" walks the element tree and
+# reads label/value pairs per operating period. Both produce the same values, but only "lxml" keeps the spaces of
+# company names and every operating period of a month.
+WELL_REPORT_PARSER = "regex"
+
+# Parse and clean the well reports in this many worker processes instead of the reactor thread, see
+# marcellus/offload.py. 0 keeps them in the spider. At most WELL_REPORT_MAX_IN_FLIGHT pages are queued for the pool
+# (0: twice the processes); further responses wait in the scraper, which holds back the downloader.
+WELL_REPORT_PROCESSES = 0
+WELL_REPORT_MAX_IN_FLIGHT = 0
+
+# Order of the well report requests, see marcellus/frontier.py. None keeps the index order, "counties" crawls the
+# counties listed in WELL_PRIORITY_COUNTIES first (in that order), "newest_permits" the wells started last first.
+WELL_PRIORITY_POLICY = None
+WELL_PRIORITY_COUNTIES = []
+
+# Pending requests held in memory by the scheduler, across all priorities. Past FRONTIER_MEMORY_LIMIT they spill to
+# disk queues in FRONTIER_SPILL_DIR (a temporary directory when None), removed again as they drain. 0 never spills.
+SCHEDULER_MEMORY_QUEUE = "marcellus.frontier.SpillingFifoQueue"
+FRONTIER_MEMORY_LIMIT = 20000
+FRONTIER_SPILL_DIR = None
+
+# Index page parser. "lxml" traverses the rendered production report once, "xpath" runs document-wide queries for
+# every county and township.
+INDEX_PAGE_PARSER = "lxml"
+
+# Response archive. "record" appends the production report (rendered, or as served with its permit tables in
+# fragments mode) and every well report to ARCHIVE_DIR while crawling; "replay" feeds the archive through the spider
+# and pipelines without network, Splash or login.
+ARCHIVE_MODE = None
+ARCHIVE_DIR = "archive"
+
 # Dupefilter
 DUPEFILTER_CLASS = "scrapy_splash.SplashAwareDupeFilter"
 
+# Adaptive throttle for well report requests, off by default. DOWNLOAD_DELAY and CONCURRENT_REQUESTS_PER_IP are the
+# starting point; concurrency grows while responses stay under the target latency and halves on slow responses, errors
+# or login pages. ADAPTIVE_THROTTLE_MAX_CONCURRENCY and ADAPTIVE_THROTTLE_MIN_DELAY are the politeness limits; they
+# default to CONCURRENT_REQUESTS_PER_IP and DOWNLOAD_DELAY, so the throttle only ever slows the crawl down unless they
+# are raised explicitly.
+ADAPTIVE_THROTTLE_ENABLED = False
+ADAPTIVE_THROTTLE_TARGET_LATENCY = 1.0
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 2
+ADAPTIVE_THROTTLE_MIN_DELAY = 1.0
+ADAPTIVE_THROTTLE_MAX_DELAY = 30.0
+ADAPTIVE_THROTTLE_MAX_ERROR_RATE = 0.05
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
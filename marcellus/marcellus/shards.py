@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# Sharded crawl across counties.
+#
+# A planning crawl (SHARD_ROLE = "plan") logs in, reads the production report index and stores every well row in a
+# local SQLite queue, one shard per county. Worker crawls (SHARD_ROLE = "worker") each log in with their own session,
+# claim a county at a time and request its well reports through the usual pipelines. The coordinator starts the
+# workers, reports per-shard progress and merges their stats. The politeness limits (ADAPTIVE_THROTTLE_MAX_CONCURRENCY
+# and ADAPTIVE_THROTTLE_MIN_DELAY) hold for all workers together, so there are never more workers than requests allowed
+# in flight:
+#
+#     python -m marcellus.shards plan
+#     python -m marcellus.shards run --workers 2
+#     python -m marcellus.shards status
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from scrapy.utils.project import get_project_settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    county TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    wells INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS wells (
+    link TEXT PRIMARY KEY,
+    county TEXT NOT NULL,
+    row TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending'
+);
+CREATE INDEX IF NOT EXISTS wells_county ON wells (county, status);
+CREATE TABLE IF NOT EXISTS stats (
+    worker TEXT PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+"""
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ShardQueue:
+    """
+    Work queue of county shards shared by processes through SQLite
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_rows(self, rows):
+        """
+        Queue well rows, grouped into shards by county. Rows already queued are kept as they are.
+        :param rows: Row dicts from the production report index
+        :return:
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany(
+            "INSERT OR IGNORE INTO wells (link, county, row) VALUES (?, ?, ?)",
+            [(row["link"], row["county"], json.dumps(row)) for row in rows],
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO shards (county, updated) VALUES (?, ?)",
+            [(county, time.time()) for county in {row["county"] for row in rows}],
+        )
+        self.db.execute("UPDATE shards SET wells = (SELECT COUNT(*) FROM wells WHERE wells.county = shards.county)")
+        self.db.execute("COMMIT")
+
+    def claim(self, worker):
+        """
+        Atomically hand the next pending shard to a worker
+        :param worker:
+        :return: County name or None when every shard is taken
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        row = self.db.execute(
+            "SELECT county FROM shards WHERE status = 'pending' ORDER BY wells DESC LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            self.db.execute(
+                "UPDATE shards SET status = 'running', worker = ?, updated = ? WHERE county = ?",
+                (worker, time.time(), row[0]),
+            )
+        self.db.execute("COMMIT")
+        return None if row is None else row[0]
+
+    def rows(self, county):
+        cursor = self.db.execute("SELECT row FROM wells WHERE county = ? AND status != 'done'", (county,))
+        return [json.loads(row) for row, in cursor]
+
+    def mark_well(self, link, status):
+        self.db.execute("UPDATE wells SET status = ? WHERE link = ?", (status, link))
+
+    def finish(self, county):
+        self.db.execute("UPDATE shards SET status = 'done', updated = ? WHERE county = ?", (time.time(), county))
+
+    def release(self, worker):
+        """
+        Put the running shards of a worker back in the queue, e.g. after it died
+        :param worker: Worker name, None for every worker
+        :return:
+        """
+        if worker is None:
+            self.db.execute("UPDATE shards SET status = 'pending', worker = NULL WHERE status = 'running'")
+        else:
+            self.db.execute(
+                "UPDATE shards SET status = 'pending', worker = NULL WHERE status = 'running' AND worker = ?", (worker,)
+            )
+
+    def save_stats(self, worker, stats):
+        self.db.execute(
+            "INSERT OR REPLACE INTO stats (worker, stats) VALUES (?, ?)", (worker, json.dumps(stats, default=str))
+        )
+
+    def progress(self):
+        """
+        :return: List of (county, status, worker, wells, done, failed)
+        """
+        return self.db.execute("""
+            SELECT shards.county, shards.status, shards.worker, shards.wells,
+                   SUM(wells.status = 'done'), SUM(wells.status = 'failed')
+            FROM shards LEFT JOIN wells ON wells.county = shards.county
+            GROUP BY shards.county ORDER BY shards.county
+            """).fetchall()
+
+    def merged_stats(self):
+        """
+        Sum the numeric stats of every worker; maxima, memory and elapsed time take the maximum
+        :return: dict
+        """
+        merged = dict()
+        for (stats,) in self.db.execute("SELECT stats FROM stats"):
+            for key, value in json.loads(stats).items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if any(word in key for word in ("max", "memusage", "elapsed_time")):
+                    merged[key] = max(merged.get(key, value), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+def crawl_command(path, role, settings):
+    command = [sys.executable, "-m", "scrapy", "crawl", "marcellus", "-s", f"SHARD_ROLE={role}", "-s"]
+    command.append(f"SHARD_QUEUE={os.path.abspath(path)}")
+    for setting in settings:
+        command += ["-s", setting]
+    return command
+
+
+def print_progress(queue):
+    print(f"{'county':<20}{'status':<10}{'wells':>8}{'done':>8}{'failed':>8}  worker")
+    for county, status, worker, wells, done, failed in queue.progress():
+        print(f"{county:<20}{status:<10}{wells:>8}{done or 0:>8}{failed or 0:>8}  {worker or ''}")
+
+
+def worker_settings(workers, max_concurrency, min_delay, download_delay):
+    """
+    Split the politeness limits of the whole crawl between the workers. Every worker starts at its share too, whether
+    or not the adaptive throttle is enabled.
+    :param workers: Number of workers, at most `max_concurrency`
+    :param max_concurrency: Well requests in flight over all workers
+    :param min_delay: Smallest delay between requests over all workers
+    :param download_delay: DOWNLOAD_DELAY of a single crawl
+    :return: List of NAME=VALUE settings
+    """
+    if workers > max_concurrency:
+        raise ValueError(f"{workers} workers exceed the {max_concurrency} requests allowed in flight")
+    ceiling = max_concurrency // workers
+    return [
+        f"ADAPTIVE_THROTTLE_MAX_CONCURRENCY={ceiling}",
+        f"ADAPTIVE_THROTTLE_MIN_DELAY={min_delay * workers}",
+        f"CONCURRENT_REQUESTS_PER_IP={ceiling}",
+        f"DOWNLOAD_DELAY={max(download_delay, min_delay) * workers}",
+    ]
+
+
+def run(queue, args):
+    queue.release(None)
+    settings = worker_settings(args.workers, args.max_concurrency, args.min_delay, args.download_delay)
+    settings += args.setting
+    workers = [subprocess.Popen(crawl_command(args.queue, "worker", settings)) for _ in range(args.workers)]
+    while any(worker.poll() is None for worker in workers):
+        time.sleep(args.interval)
+        print_progress(queue)
+    print_progress(queue)
+    print(json.dumps(queue.merged_stats(), indent=2, sort_keys=True))
+    return max(worker.returncode for worker in workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Coordinate a crawl sharded by county")
+    parser.add_argument("command", choices=("plan", "run", "status", "stats", "release"))
+    parser.add_argument("--queue", default="shards.sqlite", help="SQLite work queue")
+    parser.add_argument("--workers", type=int, default=2, help="At most --max-concurrency")
+    parser.add_argument("--max-concurrency", type=int, help="Well requests in flight over all workers")
+    parser.add_argument("--min-delay", type=float, help="Smallest delay between requests over all workers")
+    parser.add_argument("--interval", type=float, default=30.0, help="Seconds between progress reports")
+    parser.add_argument("-s", "--setting", action="append", default=list(), help="NAME=VALUE passed to the crawls")
+    args = parser.parse_args(argv)
+    settings = get_project_settings()
+    if args.max_concurrency is None:
+        args.max_concurrency = settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 2)
+    if args.min_delay is None:
+        args.min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 1.0)
+    args.download_delay = settings.getfloat("DOWNLOAD_DELAY", 0.0)
+    if args.command == "run" and args.workers > args.max_concurrency:
+        parser.error(f"--workers {args.workers} exceeds --max-concurrency {args.max_concurrency}")
+
+    queue = ShardQueue(args.queue)
+    try:
+        if args.command == "plan":
+            sys.exit(subprocess.call(crawl_command(args.queue, "plan", args.setting)))
+        elif args.command == "run":
+            sys.exit(run(queue, args))
+        elif args.command == "status":
+            print_progress(queue)
+        elif args.command == "stats":
+            print(json.dumps(queue.merged_stats(), indent=2, sort_keys=True))
+        else:
+            queue.release(None)
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# Local file sink for the cleaned wells.
+#
+# With FileSinkPipeline in ITEM_PIPELINES instead of MongoDBPipeline the crawl needs no database. Items are appended to
+# compressed files under SINK_DIR, either JSON lines (SINK_FORMAT "jsonl", one well per line, gzip, bz2 or xz) or
+# Parquet ("parquet", one row per well and period). SINK_BUFFER_ITEMS items are serialized and written at once, one
+# compression call or row group each; a file takes SINK_FILE_ITEMS items before the sink rotates to the next. Files are
+# written under a `_` prefix and renamed once closed, so a finished file is always complete. Load a finished run into
+# MongoDB afterwards with the same delta writes as the crawl:
+#
+#     python -m marcellus.sink load --dir sink
+import argparse
+import bz2
+import datetime
+import gzip
+import json
+import lzma
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pymongo
+from scrapy.utils.project import get_project_settings
+from marcellus import cleaning, compact, generation, rollups, timeseries, upserts
+
+OPENERS = {"gzip": (gzip.open, ".gz"), "bz2": (bz2.open, ".bz2"), "xz": (lzma.open, ".xz"), None: (open, "")}
+
+WELL_FIELDS = ("county", "township", "well_name", "permit_number", "fingerprint", "well_report_link")
+
+RECORD_FIELDS = tuple(field for field, key, cleaner in cleaning.FIELD_SPEC)
+
+RECORD_TYPES = dict({field: pa.float64() for field in compact.FLOAT_FIELDS}, operating_days=pa.int32())
+
+# `item` numbers the wells of a file; their rows are contiguous
+SCHEMA = pa.schema(
+    [("item", pa.int32())]
+    + [(field, pa.string()) for field in WELL_FIELDS]
+    + [(field, RECORD_TYPES.get(field, pa.string())) for field in RECORD_FIELDS]
+)
+
+
+def report_records(item):
+    report = item.get("production_report") or []
+    return report.to_records() if isinstance(report, compact.CompactReport) else report
+
+
+class JsonLinesWriter:
+    """
+    One file of JSON lines, compressed with `compression`
+    """
+
+    suffix = ".jsonl"
+
+    def __init__(self, path, compression="gzip"):
+        opener, extension = OPENERS[compression]
+        self.file = opener(path, "wb")
+
+    @classmethod
+    def extension(cls, compression):
+        return cls.suffix + OPENERS[compression][1]
+
+    def write(self, items):
+        lines = list()
+        for item in items:
+            well = dict(item)
+            well["production_report"] = report_records(item)
+            lines.append(json.dumps(well, separators=(",", ":")))
+        lines.append("")
+        self.file.write("\n".join(lines).encode("utf-8"))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    One Parquet file of well x period rows, one row group per write
+    """
+
+    suffix = ".parquet"
+
+    def __init__(self, path, compression="snappy"):
+        self.writer = pq.ParquetWriter(path, SCHEMA, compression=compression or "none")
+        self.items = 0
+
+    @classmethod
+    def extension(cls, compression):
+        return cls.suffix
+
+    def write(self, items):
+        columns = {name: list() for name in SCHEMA.names}
+        for item in items:
+            well = [(field, item.get(field)) for field in WELL_FIELDS]
+            for record in report_records(item):
+                columns["item"].append(self.items)
+                for field, value in well:
+                    columns[field].append(value)
+                for field in RECORD_FIELDS:
+                    columns[field].append(record.get(field))
+            self.items += 1
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=SCHEMA))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"jsonl": JsonLinesWriter, "parquet": ParquetWriter}
+
+
+class RotatingSink:
+    """
+    Buffers items and writes them to a rotating series of files `wells-{run}-{part}` in `directory`
+    """
+
+    def __init__(self, directory, file_format="jsonl", compression="gzip", buffer_items=500, file_items=50000):
+        if file_format not in WRITERS:
+            raise ValueError(f"Unknown sink format {file_format!r}")
+        self.directory = directory
+        self.writer_class = WRITERS[file_format]
+        self.compression = compression
+        self.buffer_items = buffer_items
+        self.file_items = file_items
+        self.run = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        self.parts = 0
+        self.buffer = list()
+        self.writer = None
+        self.name = None
+        self.items = 0
+        self.finished = list()
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, item):
+        """
+        :param item: Cleaned item
+        :return: Paths of the files finished by this item, usually none
+        """
+        self.buffer.append(item)
+        if len(self.buffer) >= self.buffer_items or self.items + len(self.buffer) >= self.file_items:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Write the buffered items, rotating when the file is full
+        :return: Paths of the files finished
+        """
+        finished = list()
+        while self.buffer:
+            if self.writer is None:
+                self.open()
+            count = min(len(self.buffer), self.file_items - self.items)
+            self.writer.write(self.buffer[:count])
+            self.buffer = self.buffer[count:]
+            self.items += count
+            if self.items >= self.file_items:
+                finished.append(self.finish())
+        return finished
+
+    def open(self):
+        self.name = f"wells-{self.run}-{self.parts:05d}{self.writer_class.extension(self.compression)}"
+        self.parts += 1
+        self.writer = self.writer_class(os.path.join(self.directory, f"_{self.name}"), self.compression)
+        self.items = 0
+
+    def finish(self):
+        self.writer.close()
+        path = os.path.join(self.directory, self.name)
+        os.replace(os.path.join(self.directory, f"_{self.name}"), path)
+        self.writer = None
+        self.finished.append(path)
+        return path
+
+    def close(self):
+        """
+        :return: Paths of the files finished
+        """
+        finished = self.flush()
+        if self.writer is not None:
+            finished.append(self.finish())
+        return finished
+
+
+def iter_jsonl(path):
+    opener = next((opener for opener, extension in OPENERS.values() if extension and path.endswith(extension)), open)
+    with opener(path, "rb") as fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_parquet(path):
+    parquet = pq.ParquetFile(path)
+    for group in range(parquet.num_row_groups):
+        columns = parquet.read_row_group(group).to_pydict()
+        item = None
+        for row in zip(*(columns[name] for name in SCHEMA.names)):
+            if item is None or row[0] != number:
+                if item is not None:
+                    yield item
+                number = row[0]
+                item = dict(zip(WELL_FIELDS, row[1 : 1 + len(WELL_FIELDS)]), production_report=list())
+            item["production_report"].append(dict(zip(RECORD_FIELDS, row[1 + len(WELL_FIELDS) :])))
+        if item is not None:
+            yield item
+
+
+def iter_items(path):
+    """
+    :param path: Finished sink file
+    :return: Generator of the items in it, with their cleaned records under `production_report`
+    """
+    if ParquetWriter.suffix in os.path.basename(path):
+        yield from iter_parquet(path)
+    else:
+        yield from iter_jsonl(path)
+
+
+def finished_files(directory):
+    """
+    :return: Finished sink files in `directory` in the order they were written
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("wells-") and os.path.isfile(os.path.join(directory, name))
+    )
+
+
+def load(paths, collection, periods=None, rollup_collection=None, compact_reports=False, batch_size=500):
+    """
+    Delta-write the items of finished sink files, like MongoDBPipeline does during a crawl
+    :param paths: Sink files
+    :param collection: Well collection
+    :param periods: Well x period collection, see `marcellus.timeseries`
+    :param rollup_collection: County x period rollups, see `marcellus.rollups`
+    :param compact_reports: Store the reports as binary columns, see COMPACT_REPORTS
+    :param batch_size: Wells per bulk write
+    :return: Generator of (path, counts) once a file is written
+    """
+    for path in paths:
+        counts = dict(wells=0)
+        batch = list()
+        for item in iter_items(path):
+            if item.get("permit_number") is None:
+                # Parquet rows carry a null where the crawl left the field out
+                item.pop("permit_number", None)
+            if compact_reports:
+                item["production_report"] = compact.CompactReport.from_records(item["production_report"])
+            batch.append(compact.to_document(item))
+            if len(batch) >= batch_size:
+                add_counts(counts, upserts.write(collection, batch, periods, rollup_collection), len(batch))
+                batch = list()
+        if batch:
+            add_counts(counts, upserts.write(collection, batch, periods, rollup_collection), len(batch))
+        yield path, counts
+
+
+def add_counts(counts, written, wells):
+    counts["wells"] += wells
+    for key, count in written.items():
+        counts[key] = counts.get(key, 0) + count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the files of a sink run into MongoDB")
+    parser.add_argument("command", choices=("load",))
+    parser.add_argument("--dir", help="Sink directory, SINK_DIR by default")
+    parser.add_argument("--batch-size", type=int, default=500, help="Wells per bulk write")
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    directory = args.dir or settings.get("SINK_DIR", "sink")
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    db = client[settings.get("MONGO_DATABASE", "marcellus")]
+    collection = db[settings.get("MONGO_COLLECTION", "report.production")]
+    upserts.ensure_indexes(collection)
+    periods = rollup_collection = None
+    if settings.get("MONGO_PERIOD_COLLECTION"):
+        periods = db[settings.get("MONGO_PERIOD_COLLECTION")]
+        timeseries.ensure_indexes(periods)
+    if settings.get("MONGO_ROLLUP_COLLECTION"):
+        rollup_collection = db[settings.get("MONGO_ROLLUP_COLLECTION")]
+        rollups.ensure_indexes(rollup_collection)
+
+    # Loaded files move to `loaded/`; a file is only moved once all of it is written, loading it again is harmless
+    loaded = os.path.join(directory, "loaded")
+    os.makedirs(loaded, exist_ok=True)
+    paths = finished_files(directory)
+    written = load(paths, collection, periods, rollup_collection, settings.getbool("COMPACT_REPORTS"), args.batch_size)
+    for path, counts in written:
+        os.replace(path, os.path.join(loaded, os.path.basename(path)))
+        print(f"{os.path.basename(path)}: " + ", ".join(f"{count} {key}" for key, count in sorted(counts.items())))
+    if paths and settings.get("MONGO_META_COLLECTION"):
+        generation.bump(db[settings.get("MONGO_META_COLLECTION")], collection.name)
+    print(f"{len(paths)} files loaded from {directory}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,27 @@
+import inspect
 import os
 import pymongo
 import re
 import scrapy
 import scrapy_splash
-from itertools import groupby
-from scrapy import FormRequest
+import time
+from scrapy import FormRequest, signals
+from scrapy.exceptions import DontCloseSpider
+from marcellus.archive import ResponseArchive
+from marcellus.checkpoint import Checkpoint
+from marcellus.extractors import (
+    iter_fragment_rows,
+    iter_permit_rows,
+    iter_townships,
+    report_from_markup,
+    report_from_tree,
+)
+from marcellus.frontier import well_priority
+from marcellus.fingerprints import index_key, load_fingerprint_index, normalize_well_name, row_fingerprint
+from marcellus.instrumentation import Metrics
+from marcellus.offload import WellReportPool
+from marcellus.render import production_report_args
+from marcellus.shards import ShardQueue, worker_name
 
 
 class ProductionReport(scrapy.Item):
@@ -21,19 +38,213 @@ class ProductionReport(scrapy.Item):
     date_start = scrapy.Field()
     permit_number = scrapy.Field()
     production_report = scrapy.Field()
+    fingerprint = scrapy.Field()
 
 
 class MarcellusSpider(scrapy.Spider):
     name = "marcellus"
     BASE_URL = "http://www.marcellusgas.org"
     start_urls = ["http://www.marcellusgas.org/login.php"]
-    collection = pymongo.MongoClient(host="localhost", port=27017)["marcellus"]["report.production"]
+
+    # Stored wells, connected to on first use; only incremental crawls read them
+    mongo_uri = "mongodb://localhost:27017"
+    mongo_db = "marcellus"
+    mongo_collection = "report.production"
+    client = None
+
+    # Incremental mode: only download well reports that are new or whose index row changed
+    incremental = False
+    persisted = dict()
+
+    # Well report parser: "regex" (serialize and strip the markup) or "lxml" (walk the element tree)
+    well_report_parser = "regex"
+
+    # Index page parser: "lxml" (one traversal of the page) or "xpath" (document-wide queries per county/township)
+    index_page_parser = "lxml"
+
+    # Index fetch mode: "splash" renders the whole production report, "fragments" requests the township permit tables
+    # directly and only falls back to Splash when the page structure is missing
+    index_fetch_mode = "splash"
+    permit_table_url = None
+    splash_fallback = False
+
+    # Splash render of the production report: "html" (render.html with a fixed wait) or "lua" (a script waiting for
+    # the tables and returning only them, see `marcellus.render`)
+    splash_render_mode = "html"
+    splash_wait_timeout = 30.0
+    # Cookies of the logged in session, handed to Splash
+    session = None
+
+    # Sharded crawl: "plan" queues the well rows by county, "worker" claims counties from the queue
+    shard_role = None
+    shard_queue = None
+    shard = None
+    worker = None
+
+    # Checkpoint of the well report frontier; a restart resumes the wells not written yet and the township permit
+    # tables not read yet
+    checkpoint = None
+    session_ttl = 3600
+    resume_rows = None
+    resume_townships = None
+
+    # Stage latencies and gauges, see `marcellus.instrumentation`
+    metrics = None
+
+    # Process pool parsing and cleaning the well reports, see `marcellus.offload`
+    pool = None
+
+    # Priority of a well request from its index row, see `marcellus.frontier`
+    priority = staticmethod(well_priority(None))
+
+    # Replay mode: start from the archived production report instead of login and Splash
+    archive_mode = None
+    archive_dir = "archive"
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        if settings.get("ARCHIVE_MODE") == "replay":
+            # Everything is answered locally, there is nobody to be polite to
+            settings.set("ROBOTSTXT_OBEY", False, priority="spider")
+            settings.set("DOWNLOAD_DELAY", 0, priority="spider")
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        base_url = crawler.settings.get("MARCELLUS_BASE_URL")
+        if base_url:
+            # e.g. a local stand-in, see marcellus/standin.py
+            spider.BASE_URL = base_url.rstrip("/")
+            spider.start_urls = [f"{spider.BASE_URL}/login.php"]
+        spider.mongo_uri = crawler.settings.get("MONGO_URI", spider.mongo_uri)
+        spider.mongo_db = crawler.settings.get("MONGO_DATABASE", spider.mongo_db)
+        spider.mongo_collection = crawler.settings.get("MONGO_COLLECTION", spider.mongo_collection)
+        spider.archive_mode = crawler.settings.get("ARCHIVE_MODE")
+        spider.index_fetch_mode = crawler.settings.get("INDEX_FETCH_MODE", "splash")
+        spider.permit_table_url = crawler.settings.get("PERMIT_TABLE_URL")
+        spider.splash_render_mode = crawler.settings.get("SPLASH_RENDER_MODE", "html")
+        spider.splash_wait_timeout = crawler.settings.getfloat("SPLASH_WAIT_TIMEOUT", 30.0)
+        spider.archive_dir = crawler.settings.get("ARCHIVE_DIR", "archive")
+        spider.incremental = crawler.settings.getbool("INCREMENTAL_CRAWL", False)
+        spider.well_report_parser = crawler.settings.get("WELL_REPORT_PARSER", "regex")
+        spider.index_page_parser = crawler.settings.get("INDEX_PAGE_PARSER", "lxml")
+        spider.priority = well_priority(
+            crawler.settings.get("WELL_PRIORITY_POLICY"), crawler.settings.getlist("WELL_PRIORITY_COUNTIES")
+        )
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        spider.shard_role = crawler.settings.get("SHARD_ROLE")
+        if spider.shard_role:
+            spider.shard_queue = ShardQueue(crawler.settings.get("SHARD_QUEUE", "shards.sqlite"))
+            spider.worker = worker_name()
+            crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        if crawler.settings.get("CHECKPOINT_PATH"):
+            spider.checkpoint = Checkpoint(crawler.settings.get("CHECKPOINT_PATH"))
+            spider.session_ttl = crawler.settings.getfloat("CHECKPOINT_SESSION_TTL", 3600)
+            crawler.signals.connect(spider.item_dropped, signal=signals.item_dropped)
+        if crawler.settings.getbool("INSTRUMENTATION_ENABLED"):
+            spider.metrics = Metrics()
+        if crawler.settings.getint("WELL_REPORT_PROCESSES"):
+            spider.pool = WellReportPool(
+                crawler.settings.getint("WELL_REPORT_PROCESSES"), crawler.settings.getint("WELL_REPORT_MAX_IN_FLIGHT")
+            )
+        crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        return spider
+
+    @property
+    def collection(self):
+        if self.client is None:
+            self.client = pymongo.MongoClient(self.mongo_uri)
+        return self.client[self.mongo_db][self.mongo_collection]
+
+    def spider_opened(self, spider):
+        if self.incremental:
+            self.persisted = load_fingerprint_index(self.collection)
+            self.logger.info("Incremental crawl: %d wells already stored", len(self.persisted))
+
+    def start_requests(self):
+        if self.archive_mode != "replay":
+            yield from self.resume_or_start()
+            return
+        archive = ResponseArchive(self.archive_dir)
+        archive.load_index()
+        for url in archive.urls("index"):
+            yield scrapy.Request(url=url, callback=self.parse_production_report, dont_filter=True)
+        if not archive.urls("index") and self.permit_table_url:
+            # Recorded in fragments mode; the permit tables are requested again and answered from the archive
+            for url in archive.urls("page"):
+                yield scrapy.Request(url=url, callback=self.request_permit_tables, dont_filter=True)
+
+    def resume_or_start(self):
+        """
+        Resume the wells and township permit tables left pending by an interrupted crawl. The saved session is tried
+        first with a single well; only if it is no longer valid do we log in again.
+        :return:
+        """
+        if self.checkpoint is None:
+            yield from super().start_requests()
+            return
+        pending = self.checkpoint.pending_rows()
+        townships = self.checkpoint.pending_townships()
+        if not pending and not townships:
+            self.checkpoint.reset()
+            yield from super().start_requests()
+            return
+        self.resume_rows = pending
+        self.resume_townships = townships
+        self.crawler.stats.set_value("checkpoint/resumed_wells", len(pending))
+        self.crawler.stats.set_value("checkpoint/resumed_townships", len(townships))
+        self.logger.info("Resuming %d wells and %d townships from the checkpoint" % (len(pending), len(townships)))
+        cookies = self.checkpoint.session(self.session_ttl)
+        if cookies is None or not pending:
+            yield from super().start_requests()
+            return
+        probe = self.well_report_request(pending[0])
+        yield probe.replace(cookies=cookies, callback=self.parse_resume_probe, dont_filter=True)
+
+    def parse_resume_probe(self, response):
+        if self.is_login_page(response):
+            self.logger.info("Saved session expired, logging in again")
+            yield from super().start_requests()
+            return
+        self.crawler.stats.set_value("checkpoint/session_reused", True)
+        # Logged in; a well without a report is failed like any other
+        item = self.parse_well_report(response)
+        if item is not None:
+            yield item
+        yield from self.resume_requests(self.resume_rows[1:])
+
+    def is_login_page(self, response):
+        # An expired session is redirected to the login form
+        return "well_id=" not in response.url or bool(response.xpath("//input[@name='PASSWORD']"))
+
+    def resume_requests(self, rows):
+        """
+        :param rows: Pending well rows to request
+        :return: Generator of the well report requests and the permit table requests of the pending townships
+        """
+        for row in rows:
+            yield self.well_report_request(row)
+        for township in self.resume_townships or ():
+            yield self.permit_table_request(township)
+
+    def save_session(self, response):
+        cookie_header = response.request.headers.get("Cookie")
+        if not cookie_header:
+            return
+        self.session = dict(
+            cookie.strip().split("=", 1) for cookie in cookie_header.decode("latin-1").split(";") if "=" in cookie
+        )
+        if self.checkpoint is not None:
+            self.checkpoint.save_session(self.session)
 
     def parse(self, response):
         # If you need a CSRF token, do it first
         return FormRequest.from_response(
             response,
             callback=self.start_scraping,
+            # Recorded by the response archive, see `marcellus.middlewares.ResponseArchiveMiddleware`
+            meta={"production_report_page": True},
             formdata={
                 "action": "login",
                 "redirect": "pro_update.php",
@@ -42,41 +253,278 @@ class MarcellusSpider(scrapy.Spider):
             },
         )
 
+    def spider_idle(self, spider):
+        """
+        A worker has finished its county; mark it done and claim the next one
+        :param spider:
+        :return:
+        """
+        if self.shard_role != "worker" or self.worker is None:
+            return
+        scheduled = False
+        for request in self.next_shard():
+            self.schedule(request)
+            scheduled = True
+        if scheduled:
+            raise DontCloseSpider
+
+    def schedule(self, request):
+        """
+        Hand a request to the engine outside of a callback. Scrapy before 2.6 requires the spider as well, later
+        versions deprecate it and then drop the argument.
+        :param request:
+        :return:
+        """
+        crawl = self.crawler.engine.crawl
+        spider = inspect.signature(crawl).parameters.get("spider")
+        if spider is not None and spider.default is inspect.Parameter.empty:
+            crawl(request, self)
+        else:
+            crawl(request)
+
+    def spider_closed(self, spider, reason):
+        if self.shard_role == "worker":
+            # An unfinished county goes back to the queue for the next worker
+            self.shard_queue.release(self.worker)
+            self.shard_queue.save_stats(self.worker, self.crawler.stats.get_stats())
+        if self.shard_queue is not None:
+            self.shard_queue.close()
+        if self.checkpoint is not None:
+            done, failed, total = self.checkpoint.progress()
+            self.logger.info("Checkpoint: %d of %d wells written, %d failed" % (done, total, failed))
+            townships = len(self.checkpoint.pending_townships())
+            if townships:
+                # Their wells are not in the frontier yet; the next crawl resumes them
+                self.crawler.stats.set_value("checkpoint/pending_townships", townships)
+                self.logger.warning("Checkpoint: %d township permit tables not read" % townships)
+            elif reason == "finished":
+                # Nothing to resume; the next crawl reads the index again
+                self.checkpoint.reset()
+            self.checkpoint.close()
+        if self.pool is not None:
+            self.pool.close()
+        if self.client is not None:
+            self.client.close()
+
+    def next_shard(self):
+        """
+        Claim counties until one still has wells to download
+        :return: Generator of well report requests
+        """
+        while True:
+            if self.shard is not None:
+                self.shard_queue.finish(self.shard)
+                self.crawler.stats.inc_value("shards/done")
+            self.shard = self.shard_queue.claim(self.worker)
+            if self.shard is None:
+                return
+            rows = self.shard_queue.rows(self.shard)
+            self.logger.info("Claimed county %s with %d wells" % (self.shard, len(rows)))
+            if rows:
+                for row in rows:
+                    yield self.well_report_request(row)
+                return
+
     def start_scraping(self, response):
-        yield scrapy_splash.SplashRequest(url=response.url, callback=self.parse_production_report, args={"wait": 2})
+        self.save_session(response)
+        if self.resume_rows or self.resume_townships:
+            # Logged in again; only the wells and townships left over from the interrupted crawl are needed
+            yield from self.resume_requests(self.resume_rows)
+            return
+        if self.shard_role == "worker":
+            # Logged in; the well rows come from the shard queue
+            yield from self.next_shard()
+            return
+        if self.index_fetch_mode == "fragments" and self.permit_table_url:
+            yield from self.request_permit_tables(response)
+        else:
+            yield self.render_production_report(response.url)
+
+    def render_production_report(self, url):
+        if self.splash_render_mode == "lua":
+            # SplashCookiesMiddleware passes the session cookies to the script
+            return scrapy_splash.SplashRequest(
+                url=url,
+                callback=self.parse_production_report,
+                endpoint="execute",
+                args=production_report_args(self.splash_wait_timeout),
+                cookies=self.session or {},
+                dont_filter=True,
+            )
+        return scrapy_splash.SplashRequest(
+            url=url, callback=self.parse_production_report, args={"wait": 2}, dont_filter=True
+        )
+
+    def request_permit_tables(self, response):
+        """
+        Read the county/township structure from the page as served and request every township permit table as a
+        plain request, in parallel. Without the structure the page needs JavaScript after all; render it in Splash.
+        :param response: The production report page, not rendered
+        :return:
+        """
+        townships = list(iter_townships(response.selector.root))
+        if not townships:
+            self.logger.info("No townships on the unrendered production report, falling back to Splash")
+            yield self.fall_back_to_splash(response.url)
+            return
+        self.crawler.stats.set_value("fragments/townships", len(townships))
+        townships = [
+            {"county": county, "township": township, "permit_link": permit_link, "index_url": response.url}
+            for county, township, permit_link, _ in townships
+        ]
+        if self.checkpoint is not None:
+            self.checkpoint.add_townships(townships)
+        for township in townships:
+            yield self.permit_table_request(township)
+
+    def permit_table_request(self, township):
+        return scrapy.Request(
+            url=f"{self.BASE_URL}{self.permit_table_url.format(link=township['permit_link'])}",
+            callback=self.parse_permit_table,
+            errback=self.permit_table_failed,
+            # Well reports from tables already parsed go first
+            priority=-1,
+            meta=dict(township),
+        )
+
+    def parse_permit_table(self, response):
+        self.crawler.stats.inc_value("fragments/tables")
+        rows = list(iter_fragment_rows(response.selector.root, response.meta["permit_link"]))
+        for row in rows:
+            row["county"] = response.meta["county"]
+            row["township"] = response.meta["township"]
+        yield from self.request_well_reports(rows)
+        if self.checkpoint is not None:
+            self.checkpoint.complete_townships([response.meta["permit_link"]])
+
+    def permit_table_failed(self, failure):
+        self.crawler.stats.inc_value("fragments/failed")
+        self.logger.warning("Permit table failed: %s" % failure.request.url)
+        request = self.fall_back_to_splash(failure.request.meta["index_url"])
+        if request is not None:
+            yield request
+
+    def fall_back_to_splash(self, url):
+        """
+        Render the whole production report once. Wells already requested are dropped by the dupefilter.
+        :param url:
+        :return: SplashRequest or None if the fallback already happened
+        """
+        if self.splash_fallback:
+            return None
+        self.splash_fallback = True
+        self.crawler.stats.set_value("fragments/splash_fallback", True)
+        return self.render_production_report(url)
 
     def parse_production_report(self, response):
+        """
+        Request the well reports of every township as soon as its table is parsed
+        :param response: The rendered production report
+        :return:
+        """
+        if getattr(response, "data", None) and response.data.get("timed_out"):
+            self.crawler.stats.set_value("splash/render_timed_out", True)
+            self.logger.warning("The permit tables did not finish loading in Splash, parsing what is there")
+        for rows in self.iter_township_rows(response):
+            yield from self.request_well_reports(rows)
+        if self.checkpoint is not None and not self.crawler.stats.get_value("splash/render_timed_out"):
+            # Every permit table was on the page
+            self.checkpoint.complete_townships()
+
+    def iter_township_rows(self, response):
+        """
+        :param response: The rendered production report
+        :return: Generator of the row lists of every township
+        """
+        if self.index_page_parser != "lxml":
+            yield from self.iter_township_rows_by_xpath(response)
+            return
+        for county, township, permit_link, permits in iter_townships(response.selector.root):
+            if permits is None:
+                continue
+            rows = list(iter_permit_rows(permits, permit_link))
+            for row in rows:
+                row["county"] = county
+                row["township"] = township
+            yield rows
+
+    def request_well_reports(self, data):
+        # This is where the magic of all the data comes from!
+        # Download each of the links to all the well reports and download the reports for those wells.
+        rows = list()
+        for row in data:
+            if self.incremental and self.check_for_persisted(row):
+                self.crawler.stats.inc_value("incremental/unchanged")
+                continue
+            rows.append(row)
+        if self.shard_role == "plan":
+            if rows:
+                self.shard_queue.add_rows(rows)
+                self.crawler.stats.inc_value("shards/planned_wells", len(rows))
+            return
+        if self.checkpoint is not None:
+            # Persist the frontier before the requests leave. Wells already in it are requested by the resume or
+            # were requested before.
+            rows = self.checkpoint.add_rows(rows)
+        for row in rows:
+            yield self.well_report_request(row)
+
+    def well_report_request(self, row):
+        link = row["link"]
+        return scrapy.Request(
+            url=f"{self.BASE_URL}{link}",
+            callback=self.parse_well_report if self.pool is None else self.parse_well_report_offloaded,
+            errback=self.well_report_failed,
+            priority=self.priority(row),
+            meta={"row": row},
+        )
+
+    def well_report_failed(self, failure):
+        self.logger.error("Well report failed: %s" % failure.request.url)
+        if self.shard_role == "worker":
+            self.shard_queue.mark_well(failure.request.meta["row"]["link"], "failed")
+        if self.checkpoint is not None:
+            self.checkpoint.fail([failure.request.meta["row"]["link"]])
+
+    def item_dropped(self, item, response, exception, spider):
+        # A dropped well is never written; don't request it again on resume
+        if item.get("well_report_link"):
+            self.checkpoint.fail([item["well_report_link"]])
+
+    def get_production_report_rows(self, response):
+        return [row for rows in self.iter_township_rows_by_xpath(response) for row in rows]
+
+    def iter_township_rows_by_xpath(self, response):
         counties = self.get_county_names(response)
         county_ids = self.get_county_ids(response)
 
-        county_dict = dict()
-        data = list()
-
-        # Scrape the production report page to gather all the table data; county, township, well_name, link_to_report
+        # Scrape the production report page to gather the table data of every township; county, township, well_name,
+        # link_to_report
         for county_idx, county in enumerate(county_ids):
             townships = self.get_townships_by_county_id(response, county)
-            county_dict[county] = {"townships": townships}
-            county_dict[county]["links"] = self.get_townships_link_by_county_id(response, county)
-            for idx, link in enumerate(county_dict[county]["links"]):
+            links = self.get_townships_link_by_county_id(response, county)
+            for idx, link in enumerate(links):
                 table_rows = self.get_table_rows(response, link)
-                county_dict[county][townships[idx]] = table_rows
                 # Get all the wells in the county/township
                 for row in table_rows:
                     row["county"] = counties[county_idx]
                     row["township"] = townships[idx]
-                # Update `data` with the wells from county/township
-                data += table_rows
-
-        # This is where the magic of all the data comes from!
-        # Download each of the links to all the well reports and download the reports for those wells.
-        for row in data:
-            link = row["link"]
-            yield scrapy.Request(url=f"{self.BASE_URL}{link}", callback=self.parse_well_report, meta={"row": row})
+                yield table_rows
 
     def check_for_persisted(self, row):
-        parsed_name = row["well_name"].replace(" ", "_").lower()
-        record = self.collection.find_one({"well_name": parsed_name})
-        return True if record is not None else False
+        """
+        Is the well already stored with the same summary values as shown in the index row?
+        :param row: Row dict built by `get_table_rows`
+        :return: True if the well report does not need to be downloaded again
+        """
+        key = index_key(self.persisted, normalize_well_name(row["well_name"]), row.get("permit_number"))
+        if key not in self.persisted:
+            self.crawler.stats.inc_value("incremental/new")
+            return False
+        if self.persisted[key] != row_fingerprint(row):
+            self.crawler.stats.inc_value("incremental/changed")
+            return False
+        return True
 
     def parse_well_report(self, response):
         """
@@ -85,61 +533,83 @@ class MarcellusSpider(scrapy.Spider):
         :param response:  Result response object from the well_id-well production report
         :return:
         """
+        well_id = self.get_well_id(response)
+
+        # Follow the link
+        if self.metrics is None:
+            item = self.parse_by_well_id(response, well_id, row=response.meta["row"])
+        else:
+            with self.metrics.timer("parse_by_well_id"):
+                item = self.parse_by_well_id(response, well_id, row=response.meta["row"])
+        self.mark_well(response, item)
+        return item
+
+    async def parse_well_report_offloaded(self, response):
+        """
+        `parse_well_report` with the extraction and cleaning done in the process pool
+        :param response:
+        :return: Item with the cleaned report, or None when the report is missing
+        """
+        well_id = self.get_well_id(response)
+        started = time.perf_counter()
+        try:
+            records = await self.pool.parse_well_report(response.text, well_id, self.well_report_parser)
+        except Exception:
+            self.logger.exception("Well report %s failed in the process pool" % well_id)
+            records = None
+        if self.metrics is not None:
+            self.metrics.observe("parse_offloaded", time.perf_counter() - started)
+        item = self.build_item(response.meta["row"], records) if records is not None else None
+        self.mark_well(response, item)
+        return item
+
+    def get_well_id(self, response):
         # Split the URL where the parameters being.
         page = response.url.split(".php?")[-1]
 
         # Get the well_id from the remaining part of the URL
-        well_id = re.match(r".*well_id=([0-9]+)", page).group(1)
+        return re.match(r".*well_id=([0-9]+)", page).group(1)
 
-        # Follow the link
-        return self.parse_by_well_id(response, well_id, row=response.meta["row"])
+    def mark_well(self, response, item):
+        if self.shard_role == "worker":
+            self.shard_queue.mark_well(response.meta["row"]["link"], "done" if item is not None else "failed")
+        if item is None and self.checkpoint is not None:
+            # The page has no report; retrying won't change that
+            self.checkpoint.fail([response.meta["row"]["link"]])
 
     def parse_by_well_id(self, response, well_id, row):
-        # Get the desired DOM element
-        dom = response.xpath(f"//div[@id='pro_{well_id}']").extract()
-        if len(dom) == 0:
+        if self.well_report_parser == "lxml":
+            report_dict = self.get_report_from_tree(response, well_id)
+        else:
+            report_dict = self.get_report_from_markup(response, well_id)
+        if report_dict is None:
             return
+        return self.build_item(row, report_dict)
 
-        # Sometimes errors occur
-        try:
-            # Extract the first (and only) element
-            dom = dom[0]
-
-            # Replace all the whitespace characters with null strings
-            no_ws = re.sub(r"\s", "", dom)
-
-            # Remove all the HTMl tags. Replace those tags with newline characters
-            no_tags = re.sub(r"<.*?>", "\n", no_ws)
-        except Exception as e:
-            self.logger.exception(e)
-            return
-        # Split into a nice list
-        list_report = re.split(r"\n+", no_tags)
-
-        # This is the itertools.groupby method, not the pandas groupby. It works differently!
-        # The list is split each time the lambda function is True. This allows for unique keys to
-        # be creates where the `OperatingPeriod` is the key
-        unique_keys = list()
-        groups = list()
-        for k, g in groupby(list_report, lambda x: "OperatingPeriod" in x):
-            unique_keys.append(k)
-            groups.append(list(g))
-
-        # Create a dict object out of the iterrated report
-        report_dict = {}
-        for idx, (key, group) in enumerate(zip(unique_keys, groups)):
-            # if key is True means that the element of groups[idx][0] has 'OperatingPeriod' in the string.
-            # The 'OperatingPeriod' becomes the key for the remaining fields of the report
-            if key is True:
-                report_dict[groups[idx][0]] = groups[idx + 1]
-
+    def build_item(self, row, production_report):
+        """
+        :param row: Index row of the well
+        :param production_report: Report as read by the regex parser, or cleaned records from the lxml parser or the
+            process pool
+        :return:
+        """
         prod_report = ProductionReport()
         prod_report["county"] = row["county"]
         prod_report["township"] = row["township"]
         prod_report["well_name"] = row["well_name"]
-        prod_report["production_report"] = report_dict
+        prod_report["production_report"] = production_report
+        prod_report["fingerprint"] = row_fingerprint(row)
+        prod_report["well_report_link"] = row["link"]
+        if row.get("permit_number"):
+            prod_report["permit_number"] = row["permit_number"]
         return prod_report
 
+    def get_report_from_tree(self, response, well_id):
+        return report_from_tree(response, well_id)
+
+    def get_report_from_markup(self, response, well_id):
+        return report_from_markup(response, well_id)
+
     def parse_production_report_table(self, response):
         return response.xpath('//*[@id="proData"]')
 
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Local stand-in for marcellusgas.org and Splash.
+#
+# Serves the login form, the production report index (as served, and rendered through Splash-compatible `render.html`
+# and `execute` endpoints), the township permit table fragments and synthetic well reports, all generated by
+# `marcellus.synthetic`. Latency, errors and session loss can be injected to exercise throttling and throughput locally:
+#
+#     python -m marcellus.standin --port 8080 --wells 2000 --latency 0.3 --jitter 0.1
+#     scrapy crawl marcellus -s MARCELLUS_BASE_URL=http://localhost:8080 -s SPLASH_URL=http://localhost:8080
+import argparse
+import json
+import random
+from urllib.parse import parse_qs, urlparse
+from twisted.internet import reactor
+from twisted.web import resource, server
+from marcellus import synthetic
+
+LOGIN_PAGE = """<html><body>
+<form method="post" action="/login.php">
+<input type="hidden" name="action" value="login"><input type="hidden" name="redirect" value="pro_update.php">
+<input type="text" name="EMAIL"><input type="password" name="PASSWORD"><input type="submit" value="Login">
+</form></body></html>"""
+
+
+class StandIn(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.index = synthetic.index_page(args.counties, args.wells, args.townships, args.seed).encode("utf-8")
+        self.skeleton = synthetic.index_page(args.counties, args.wells, args.townships, args.seed, tables=False)
+        self.skeleton = self.skeleton.encode("utf-8")
+        # What the Lua render returns, see `marcellus.render`
+        self.fragment = self.index[self.index.index(b'<div id="proData">') : self.index.rindex(b"</body>")]
+        self.townships = synthetic.township_wells(args.counties, args.wells, args.townships, args.seed)
+        self.served = 0
+        self.sessions = set()
+
+    def render_GET(self, request):
+        return self.delay(request)
+
+    def render_POST(self, request):
+        return self.delay(request)
+
+    def delay(self, request):
+        latency = max(0.0, self.rng.gauss(self.args.latency, self.args.jitter))
+        if request.path in (b"/render.html", b"/execute"):
+            latency += self.args.render_latency
+        call = reactor.callLater(latency, self.respond, request)
+        request.notifyFinish().addErrback(lambda _: call.cancel() if call.active() else None)
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        path = request.path.decode("utf-8")
+        status, body = self.route(path, request)
+        request.setResponseCode(status)
+        if status == 302:
+            request.setHeader(b"location", body)
+            body = b""
+        if not request.responseHeaders.hasHeader(b"content-type"):
+            request.setHeader(b"content-type", b"text/html; charset=utf-8")
+        request.write(body)
+        request.finish()
+
+    def route(self, path, request):
+        if path == "/robots.txt":
+            return 200, b"User-agent: *\nAllow: /\n"
+        if path == "/login.php":
+            if request.method == b"POST":
+                session = "%032x" % self.rng.getrandbits(128)
+                self.sessions.add(session)
+                request.addCookie(b"PHPSESSID", session.encode("ascii"), path=b"/")
+                return 302, b"/pro_update.php"
+            return 200, LOGIN_PAGE.encode("utf-8")
+        if path == "/pro_update.php":
+            return 200, self.skeleton
+        if path == "/render.html":
+            return 200, self.index
+        if path == "/execute":
+            return self.execute(request)
+        if path == "/pro_permits.php":
+            muni = int(parse_qs(urlparse(request.uri.decode("utf-8")).query).get("muni", ["-1"])[0])
+            if muni not in self.townships and not 0 <= muni < self.args.counties * self.args.townships:
+                return 404, b"<html><body>Not found</body></html>"
+            return 200, synthetic.permit_table(muni, self.townships.get(muni, ())).encode("utf-8")
+        if path == "/pro_well.php":
+            return self.well_report(request)
+        return 404, b"<html><body>Not found</body></html>"
+
+    def execute(self, request):
+        """
+        The Lua render of the production report: only `#proData`, and only for a logged in session
+        """
+        args = json.loads(request.content.read() or b"{}")
+        cookies = args.get("cookies") or []
+        session = next((cookie["value"] for cookie in cookies if cookie.get("name") == "PHPSESSID"), None)
+        request.setHeader(b"content-type", b"application/json")
+        if self.args.require_session and session not in self.sessions:
+            # Splash would wait on the login page until the timeout
+            html, timed_out = "", True
+        else:
+            html, timed_out = self.fragment.decode("utf-8"), False
+        result = {"html": html, "url": args.get("url"), "cookies": cookies, "timed_out": timed_out}
+        return 200, json.dumps(result).encode("utf-8")
+
+    def well_report(self, request):
+        self.served += 1
+        if self.args.session_limit and self.served > self.args.session_limit:
+            return 302, b"/login.php"
+        if self.args.require_session and (request.getCookie(b"PHPSESSID") or b"").decode("ascii") not in self.sessions:
+            return 302, b"/login.php"
+        if self.rng.random() < self.args.error_rate:
+            return 500, b"<html><body>Server error</body></html>"
+        query = parse_qs(urlparse(request.uri.decode("utf-8")).query)
+        well_id = int(query.get("well_id", ["0"])[0])
+        return 200, synthetic.well_report_page(well_id, self.args.periods, self.args.seed).encode("utf-8")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for marcellusgas.org and Splash")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--counties", type=int, default=10)
+    parser.add_argument("--townships", type=int, default=10, help="Townships per county")
+    parser.add_argument("--wells", type=int, default=2000)
+    parser.add_argument("--periods", type=int, default=24)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Standard deviation of the latency")
+    parser.add_argument("--render-latency", type=float, default=0.0, help="Extra seconds for a Splash render")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of well reports answered with 500")
+    parser.add_argument("--session-limit", type=int, default=0, help="Redirect to login after this many reports")
+    parser.add_argument("--require-session", action="store_true", help="Only serve well reports to logged in sessions")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    reactor.listenTCP(args.port, server.Site(StandIn(args)))
+    print(json.dumps(vars(args)))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
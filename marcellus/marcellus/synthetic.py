@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Synthetic marcellusgas.org pages for benchmarks.
+#
+# The markup follows what the spider reads: `munilink_*` county anchors, `munis_*` township lists, `permits_*` well
+# tables on the rendered production report, and `pro_{well_id}` divs with one table per operating period on the well
+# reports.
+import random
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+COMPANIES = ("Chesapeake Appalachia LLC", "Range Resources &amp; Co", "Cabot Oil &amp; Gas", "EQT Production", "SWN")
+BASE_YEAR = 2010
+
+
+def index_rows(counties=60, wells=20000, townships_per_county=20, seed=0):
+    """
+    Rows of the production report index, spread evenly over counties and townships
+    :return: List of (county number, township number, well_id)
+    """
+    rng = random.Random(seed)
+    townships = counties * townships_per_county
+    rows = [(well_id, rng.randrange(townships)) for well_id in range(1, wells + 1)]
+    rows.sort(key=lambda row: row[1])
+    return [(township // townships_per_county, township, well_id) for well_id, township in rows]
+
+
+def township_wells(counties=60, wells=20000, townships_per_county=20, seed=0):
+    """
+    :return: {township number: [well_id, ...]}
+    """
+    by_township = dict()
+    for _, township, well_id in index_rows(counties, wells, townships_per_county, seed):
+        by_township.setdefault(township, list()).append(well_id)
+    return by_township
+
+
+def index_page(counties=60, wells=20000, townships_per_county=20, seed=0, tables=True):
+    """
+    Production report page
+    :param tables: False gives the page as served before the JavaScript loads the permit tables
+    :return: HTML str
+    """
+    by_township = township_wells(counties, wells, townships_per_county, seed)
+    parts = ['<html><body><div id="proData">']
+    for county in range(counties):
+        parts.append(f'<a id="munilink_{county}" href="#">+ County{county}</a><div id="munis_{county}">')
+        for township in range(county * townships_per_county, (county + 1) * townships_per_county):
+            parts.append(f'<a id="township_{township}" href="#">+ Township {township}</a>')
+            if tables:
+                parts.append(permit_table(township, by_township.get(township, ())))
+            else:
+                parts.append(f'<div id="permits_{township}"></div>')
+        parts.append("</div>")
+    parts.append("</div></body></html>")
+    return "".join(parts)
+
+
+def permit_table(township, well_ids):
+    parts = [
+        f'<div id="permits_{township}"><table><tbody>'
+        "<tr><th>Well</th><th>Royalty</th><th>Market Value</th><th>MCF</th><th>Report</th><th>Start</th>"
+        "<th>Permit</th></tr>"
+    ]
+    for position, well_id in enumerate(well_ids):
+        parts.append(index_row(well_id, position))
+    parts.append("</tbody></table></div>")
+    return "".join(parts)
+
+
+def index_row(well_id, position):
+    mcf = well_id * 37 % 900000
+    return (
+        f'<tr class="record_book_row{position % 2}">'
+        f"<td><b> Well {well_id} {well_id % 9 + 1}H </b></td>"
+        f"<td><nobr>${mcf * 0.4:,.2f}</nobr></td>"
+        f"<td><nobr>${mcf * 3.1:,.2f}</nobr></td>"
+        f"<td><nobr>{mcf:,}</nobr></td>"
+        f'<td><span><a href="/pro_well.php?well_id={well_id}">Report</a></span></td>'
+        f"<td><span>{BASE_YEAR + well_id % 10}-0{well_id % 9 + 1}-15</span></td>"
+        f"<td><span>{37 + well_id % 100:03d}-{well_id:05d}</span></td>"
+        "</tr>"
+    )
+
+
+def well_report_page(well_id, periods=120, seed=0):
+    """
+    Well report with one table per monthly operating period
+    :param well_id:
+    :param periods: Number of operating periods (120 = 10 years)
+    :param seed:
+    :return: HTML str
+    """
+    rng = random.Random(seed * 1000003 + well_id)
+    company = COMPANIES[well_id % len(COMPANIES)]
+    parts = [f'<html><body><h1>Well {well_id}</h1><div id="pro_{well_id}">\n']
+    gas = rng.randint(50000, 900000)
+    for period in range(periods):
+        month = MONTHS[period % 12]
+        year = BASE_YEAR + period // 12
+        days = rng.randint(25, 31)
+        gas = int(gas * rng.uniform(0.9, 1.0))
+        value = gas * rng.uniform(1.5, 4.0)
+        parts.append(
+            '<table class="production">\n'
+            f"  <tr><td colspan=2><b>Operating Period: {month} {year} - {month} {year}</b></td></tr>\n"
+            f"  <tr><td>Production Company:</td><td>{company}</td></tr>\n"
+            f"  <tr><td>Quantity of Gas:</td><td>{gas:,} Mcf</td></tr>\n"
+            f"  <tr><td>Value of Gas:</td><td>${value:,.2f} (wellhead)</td></tr>\n"
+            f"  <tr><td>Est. Royalties:</td><td>${value * 0.125:,.2f} (12.5%)</td></tr>\n"
+            f"  <tr><td>Operating Days:</td><td>{days} days</td></tr>\n"
+            f"  <tr><td>Avg Production Per Day:</td><td>{gas // days:,} Mcf :${value / days:,.2f} (per day)</td></tr>\n"
+            f"  <tr><td>crowdsourced ATW:</td><td>{rng.uniform(50, 99):.1f} / 100</td></tr>\n"
+            "</table>\n"
+        )
+    parts.append("</div></body></html>")
+    return "".join(parts)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Well x period layout of the production reports.
+#
+# Next to the well documents with their embedded `production_report`, MongoDBPipeline can keep one document per
+# operating period in MONGO_PERIOD_COLLECTION. Period and county queries then run on compound indexes instead of
+# scanning every embedded array. A document is keyed by the well key (well_name, permit_number), the same as the wells
+# themselves (see `marcellus.upserts`), the period and its `sequence` within the period: a well can report several
+# operating periods in one month, numbered from 0 in report order. Count wells on `sequence` 0, sum values over all
+# documents. `python -m marcellus.timeseries migrate` fills the collection from existing wells.
+import argparse
+import pymongo
+from scrapy.utils.project import get_project_settings
+from marcellus import compact
+
+WELL_FIELDS = ("well_name", "permit_number", "county", "township")
+
+KEY_FIELDS = ("well_name", "permit_number", "period", "sequence")
+
+INDEXES = (
+    ([("period", pymongo.ASCENDING), ("county", pymongo.ASCENDING)], {"name": "period_county"}),
+    ([(field, pymongo.ASCENDING) for field in KEY_FIELDS], {"name": "well_permit_period_sequence", "unique": True}),
+)
+
+# Keyed without the permit number or the sequence, they merged wells sharing a name and operating periods sharing a
+# month
+DROPPED_INDEXES = ("well_period", "well_permit_period")
+
+
+def ensure_indexes(periods):
+    """
+    Create the compound indexes and drop the ones they replace. Safe to call on every start.
+    :param periods: Period collection
+    :return:
+    """
+    existing = periods.index_information()
+    for name in DROPPED_INDEXES:
+        if name in existing:
+            periods.drop_index(name)
+    for keys, options in INDEXES:
+        periods.create_index(keys, **options)
+
+
+def period_documents(document):
+    """
+    Flatten a cleaned well document into one document per operating period
+    :param document: Well document with `production_report` or `compact_report`
+    :return: Generator of period documents
+    """
+    well = {field: document.get(field) for field in WELL_FIELDS}
+    sequences = dict()
+    for record in compact.report_records(document):
+        period_document = dict(well)
+        period_document.update(record)
+        period_document["sequence"] = sequences.get(record.get("period"), 0)
+        sequences[record.get("period")] = period_document["sequence"] + 1
+        yield period_document
+
+
+def period_updates(documents):
+    """
+    Upserts keyed by KEY_FIELDS, so re-crawls replace periods instead of duplicating them. The records of a period
+    are always written together; sequences past the last one are left over from a period that lost a record and are
+    deleted.
+    :param documents: Well documents, with every record of the periods to write
+    :return: List of write operations
+    """
+    operations = list()
+    for document in documents:
+        lengths = dict()
+        for period in period_documents(document):
+            operations.append(
+                pymongo.ReplaceOne({field: period.get(field) for field in KEY_FIELDS}, period, upsert=True)
+            )
+            lengths[period.get("period")] = period["sequence"] + 1
+        for period, length in lengths.items():
+            selector = {field: document.get(field) for field in KEY_FIELDS[:2]}
+            operations.append(pymongo.DeleteMany(dict(selector, period=period, sequence={"$gte": length})))
+    return operations
+
+
+def migrate(collection, periods, batch_size=500):
+    """
+    Copy the embedded production reports of every stored well into the period collection
+    :param collection: Well collection
+    :param periods: Period collection
+    :param batch_size: Wells per bulk write
+    :return: Number of wells migrated
+    """
+    ensure_indexes(periods)
+    projection = dict.fromkeys(WELL_FIELDS + ("production_report", "compact_report"), 1)
+    cursor = collection.find({}, projection=projection, batch_size=batch_size)
+    batch = list()
+    count = 0
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            count += write(periods, batch)
+            batch = list()
+    if batch:
+        count += write(periods, batch)
+    return count
+
+
+def write(periods, documents):
+    updates = period_updates(documents)
+    if updates:
+        periods.bulk_write(updates, ordered=False)
+    return len(documents)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the well x period collection")
+    parser.add_argument("command", choices=("migrate", "ensure-indexes"))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    db = client[settings.get("MONGO_DATABASE", "marcellus")]
+    periods = db[settings.get("MONGO_PERIOD_COLLECTION") or "report.periods"]
+    if args.command == "migrate":
+        count = migrate(db[settings.get("MONGO_COLLECTION", "report.production")], periods, args.batch_size)
+        print(f"{count} wells migrated to {periods.full_name}")
+    else:
+        ensure_indexes(periods)
+        print(f"Indexes ready on {periods.full_name}")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
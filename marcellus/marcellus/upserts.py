@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# Idempotent delta writes of the well documents.
+#
+# A well is keyed by (well_name, permit_number) and carries a hash of every cleaned period in `period_hashes`. A well can
+# report several operating periods in the same month, so a period is all the records of its month, hashed together.
+# When a re-crawl brings the well back and only adds periods, the new records get `$push`ed; when a stored period
+# changed, the report is merged period by period over the stored one and written whole. A well that did not change is
+# not written at all. The same comparison gives the signed rollup increments and the periods to upsert into the well x
+# period collection.
+# `python -m marcellus.upserts migrate` removes the duplicates older crawls inserted and backfills the hashes.
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import pymongo
+from pymongo.errors import OperationFailure
+from scrapy.utils.project import get_project_settings
+from marcellus import compact, generation, rollups, timeseries, wells
+
+logger = logging.getLogger(__name__)
+
+HASH_FIELD = "period_hashes"
+
+# Well fields refreshed on every write
+WELL_FIELDS = ("county", "township", "well_name", "permit_number", "fingerprint", "well_report_link")
+
+LOOKUP_PROJECTION = {
+    "well_name": 1,
+    "permit_number": 1,
+    "fingerprint": 1,
+    HASH_FIELD: 1,
+    "compact_report.version": 1,
+}
+
+REPORT_PROJECTION = {"production_report": 1, "compact_report": 1}
+
+Plan = collections.namedtuple("Plan", ("operations", "deltas", "periods", "counts"))
+
+
+def period_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def period_groups(records):
+    """
+    :param records: Cleaned records of a well
+    :return: {period: [records of the period in report order]}, in the order the periods first appear
+    """
+    groups = dict()
+    for record in records:
+        groups.setdefault(record.get("period"), list()).append(record)
+    return groups
+
+
+def group_hash(group):
+    # A period with a single record hashes like the record alone, as before periods were grouped
+    return period_hash(group[0]) if len(group) == 1 else period_hash(group)
+
+
+def period_hashes(records):
+    return {str(period): group_hash(group) for period, group in period_groups(records).items()}
+
+
+def well_key(document):
+    return document.get("well_name"), document.get("permit_number")
+
+
+def ensure_indexes(collection):
+    """
+    Unique index on the well key, and indexes on the write time for incremental exports and on the permit numbers for
+    the well search. Collections written by older crawls hold duplicates and need `python -m marcellus.upserts migrate`
+    first.
+    :param collection: Well collection
+    :return: True if the index is in place
+    """
+    collection.create_index("updated", name="updated")
+    wells.ensure_indexes(collection)
+    try:
+        collection.create_index(
+            [("well_name", pymongo.ASCENDING), ("permit_number", pymongo.ASCENDING)], name="well_permit", unique=True
+        )
+    except OperationFailure as error:
+        logger.error("Unique well index not created, run `python -m marcellus.upserts migrate`: %s", error)
+        return False
+    return True
+
+
+def plan(collection, documents, now=None):
+    """
+    Compare a batch of well documents with what is stored and plan the delta writes
+    :param collection: Well collection
+    :param documents: Well documents, see `marcellus.compact.to_document`
+    :param now: Time stamp of the write, stored as `updated`
+    :return: Plan of write operations, signed rollup increments, period documents to upsert and counts
+    """
+    now = now or datetime.datetime.utcnow()
+    # The last document of a well in the batch wins
+    documents = list({well_key(document): document for document in documents}.values())
+    stored = dict()
+    by_name = collections.defaultdict(list)
+    names = list({document.get("well_name") for document in documents})
+    for match in collection.find({"well_name": {"$in": names}}, LOOKUP_PROJECTION):
+        if well_key(match) not in stored:
+            stored[well_key(match)] = match
+            by_name[match.get("well_name")].append(match)
+
+    counts = collections.Counter()
+    operations = list()
+    deltas = dict()
+    period_documents = list()
+    changed_wells = list()
+    for document in documents:
+        records = compact.report_records(document)
+        match = adopted_match(document, stored, by_name)
+        if match is None:
+            operations.append(insert_operation(document, records, now))
+            rollups.accumulate_well(deltas, document.get("county"), records)
+            period_documents.append(period_document(document, records))
+            counts["wells_inserted"] += 1
+            counts["periods_new"] += len(period_groups(records))
+            continue
+        changed_wells.append((document, records, match))
+
+    # Stored values are only needed for wells that changed
+    previous = dict()
+    needed = [match["_id"] for document, records, match in changed_wells if needs_previous(document, records, match)]
+    if needed:
+        for match in collection.find({"_id": {"$in": needed}}, REPORT_PROJECTION):
+            previous[match["_id"]] = period_groups(compact.report_records(match))
+
+    for document, records, match in changed_wells:
+        old = previous.get(match["_id"])
+        update = update_operations(document, records, match, old, now)
+        if update is None:
+            counts["wells_unchanged"] += 1
+            continue
+        well_operations, new, changed = update
+        operations.extend(well_operations)
+        county = document.get("county")
+        rollups.accumulate_well(deltas, county, new)
+        changed_periods = period_groups(changed)
+        for period, group in changed_periods.items():
+            # The stored records of the period come out, the crawled ones go in; the well was counted before
+            for record in old[period]:
+                rollups.accumulate(deltas, county, record, wells=0, sign=-1)
+            for record in group:
+                rollups.accumulate(deltas, county, record, wells=0)
+        if new or changed:
+            period_documents.append(period_document(document, new + changed))
+        counts["wells_updated"] += 1
+        counts["periods_new"] += len(period_groups(new))
+        counts["periods_changed"] += len(changed_periods)
+    return Plan(operations, deltas, period_documents, counts)
+
+
+def adopted_match(document, stored, by_name):
+    """
+    The stored well a document is written to. Wells stored before permit numbers were kept are adopted by the next
+    write with a permit number, and a document without a permit number adopts the stored well of its name when there
+    is only one.
+    :param stored: {well key: stored well}
+    :param by_name: {well_name: [stored wells]}
+    :return: Stored well or None for a new well
+    """
+    name, permit = well_key(document)
+    match = stored.get((name, permit))
+    if match is not None:
+        return match
+    if permit is not None:
+        return stored.get((name, None))
+    candidates = by_name.get(name, ())
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def write(collection, documents, periods=None, rollup_collection=None):
+    """
+    Plan and run the delta writes of a batch of well documents
+    :param collection: Well collection
+    :param documents: Well documents, see `marcellus.compact.to_document`
+    :param periods: Well x period collection kept up to date, see `marcellus.timeseries`
+    :param rollup_collection: County x period rollups kept up to date, see `marcellus.rollups`
+    :return: Counts of the plan
+    """
+    batch = plan(collection, documents)
+    if batch.operations:
+        collection.bulk_write(batch.operations, ordered=False)
+    if periods is not None:
+        timeseries.write(periods, batch.periods)
+    updates = rollups.rollup_updates(batch.deltas) if rollup_collection is not None else None
+    if updates:
+        rollup_collection.bulk_write(updates, ordered=False)
+    return batch.counts
+
+
+def needs_previous(document, records, match):
+    """
+    Legacy wells, wells changing layout, compact wells with any change and wells with changed periods are compared
+    against their stored values
+    """
+    stored_hashes = match.get(HASH_FIELD)
+    if stored_hashes is None or ("compact_report" in match) != ("compact_report" in document):
+        return True
+    hashes = period_hashes(records)
+    if "compact_report" in document:
+        return any(stored_hashes.get(period) != hash_ for period, hash_ in hashes.items())
+    return any(stored_hashes.get(period, hash_) != hash_ for period, hash_ in hashes.items())
+
+
+def insert_operation(document, records, now):
+    fields = dict(document)
+    fields[HASH_FIELD] = period_hashes(records)
+    fields["updated"] = now
+    return pymongo.UpdateOne(well_filter(document), {"$set": fields}, upsert=True)
+
+
+def well_filter(document):
+    name, permit = well_key(document)
+    return {"well_name": name, "permit_number": permit}
+
+
+def update_operations(document, records, match, old, now):
+    """
+    :param old: Stored records grouped by period, see `needs_previous` and `period_groups`; None when every stored
+        period is unchanged
+    :return: (operations, new records, changed records), or None if the well is unchanged. The changed records are all
+        the crawled records of every changed period.
+    """
+    hashes = period_hashes(records)
+    stored_hashes = match.get(HASH_FIELD) or dict()
+    if old is None:
+        new = [record for record in records if str(record.get("period")) not in stored_hashes]
+        changed = list()
+    else:
+        new = [record for record in records if record.get("period") not in old]
+        changed = [
+            record
+            for record in records
+            if record.get("period") in old
+            and group_hash(old[record.get("period")]) != hashes[str(record.get("period"))]
+        ]
+    layout_changed = ("compact_report" in match) != ("compact_report" in document)
+    if (
+        not new
+        and not changed
+        and not layout_changed
+        and match.get("fingerprint") == document.get("fingerprint")
+        # Hashes stored before periods were grouped are brought up to date
+        and all(stored_hashes.get(period) == hash_ for period, hash_ in hashes.items())
+    ):
+        return None
+
+    selector = {"_id": match["_id"]}
+    fields = {field: document[field] for field in WELL_FIELDS if field in document}
+    if document.get("permit_number") is None:
+        # Adopted without a permit number; keep the stored one
+        fields.pop("permit_number", None)
+    fields["updated"] = now
+    if old is not None:
+        # Changed, legacy and compact wells are written whole, merged period by period over the stored report
+        merged = dict(old)
+        merged.update(period_groups(records))
+        merged = [record for group in merged.values() for record in group]
+        fields[HASH_FIELD] = period_hashes(merged)
+        if "compact_report" in document:
+            fields["compact_report"] = compact.CompactReport.from_records(merged).encode()
+            unset = "production_report"
+        else:
+            fields["production_report"] = merged
+            unset = "compact_report"
+        return [pymongo.UpdateOne(selector, {"$set": fields, "$unset": {unset: ""}})], new, changed
+
+    # Only new periods; they are appended to the stored report
+    for period in period_groups(new):
+        fields[f"{HASH_FIELD}.{period}"] = hashes[str(period)]
+    operations = [pymongo.UpdateOne(selector, {"$set": fields})]
+    if new:
+        operations.append(pymongo.UpdateOne(selector, {"$push": {"production_report": {"$each": new}}}))
+    return operations, new, changed
+
+
+def period_document(document, records):
+    return dict({field: document.get(field) for field in timeseries.WELL_FIELDS}, production_report=records)
+
+
+def dedupe(collection):
+    """
+    Keep the newest document of every well key and delete the older ones
+    :param collection: Well collection
+    :return: Number of documents deleted
+    """
+    pipeline = [
+        {"$group": {"_id": {"well_name": "$well_name", "permit_number": "$permit_number"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    deleted = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        older = sorted(group["ids"])[:-1]
+        deleted += collection.delete_many({"_id": {"$in": older}}).deleted_count
+    return deleted
+
+
+def backfill_hashes(collection, batch_size=500):
+    """
+    :param collection: Well collection
+    :param batch_size: Wells per bulk write
+    :return: Number of wells hashed
+    """
+    cursor = collection.find({HASH_FIELD: {"$exists": False}}, REPORT_PROJECTION, batch_size=batch_size)
+    operations = list()
+    count = 0
+    for document in cursor:
+        hashes = period_hashes(compact.report_records(document))
+        operations.append(pymongo.UpdateOne({"_id": document["_id"]}, {"$set": {HASH_FIELD: hashes}}))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            count += len(operations)
+            operations = list()
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        count += len(operations)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare the well collection for delta writes")
+    parser.add_argument("command", choices=("migrate",))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    client = pymongo.MongoClient(settings.get("MONGO_URI", "mongodb://localhost:27017"))
+    db = client[settings.get("MONGO_DATABASE", "marcellus")]
+    collection = db[settings.get("MONGO_COLLECTION", "report.production")]
+    deleted = dedupe(collection)
+    print(f"{deleted} duplicate wells deleted")
+    print(f"{backfill_hashes(collection, args.batch_size)} wells hashed")
+    ensure_indexes(collection)
+    if deleted and settings.get("MONGO_ROLLUP_COLLECTION"):
+        # The rollups counted the duplicates
+        rollups.rebuild(collection, db[settings.get("MONGO_ROLLUP_COLLECTION")], args.batch_size)
+        print("Rollups rebuilt")
+    if settings.get("MONGO_META_COLLECTION"):
+        generation.bump(db[settings.get("MONGO_META_COLLECTION")], collection.name)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
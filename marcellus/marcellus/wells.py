@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Well search for the dashboard drilldown.
+#
+# Wells are found by a prefix of their name or of their permit number. Names are stored normalized (lowercase,
+# underscores, see MarcellusPipeline), so the search text is normalized the same way. Both searches are anchored,
+# case-sensitive prefix matches on an indexed field, which MongoDB answers with an index range scan: names use the
+# leading key of the `well_permit` index (see `marcellus.upserts`), permit numbers their own index. Pages are sorted on
+# the same index and only carry the summary fields; the production report of a well is loaded once it is picked.
+import re
+import bson
+import pandas as pd
+import pymongo
+from marcellus import compact
+
+SEARCH_FIELDS = ("well_name", "permit_number")
+
+SUMMARY_FIELDS = ("well_name", "permit_number", "county", "township")
+
+SUMMARY_PROJECTION = dict.fromkeys(SUMMARY_FIELDS, 1)
+
+SORTS = {
+    "well_name": [("well_name", pymongo.ASCENDING), ("permit_number", pymongo.ASCENDING)],
+    "permit_number": [("permit_number", pymongo.ASCENDING)],
+}
+
+REPORT_PROJECTION = {"production_report": 1, "compact_report": 1}
+
+REPORT_COLUMNS = ("period",) + compact.FLOAT_FIELDS + ("operating_days", "production_company")
+
+
+def ensure_indexes(collection):
+    """
+    Index the permit numbers; the names are covered by the `well_permit` index
+    :param collection: Well collection
+    :return:
+    """
+    collection.create_index("permit_number", name="permit_number")
+
+
+def normalize(text, field="well_name"):
+    text = (text or "").strip()
+    if field == "well_name":
+        return text.lower().replace(" ", "_")
+    return text
+
+
+def search_filter(text, field="well_name"):
+    """
+    :param text: Beginning of a well name or permit number; everything when empty
+    :param field: "well_name" or "permit_number"
+    :return: Query dict
+    """
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f"Unknown search field {field!r}")
+    prefix = normalize(text, field)
+    if not prefix:
+        return dict()
+    return {field: {"$regex": "^" + re.escape(prefix)}}
+
+
+def count(collection, text, field="well_name"):
+    return collection.count_documents(search_filter(text, field))
+
+
+def search(collection, text, field="well_name", page=0, page_size=25):
+    """
+    :param collection: Well collection
+    :param page: Page number, from 0
+    :return: DataFrame of the wells of the page with `id` and the SUMMARY_FIELDS
+    """
+    cursor = (
+        collection.find(search_filter(text, field), SUMMARY_PROJECTION)
+        .sort(SORTS[field])
+        .skip(page * page_size)
+        .limit(page_size)
+    )
+    rows = [dict({name: document.get(name) for name in SUMMARY_FIELDS}, id=str(document["_id"])) for document in cursor]
+    return pd.DataFrame.from_records(rows, columns=("id",) + SUMMARY_FIELDS)
+
+
+def document_id(well_id):
+    return bson.ObjectId(well_id) if bson.ObjectId.is_valid(well_id) else well_id
+
+
+def report_frame(records):
+    """
+    :param records: Cleaned records of one well
+    :return: DataFrame of the records, one row per period in order
+    """
+    frame = pd.DataFrame.from_records(records, columns=REPORT_COLUMNS)
+    return frame.sort_values("period").reset_index(drop=True)
+
+
+def series(collection, well_id):
+    """
+    :param collection: Well collection
+    :param well_id: `id` of a search result
+    :return: DataFrame of the production report of the well, see `report_frame`; empty when the well is gone
+    """
+    document = collection.find_one({"_id": document_id(well_id)}, REPORT_PROJECTION)
+    return report_frame(compact.report_records(document) if document is not None else [])
@@ -0,0 +1,98 @@
+import datetime
+import mongomock
+import numpy as np
+import pandas as pd
+import pytest
+from marcellus import analytics, compact, export
+
+
+def rows(well, permit_number, county, gas_by_period, days=30.0):
+    return [
+        {
+            "well": well,
+            "permit_number": permit_number,
+            "county": county,
+            "township": "athens",
+            "production_company": "EQT Production",
+            "month": compact.period_ordinal(period),
+            "avg_production": None,
+            "est_royalites": None,
+            "quanitity_of_gas": gas,
+            "value_of_gas": None,
+            "crowd_source_atw": None,
+            "operating_days": days,
+        }
+        for period, gas in gas_by_period.items()
+    ]
+
+
+def frame(*wells):
+    return analytics.finish_frame(pd.DataFrame([row for well in wells for row in well]))
+
+
+def periods(start, values):
+    year, month = map(int, start.split("-"))
+    ordinal = year * 12 + month - 1
+    return {compact.ordinal_period(ordinal + i): value for i, value in enumerate(values)}
+
+
+WELL = {"well_name": "smith_1h", "permit_number": "015-00001", "county": "bradford", "township": "athens"}
+
+
+def record(period, gas):
+    return {"period": period, "month": int(period[5:]), "quanitity_of_gas": gas, "operating_days": 15}
+
+
+# Two wells named alike, one declining 10% a month, one flat
+DECLINING = rows("smith_1h", "015-00001", "bradford", periods("2019-01", [3000.0 * 0.9**i for i in range(8)]))
+FLAT = rows("smith_1h", "015-00002", "tioga", periods("2019-01", [1500.0] * 8))
+
+
+def test_declines_are_fitted_per_well_and_permit():
+    curves = analytics.decline_curves(frame(DECLINING, FLAT), window=1)
+    rates = analytics.decline_rates(curves, min_months=6)
+    assert rates["permit_number"].astype(str).tolist() == ["015-00001", "015-00002"]
+    assert rates["monthly_decline"].tolist() == pytest.approx([-np.log(0.9), 0.0], abs=1e-9)
+    assert rates["peak_rate"].tolist() == pytest.approx([100.0, 50.0])
+
+    curve = analytics.decline_curves(frame(DECLINING, FLAT), window=1, wells=["smith_1h"], permit_number="015-00002")
+    assert curve["rate"].tolist() == pytest.approx([50.0] * 8)
+
+
+def test_trend_fills_missing_months():
+    january = rows("jones_2h", "015-00003", "bradford", {"2019-01": 10.0, "2019-03": 30.0})
+    result = analytics.trend(frame(january, FLAT[:2]), by="county", window=2)
+    bradford = result[result["county"] == "bradford"]
+    assert bradford["period"].tolist() == ["2019-01", "2019-02", "2019-03"]
+    assert bradford["total"].tolist() == [10.0, 0.0, 30.0]
+    assert bradford["rolling"].tolist() == [10.0, 5.0, 15.0]
+    overall = analytics.trend(frame(january, FLAT[:2]), window=1)
+    assert overall["total"].tolist() == [1510.0, 1500.0, 30.0]
+
+
+def test_top_producers_rank_per_period():
+    top = analytics.top_producers(frame(DECLINING, FLAT), n=1)
+    assert len(top) == 8
+    assert top["rank"].unique().tolist() == [1]
+    # The declining well out-produces the flat one until August
+    assert top["permit_number"].astype(str).tolist() == ["015-00001"] * 7 + ["015-00002"]
+    top = analytics.top_producers(frame(DECLINING, FLAT), n=2, period="2019-08")
+    assert top["permit_number"].astype(str).tolist() == ["015-00002", "015-00001"]
+    assert top["rank"].tolist() == [1, 2]
+
+
+def test_export_frame_keeps_the_latest_export(tmp_path):
+    db = mongomock.MongoClient().db
+    first = datetime.datetime(2020, 1, 1)
+    report = [record("2019-01", 10.0), record("2019-02", 9.0)]
+    db.wells.insert_one(dict(WELL, production_report=report, updated=first))
+    export.export(db.wells, str(tmp_path))
+    # Re-crawled: two operating periods in January, and February is gone
+    report = [record("2019-01", 6.0), record("2019-01", 5.0)]
+    db.wells.update_one({}, {"$set": {"production_report": report, "updated": first + datetime.timedelta(days=1)}})
+    export.export(db.wells, str(tmp_path))
+
+    loaded = analytics.load_export_frame(str(tmp_path))
+    assert loaded["period"].astype(str).tolist() == ["2019-01", "2019-01"]
+    assert sorted(loaded["quanitity_of_gas"]) == [5.0, 6.0]
+    assert loaded["permit_number"].astype(str).unique().tolist() == ["015-00001"]
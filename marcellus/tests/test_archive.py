@@ -0,0 +1,59 @@
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from marcellus import synthetic
+from marcellus.middlewares import ResponseArchiveMiddleware
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+PAGE = dict(counties=2, wells=40, townships_per_county=3, seed=3)
+
+
+def crawl(mode, archive_dir):
+    crawler = get_crawler(
+        MarcellusSpider,
+        {
+            "ARCHIVE_MODE": mode,
+            "ARCHIVE_DIR": archive_dir,
+            "INDEX_FETCH_MODE": "fragments",
+            "PERMIT_TABLE_URL": "/pro_permits.php?muni={link}",
+        },
+    )
+    spider = MarcellusSpider.from_crawler(crawler)
+    middleware = ResponseArchiveMiddleware.from_crawler(crawler)
+    middleware.spider_opened(spider)
+    return spider, middleware
+
+
+def respond(request, body):
+    return HtmlResponse(url=request.url, body=body.encode("utf-8"), encoding="utf-8", request=request)
+
+
+def test_fragments_are_recorded_and_replayed(tmp_path):
+    spider, middleware = crawl("record", str(tmp_path))
+    request = Request(f"{spider.BASE_URL}/pro_update.php", meta={"production_report_page": True})
+    page = respond(request, synthetic.index_page(tables=False, **PAGE))
+    middleware.process_response(request, page, spider)
+    townships = synthetic.township_wells(**PAGE)
+    recorded = list()
+    for fragment in spider.request_permit_tables(page):
+        township = int(fragment.meta["permit_link"])
+        response = respond(fragment, synthetic.permit_table(township, townships.get(township, ())))
+        middleware.process_response(fragment, response, spider)
+        recorded.extend(request.url for request in spider.parse_permit_table(response))
+    middleware.spider_closed(spider)
+    assert len(recorded) == 40
+
+    spider, middleware = crawl("replay", str(tmp_path))
+    replayed = list()
+    pending = list(spider.start_requests())
+    assert len(pending) == 1
+    while pending:
+        request = pending.pop()
+        response = middleware.process_request(request, spider)
+        for output in request.callback(response):
+            if output.callback == spider.parse_permit_table:
+                pending.append(output)
+            else:
+                replayed.append(output.url)
+    middleware.spider_closed(spider)
+    assert sorted(replayed) == sorted(recorded)
@@ -0,0 +1,134 @@
+import pytest
+from scrapy import Request
+from scrapy.exceptions import DropItem
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+from marcellus import synthetic
+from marcellus.checkpoint import Checkpoint
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+
+def row(well_id):
+    return {
+        "well_name": f"Well {well_id}",
+        "link": f"/pro_well.php?well_id={well_id}",
+        "county": "County0",
+        "township": "Township 0",
+        "permit_number": f"037-{well_id:05d}",
+    }
+
+
+def well_response(well_id, body):
+    request = Request(f"http://localhost{row(well_id)['link']}", meta={"row": row(well_id)})
+    return HtmlResponse(url=request.url, body=body.encode("utf-8"), encoding="utf-8", request=request)
+
+
+def township(permit_link):
+    return {"county": "County0", "township": "Township 0", "permit_link": permit_link, "index_url": "http://localhost"}
+
+
+def new_spider(tmp_path):
+    settings = {"CHECKPOINT_PATH": str(tmp_path / "checkpoint.sqlite"), "PERMIT_TABLE_URL": "/permits?muni={link}"}
+    return MarcellusSpider.from_crawler(get_crawler(MarcellusSpider, settings))
+
+
+@pytest.fixture
+def spider(tmp_path):
+    spider = new_spider(tmp_path)
+    spider.checkpoint.add_rows([row(well_id) for well_id in range(5)])
+    return spider
+
+
+def test_failed_and_dropped_wells_are_not_resumed(spider, tmp_path):
+    # Download failed
+    failure = Failure(ConnectionError("refused"))
+    failure.request = Request(f"http://localhost{row(0)['link']}", meta={"row": row(0)})
+    spider.well_report_failed(failure)
+    # Page without a report
+    assert spider.parse_well_report(well_response(1, "<html><body>No report</body></html>")) is None
+    # Item dropped by a pipeline
+    item = spider.parse_well_report(well_response(2, synthetic.well_report_page(2, periods=3)))
+    spider.item_dropped(item, None, DropItem("missing production_report"), spider)
+    # Written
+    spider.checkpoint.complete([row(3)["link"]])
+    spider.spider_closed(spider, "shutdown")
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.sqlite"))
+    assert [pending["link"] for pending in checkpoint.pending_rows()] == [row(4)["link"]]
+    assert tuple(checkpoint.progress()) == (1, 3, 5)
+    checkpoint.close()
+
+
+def test_finished_crawl_starts_over(spider, tmp_path):
+    spider.checkpoint.fail([row(0)["link"]])
+    spider.spider_closed(spider, "finished")
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.sqlite"))
+    assert checkpoint.pending_rows() == []
+    assert tuple(checkpoint.progress()) == (0, 0, 0)
+    checkpoint.close()
+
+
+def test_unread_townships_are_resumed(spider, tmp_path):
+    spider.checkpoint.add_townships([township("1"), township("2")])
+    spider.checkpoint.complete_townships(["1"])
+    spider.checkpoint.complete([row(well_id)["link"] for well_id in range(5)])
+    spider.spider_closed(spider, "finished")
+    assert spider.crawler.stats.get_value("checkpoint/pending_townships") == 1
+
+    resumed = new_spider(tmp_path)
+    (login,) = resumed.resume_or_start()
+    assert login.url == MarcellusSpider.start_urls[0]
+    assert resumed.crawler.stats.get_value("checkpoint/resumed_townships") == 1
+    logged_in = HtmlResponse(url="http://localhost/pro_update.php", body=b"", request=Request("http://localhost"))
+    (table,) = resumed.start_scraping(logged_in)
+    assert table.url.endswith("/permits?muni=2")
+    # Wells of the table already in the frontier are not requested again
+    rows = [dict(row(well_id), permit_link="2") for well_id in range(4, 7)]
+    assert [request.meta["row"]["link"] for request in resumed.request_well_reports(rows)] == [
+        row(5)["link"],
+        row(6)["link"],
+    ]
+    resumed.checkpoint.complete_townships(["2"])
+    resumed.spider_closed(resumed, "finished")
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.sqlite"))
+    assert (checkpoint.pending_townships(), tuple(checkpoint.progress())) == ([], (0, 0, 0))
+    checkpoint.close()
+
+
+def test_resume_probe_checks_the_login(spider):
+    spider.checkpoint.save_session({"PHPSESSID": "abc"})
+    (probe,) = spider.resume_or_start()
+    assert probe.callback == spider.parse_resume_probe
+    # The probe well has no report, but the session is valid
+    requests = list(spider.parse_resume_probe(well_response(0, "<html><body>No report</body></html>")))
+    assert [request.meta["row"]["link"] for request in requests] == [row(well_id)["link"] for well_id in range(1, 5)]
+    assert spider.crawler.stats.get_value("checkpoint/session_reused")
+    assert [pending["link"] for pending in spider.checkpoint.pending_rows()] == [row(i)["link"] for i in range(1, 5)]
+
+    login_page = HtmlResponse(
+        url="http://localhost/login.php",
+        body=b'<form><input type="password" name="PASSWORD"></form>',
+        request=probe,
+    )
+    (login,) = spider.parse_resume_probe(login_page)
+    assert login.url == MarcellusSpider.start_urls[0]
+
+
+def test_checkpoint_without_failed_column(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    checkpoint = Checkpoint(path)
+    checkpoint.db.executescript(
+        "DROP TABLE frontier; CREATE TABLE frontier (link TEXT PRIMARY KEY, row TEXT, done INTEGER);"
+    )
+    checkpoint.db.execute("INSERT INTO frontier VALUES (?, ?, 0)", (row(0)["link"], '{"link": "%s"}' % row(0)["link"]))
+    checkpoint.db.commit()
+    checkpoint.close()
+
+    checkpoint = Checkpoint(path)
+    assert len(checkpoint.pending_rows()) == 1
+    checkpoint.fail([row(0)["link"]])
+    assert checkpoint.pending_rows() == []
+    checkpoint.close()
@@ -0,0 +1,27 @@
+import mongomock
+from marcellus import export
+from marcellus.dashboard import SnapshotDashboardData
+
+
+def well(name, county):
+    return {
+        "well_name": name,
+        "county": county,
+        "township": "athens",
+        "production_report": [
+            {"period": "2019-01", "month": 1, "quanitity_of_gas": 10.0, "operating_days": 31},
+            {"period": "2019-02", "month": 2, "quanitity_of_gas": 12.0, "operating_days": 28},
+        ],
+    }
+
+
+def test_snapshot_reads_the_export(tmp_path):
+    collection = mongomock.MongoClient().db.wells
+    collection.insert_many([well("a", "bradford"), well("b", "bradford"), well("c", "tioga")])
+    export.export(collection, str(tmp_path))
+    data = SnapshotDashboardData(str(tmp_path), None)
+    assert data.collection is None
+    assert data.periods() == ["2019-01", "2019-02"]
+    counts = data.county_counts("2019-01")
+    assert dict(zip(counts["county"], counts["sum"])) == {"BRADFORD": 2, "TIOGA": 1}
+    assert data.count_wells("") == 3
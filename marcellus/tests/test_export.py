@@ -0,0 +1,63 @@
+import datetime
+import os
+import mongomock
+import pytest
+from marcellus import export
+
+
+def well(name, county="bradford"):
+    return {
+        "well_name": name,
+        "county": county,
+        "township": "athens",
+        "production_report": [{"period": "2019-01", "month": 1, "quanitity_of_gas": 10.0, "operating_days": 31}],
+    }
+
+
+@pytest.fixture
+def collection():
+    collection = mongomock.MongoClient().db.wells
+    collection.insert_many([well("a"), well("b", county="tioga")])
+    return collection
+
+
+def test_full_export_replaces_previous_export(collection, tmp_path):
+    out = str(tmp_path / "export")
+    export.export(collection, out)
+    os.makedirs(os.path.join(out, "county=gone", "year=2018"))
+    state, wells, rows = export.export(collection, out, full=True)
+    assert (wells, rows, state["runs"]) == (2, 2, 1)
+    assert sorted(os.listdir(out)) == ["_export.json", "county=bradford", "county=tioga"]
+
+
+def test_full_export_keeps_other_files(collection, tmp_path):
+    (tmp_path / "notes.txt").write_text("keep")
+    export.export(collection, str(tmp_path))
+    with pytest.raises(ValueError):
+        export.export(collection, str(tmp_path), full=True)
+    assert sorted(os.listdir(tmp_path)) == ["_export.json", "county=bradford", "county=tioga", "notes.txt"]
+
+
+def test_readers_keep_the_latest_export_of_a_well(collection, tmp_path):
+    out = str(tmp_path)
+    first = datetime.datetime(2020, 1, 1)
+    collection.update_many({}, {"$set": {"updated": first}})
+    february = {"period": "2019-02", "month": 2, "quanitity_of_gas": 9.0, "operating_days": 28}
+    collection.update_one({"well_name": "a"}, {"$push": {"production_report": february}})
+    export.export(collection, out)
+    # Re-crawled: two operating periods in January, and the February period is gone
+    report = [
+        {"period": "2019-01", "month": 1, "quanitity_of_gas": 6.0, "operating_days": 15},
+        {"period": "2019-01", "month": 1, "quanitity_of_gas": 5.0, "operating_days": 16},
+    ]
+    collection.update_one(
+        {"well_name": "a"}, {"$set": {"production_report": report, "updated": first + datetime.timedelta(days=1)}}
+    )
+    state, wells, rows = export.export(collection, out)
+    assert (wells, state["runs"]) == (1, 2)
+
+    rows = export.read_export(out, ["well_name", "period", "quanitity_of_gas"])
+    current = sorted(zip(rows["well_name"], rows["period"], rows["quanitity_of_gas"]))
+    assert current == [("a", "2019-01", 5.0), ("a", "2019-01", 6.0), ("b", "2019-01", 10.0)]
+    bradford = export.read_export(out, ["well_name", "quanitity_of_gas"], filters=[("county", "=", "bradford")])
+    assert sorted(bradford["quanitity_of_gas"]) == [5.0, 6.0]
@@ -0,0 +1,90 @@
+import html
+import os
+import pytest
+from parsel import Selector
+from scrapy.http import HtmlResponse
+from marcellus import cleaning, synthetic
+from marcellus.extractors import iter_fragment_rows, iter_production_report, report_from_markup, report_from_tree
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+CLEANER = cleaning.ReportCleaner()
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def report(period, company, gas, value, royalties, days, avg_production, atw):
+    return {
+        "avg_production": avg_production,
+        "est_royalites": royalties,
+        "operating_days": days,
+        "production_company": company,
+        "quanitity_of_gas": gas,
+        "value_of_gas": value,
+        "crowd_source_atw": atw,
+        "period": period,
+    }
+
+
+def index_response(tables=True):
+    page = synthetic.index_page(counties=4, wells=200, townships_per_county=5, seed=3, tables=tables)
+    return HtmlResponse(url="http://localhost/pro_update.php", body=page.encode("utf-8"), encoding="utf-8")
+
+
+@pytest.mark.parametrize("well_id", [0, 1, 17, 199, 4242])
+def test_well_report_parsers_agree(well_id):
+    selector = Selector(text=synthetic.well_report_page(well_id, periods=36, seed=3))
+    from_tree = report_from_tree(selector, well_id)
+    from_markup = CLEANER.clean(report_from_markup(selector, well_id))
+    assert len(from_tree) == 36
+    # The regex parser loses the spaces of company names
+    company = html.unescape(synthetic.COMPANIES[well_id % len(synthetic.COMPANIES)])
+    assert {record.pop("production_company") for record in from_tree} == {company}
+    assert from_tree == [{k: v for k, v in record.items() if k != "production_company"} for record in from_markup]
+
+
+def test_saved_well_report():
+    with open(os.path.join(FIXTURES, "pro_well_6021.html"), encoding="utf-8") as page:
+        selector = Selector(text=page.read())
+    chesapeake = "Chesapeake Appalachia LLC"
+    assert report_from_tree(selector, 6021) == [
+        report("2019-12", chesapeake, 1062443.0, 2231130.3, 278891.29, 184, 12125.71, 71.4),
+        report("2020-01", chesapeake, 98310.0, 176958.0, 22119.75, 19, 9313.58, 71.4),
+        report("2020-01", "Repsol Oil & Gas USA LLC", 54207.0, 97572.6, 12196.58, 12, 8131.05, None),
+    ]
+    # The regex parser keys operating periods by their text and keeps only the last of a month
+    assert CLEANER.clean(report_from_markup(selector, 6021)) == [
+        report("2019-12", "ChesapeakeAppalachiaLLC", 1062443.0, 2231130.3, 278891.29, 184, 12125.71, 71.4),
+        report("2020-01", "RepsolOil_;GasUSALLC", 54207.0, 97572.6, 12196.58, 12, 8131.05, None),
+    ]
+
+
+def test_missing_well_report():
+    selector = Selector(text=synthetic.well_report_page(5, periods=3))
+    assert report_from_tree(selector, 6) is None
+    assert report_from_markup(selector, 6) is None
+
+
+def test_index_parsers_agree():
+    response = index_response()
+    spider = MarcellusSpider()
+    spider.index_page_parser = "lxml"
+    by_tree = list(spider.iter_township_rows(response))
+    spider.index_page_parser = "xpath"
+    by_xpath = list(spider.iter_township_rows(response))
+    assert sum(len(rows) for rows in by_tree) == 200
+    assert by_tree == by_xpath
+    assert list(iter_production_report(response.selector.root)) == spider.get_production_report_rows(response)
+
+
+def test_fragment_rows_match_rendered_index():
+    rendered = {row["link"]: row for row in iter_production_report(index_response().selector.root)}
+    townships = synthetic.township_wells(counties=4, wells=200, townships_per_county=5, seed=3)
+    fragments = list()
+    for township, well_ids in townships.items():
+        root = Selector(text=synthetic.permit_table(township, well_ids)).root
+        fragments.extend(iter_fragment_rows(root, str(township)))
+    assert len(fragments) == len(rendered)
+    for row in fragments:
+        expected = {
+            field: value for field, value in rendered[row["link"]].items() if field not in ("county", "township")
+        }
+        assert row == expected
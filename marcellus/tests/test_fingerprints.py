@@ -0,0 +1,47 @@
+import mongomock
+from scrapy.utils.test import get_crawler
+from marcellus.fingerprints import load_fingerprint_index, row_fingerprint
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+
+def row(permit_number, mcf="100"):
+    return {
+        "well_name": "Smith 1H",
+        "royalty": "1.00",
+        "market_value": "2.00",
+        "mcf": mcf,
+        "permit_number": permit_number,
+    }
+
+
+def stored(permit_number, mcf="100"):
+    document = {"well_name": "smith_1h", "fingerprint": row_fingerprint(row(permit_number, mcf))}
+    if permit_number:
+        document["permit_number"] = permit_number
+    return document
+
+
+def spider(*documents):
+    collection = mongomock.MongoClient().db.wells
+    collection.insert_many(list(documents))
+    spider = MarcellusSpider.from_crawler(get_crawler(MarcellusSpider))
+    spider.persisted = load_fingerprint_index(collection)
+    return spider
+
+
+def test_wells_sharing_a_name_keep_their_fingerprints():
+    crawl = spider(stored("015-00001"), stored("015-00002", mcf="200"))
+    assert set(crawl.persisted) == {("smith_1h", "015-00001"), ("smith_1h", "015-00002")}
+    assert crawl.check_for_persisted(row("015-00001"))
+    assert crawl.check_for_persisted(row("015-00002", mcf="200"))
+    assert not crawl.check_for_persisted(row("015-00002"))
+    assert not crawl.check_for_persisted(row("015-00003"))
+    stats = crawl.crawler.stats
+    assert (stats.get_value("incremental/changed"), stats.get_value("incremental/new")) == (1, 1)
+
+
+def test_a_well_stored_without_permit_number_is_found_by_name():
+    crawl = spider(dict(stored("015-00001"), permit_number=None))
+    assert crawl.check_for_persisted(row("015-00001"))
+    assert not crawl.check_for_persisted(row("015-00001", mcf="200"))
+    assert crawl.crawler.stats.get_value("incremental/changed") == 1
@@ -0,0 +1,46 @@
+import pytest
+from scrapy import Request
+from scrapy.utils.test import get_crawler
+from marcellus import shards
+from marcellus.spiders.marcellusgas import MarcellusSpider
+
+
+def test_workers_share_the_politeness_limits():
+    settings = dict(setting.split("=") for setting in shards.worker_settings(2, 4, 0.5, 1.0))
+    assert settings == {
+        "ADAPTIVE_THROTTLE_MAX_CONCURRENCY": "2",
+        "ADAPTIVE_THROTTLE_MIN_DELAY": "1.0",
+        "CONCURRENT_REQUESTS_PER_IP": "2",
+        "DOWNLOAD_DELAY": "2.0",
+    }
+
+
+def test_more_workers_than_requests_in_flight_are_refused():
+    with pytest.raises(ValueError):
+        shards.worker_settings(3, 2, 1.0, 1.0)
+    with pytest.raises(SystemExit):
+        shards.main(["run", "--workers", "3", "--max-concurrency", "2", "--queue", "unused.sqlite"])
+
+
+class OldEngine:
+    # Scrapy before 2.6
+    def __init__(self):
+        self.crawled = list()
+
+    def crawl(self, request, spider):
+        self.crawled.append((request, spider))
+
+
+class Engine(OldEngine):
+    def crawl(self, request, spider=None):
+        assert spider is None, "the spider argument is deprecated"
+        self.crawled.append((request, spider))
+
+
+@pytest.mark.parametrize("engine_class", [OldEngine, Engine])
+def test_requests_are_scheduled_on_any_engine(engine_class):
+    spider = MarcellusSpider.from_crawler(get_crawler(MarcellusSpider))
+    spider.crawler.engine = engine = engine_class()
+    request = Request("http://localhost/pro_well.php?well_id=1")
+    spider.schedule(request)
+    assert engine.crawled == [(request, spider if engine_class is OldEngine else None)]
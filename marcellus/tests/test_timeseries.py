@@ -0,0 +1,38 @@
+import mongomock
+import pymongo
+from marcellus import timeseries
+
+REPORT = [{"period": "2019-01", "quanitity_of_gas": 10.0}, {"period": "2019-02", "quanitity_of_gas": 12.0}]
+
+
+def well(permit_number, gas=None, report=REPORT):
+    report = [record if gas is None else dict(record, quanitity_of_gas=gas) for record in report]
+    return {"well_name": "smith_1h", "permit_number": permit_number, "county": "bradford", "production_report": report}
+
+
+def test_wells_sharing_a_name_keep_their_periods():
+    periods = mongomock.MongoClient().db.periods
+    periods.create_index([("well_name", pymongo.ASCENDING), ("period", pymongo.ASCENDING)], name="well_period")
+    timeseries.ensure_indexes(periods)
+    assert "well_period" not in periods.index_information()
+    timeseries.write(periods, [well("015-00001"), well("015-00002")])
+    timeseries.write(periods, [well("015-00001", gas=20.0)])
+    assert periods.count_documents({}) == 4
+    assert periods.count_documents({"permit_number": "015-00001", "quanitity_of_gas": 20.0}) == 2
+    assert periods.count_documents({"permit_number": "015-00002", "quanitity_of_gas": {"$lt": 20.0}}) == 2
+
+
+def test_operating_periods_of_one_month_are_kept_apart():
+    periods = mongomock.MongoClient().db.periods
+    timeseries.ensure_indexes(periods)
+    january = [{"period": "2019-01", "quanitity_of_gas": 10.0}, {"period": "2019-01", "quanitity_of_gas": 5.0}]
+    timeseries.write(periods, [well("015-00001", report=january + REPORT[1:])])
+    january_total = [{"$match": {"period": "2019-01"}}, {"$group": {"_id": None, "gas": {"$sum": "$quanitity_of_gas"}}}]
+    assert periods.count_documents({}) == 3
+    assert next(periods.aggregate(january_total))["gas"] == 15.0
+    assert periods.count_documents({"period": "2019-01", "sequence": 0}) == 1
+
+    # The month is reported as one operating period again
+    timeseries.write(periods, [well("015-00001", report=[{"period": "2019-01", "quanitity_of_gas": 14.0}])])
+    assert periods.count_documents({"period": "2019-01"}) == 1
+    assert next(periods.aggregate(january_total))["gas"] == 14.0
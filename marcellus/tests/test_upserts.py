@@ -0,0 +1,114 @@
+import mongomock
+import pytest
+from twisted.internet import defer
+from marcellus import compact, pipelines, rollups, upserts
+
+
+def record(period, gas, company="EQT Production"):
+    return {
+        "avg_production": None,
+        "est_royalites": None,
+        "operating_days": 31,
+        "production_company": company,
+        "quanitity_of_gas": gas,
+        "value_of_gas": None,
+        "crowd_source_atw": None,
+        "period": period,
+    }
+
+
+def well(*records, well_name="smith_1h", permit_number="015-00001", compact_report=False):
+    report = list(records)
+    document = {
+        "well_name": well_name,
+        "permit_number": permit_number,
+        "county": "bradford",
+        "production_report": compact.CompactReport.from_records(report) if compact_report else report,
+    }
+    return compact.to_document(document)
+
+
+# Two operating periods in January
+JANUARY = (record("2019-01", 10.0), record("2019-01", 5.0, company="SWN"))
+
+
+def stored_report(collection):
+    (document,) = collection.find({})
+    return [(record["period"], record["quanitity_of_gas"]) for record in compact.report_records(document)]
+
+
+def rollup_table(collection):
+    return {(document["county"], document["period"]): document["quanitity_of_gas"] for document in collection.find({})}
+
+
+def test_a_well_counts_once_per_period():
+    collection = mongomock.MongoClient().db.wells
+    first = well(*JANUARY, record("2019-02", 12.0))
+    batch = upserts.plan(collection, [first])
+    assert batch.counts["wells_inserted"] == 1
+    assert batch.deltas == rollups.rollup_deltas([first])
+    assert {key: delta["well_count"] for key, delta in batch.deltas.items()} == {
+        ("bradford", "2019-01"): 1,
+        ("bradford", "2019-02"): 1,
+    }
+    assert batch.deltas[("bradford", "2019-01")]["quanitity_of_gas"] == 15.0
+
+    upserts.write(collection, [first])
+    second = well(*JANUARY, record("2019-02", 12.0), record("2019-03", 7.0), record("2019-03", 1.0, company="SWN"))
+    batch = upserts.plan(collection, [second])
+    assert batch.counts["wells_updated"] == 1
+    assert {key: delta["well_count"] for key, delta in batch.deltas.items()} == {("bradford", "2019-03"): 1}
+
+
+@pytest.mark.parametrize("compact_report", [False, True])
+def test_same_month_records_survive_a_recrawl(compact_report):
+    db = mongomock.MongoClient().db
+    upserts.write(db.wells, [well(*JANUARY, compact_report=compact_report)], rollup_collection=db.rollups)
+    added = well(*JANUARY, record("2019-02", 12.0), compact_report=compact_report)
+    upserts.write(db.wells, [added], rollup_collection=db.rollups)
+    assert stored_report(db.wells) == [("2019-01", 10.0), ("2019-01", 5.0), ("2019-02", 12.0)]
+
+    # The first of the two January records changes
+    changed = well(record("2019-01", 11.0), JANUARY[1], record("2019-02", 12.0), compact_report=compact_report)
+    counts = upserts.write(db.wells, [changed], rollup_collection=db.rollups)
+    assert (counts["wells_updated"], counts["periods_changed"]) == (1, 1)
+    assert stored_report(db.wells) == [("2019-01", 11.0), ("2019-01", 5.0), ("2019-02", 12.0)]
+    assert rollup_table(db.rollups) == {("bradford", "2019-01"): 16.0, ("bradford", "2019-02"): 12.0}
+    assert db.rollups.find_one({"period": "2019-01"})["well_count"] == 1
+
+    counts = upserts.write(db.wells, [changed], rollup_collection=db.rollups)
+    assert counts["wells_unchanged"] == 1
+
+
+def test_a_well_without_permit_number_is_adopted():
+    collection = mongomock.MongoClient().db.wells
+    upserts.write(collection, [well(*JANUARY)])
+    counts = upserts.write(collection, [well(*JANUARY, record("2019-02", 12.0), permit_number=None)])
+    assert counts["wells_updated"] == 1
+    assert collection.count_documents({}) == 1
+    assert collection.find_one({})["permit_number"] == "015-00001"
+
+
+def test_flushes_of_the_same_well_are_serialized(monkeypatch):
+    threads = list()
+
+    def defer_to_thread(function, *args):
+        d = defer.Deferred()
+        threads.append((function, args, d))
+        return d
+
+    monkeypatch.setattr(pipelines.threads, "deferToThread", defer_to_thread)
+    pipeline = pipelines.MongoDBPipeline("mongodb://localhost", "marcellus", "wells")
+    pipeline.buffer = [well(*JANUARY)]
+    pipeline.flush()
+    pipeline.buffer = [well(record("2019-02", 12.0), well_name="jones_2h", permit_number="015-00002")]
+    pipeline.flush()
+    pipeline.buffer = [well(*JANUARY, record("2019-02", 12.0))]
+    pipeline.flush()
+    # The third batch holds the well of the first and waits for it
+    assert len(threads) == 2
+    threads[0][2].callback(dict())
+    assert len(threads) == 3
+    for function, args, d in threads[1:]:
+        d.callback(dict())
+    assert pipeline.pending == [] and pipeline.in_flight == dict()